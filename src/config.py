@@ -7,12 +7,30 @@ import os
 from pathlib import Path
 
 AWS_PROFILE = "3di"
+AWS_RAW_PIECES = "s3://3di-data-mdb/raw/pieces"
 AWS_PIECES = "s3://3di-data-mdb/clean/pieces"
 AWS_PROJECT = "s3://3di-project-entropy"
 
+# Local directory that serves s3://<bucket>/<key> urls from <dir>/<bucket>/<key>
+# if set, to run the pipeline without AWS access
+S3_ROOT = os.environ.get("ENTROPY_S3_ROOT")
+
 ROOTDIR = Path(__file__).parent.parent
 FIGDIR = os.path.join(ROOTDIR, "output", "figures")
 TABDIR = os.path.join(ROOTDIR, "output", "tables")
+CACHEDIR = os.path.join(ROOTDIR, "cache")
+# Local copies of lookup tables, kept apart from the size-capped piece cache so
+# that evicting pieces never evicts them
+LOOKUP_CACHEDIR = os.path.join(CACHEDIR, "lookups")
+
+# Maximum size of local cache of cleaned pieces in GB
+CACHE_MAX_GB = 20
+
+# Maximum number of files read concurrently by readers in `helpers/data.py`
+IO_THREADS = 8
+
+# Number of user buckets partitioned clean pieces are split into
+USER_BUCKETS = 16
 
 # Data preprocessing parameters
 # Income and spend expressed in '000s of Pounds
@@ -1,19 +1,20 @@
 """
 Functions to create columns for analysis dataset at user-month frequency.
 
+Each aggregator is called with the txn-level data of a piece and the piece's
+user-month grouping (see `groups.py`), which is computed only once.
+
 """
 
-import re
-import os
+import collections
 import functools
+import re
 
 import numpy as np
 import pandas as pd
-from scipy import stats
-import s3fs
 
-from src import config
-import src.helpers.data as hd
+import src.data.diversity as dv
+import src.data.groups as gr
 import src.helpers.helpers as hh
 
 
@@ -22,107 +23,376 @@ TIMER_ON = False
 
 aggregators = []
 
+# Columns used by the user-month grouping passed to all aggregators
+GROUP_COLUMNS = ["user_id", "ym"]
+
+
+def aggregator(func=None, columns=None):
+    """Adds func to list of aggregator functions.
+
+    Args:
+    columns: List of txn-level columns func reads in addition to
+      `GROUP_COLUMNS`, used to read only required columns from each piece.
+      None indicates that func might read any column.
+    """
+
+    def register(func):
+        func.columns = columns
+        aggregators.append(func)
+        return func
+
+    return register(func) if func else register
+
+
+piece_aggregators = []
 
-def aggregator(func):
-    aggregators.append(func)
+
+def piece_aggregator(func):
+    """Adds func to list of functions applied to user-month data of a piece.
+
+    Used for variables that depend on all user-months of a piece, like
+    standardised scores, and thus can't be calculated by aggregators, which
+    might only see a batch of the piece's users. Functions are called with
+    the user-month data and a dict mapping names to lists of categories
+    observed in the piece, as reported by aggregators in the `categories`
+    attribute of their output.
+    """
+    piece_aggregators.append(func)
     return func
 
 
-@aggregator
+def input_columns():
+    """Returns txn-level columns read by all aggregators, or None if unknown."""
+    if any(f.columns is None for f in aggregators):
+        return None
+    return sorted(set(GROUP_COLUMNS).union(*(f.columns for f in aggregators)))
+
+
+@aggregator(columns=[])
 @hh.timer(on=TIMER_ON)
-def numeric_ym(df):
+def numeric_ym(df, groups):
     """Numeric ym variable for use in R."""
-    group_cols = [df.user_id, df.ym]
-    g = df.ym.groupby(group_cols).first()
+    g = groups.first(df.ym)
     yr = g.dt.year.astype("string")
     mt = g.dt.month.astype("string").apply("{:0>2}".format)
     return (yr + mt).astype("int").rename("ymn")
 
 
-@aggregator
+@aggregator(columns=["date"])
 @hh.timer(on=TIMER_ON)
-def month(df):
+def month(df, groups):
     """Numeric month for use as FE."""
-    group_cols = [df.user_id, df.ym]
-    return df.date.dt.month.groupby(group_cols).first().rename("month")
+    return groups.first(df.date).dt.month.rename("month")
 
 
-@aggregator
+@aggregator(columns=[])
 @hh.timer(on=TIMER_ON)
-def txns_count(df):
-    group_cols = [df.user_id, df.ym]
-    return df.groupby(group_cols).id.size().rename("txns_count")
+def txns_count(df, groups):
+    return groups.size().rename("txns_count")
+
+
+# Masked reductions
+#
+# Many variables are reductions of txn amounts over txns selected by a mask.
+# They are declared as specs below and evaluated together by
+# `masked_reductions`, which reduces only the selected rows and thus avoids
+# creating a full-length masked copy of amount for each variable. Masks are
+# functions of the txn data; consecutive specs with the same mask function
+# share a single mask evaluation.
+
+MaskedReduction = collections.namedtuple(
+    "MaskedReduction",
+    ["name", "mask", "transform", "reduction", "post"],
+    defaults=[None, None, "sum", None],
+)
+MaskedReduction.__doc__ = """Spec of a masked reduction of txn amounts.
+
+Args:
+name: Name of resulting column.
+mask: Function returning a Boolean series selecting txns to reduce, or None
+  to reduce all txns.
+transform: Function applied to the array of selected amounts.
+reduction: One of {'sum', 'count', 'mean'}.
+post: Function applied to the resulting user-month series.
+"""
+
+
+BENEFIT_TAGS = [
+    "benefits",
+    "job seekers benefits",
+    "other benefits",
+    "incapacity benefits",
+]
+
+INVEST_TAGS = [
+    "pension or investments",
+    "investment - other",
+    "investments or shares",
+]
+
+LOAN_FUND_TAGS = [
+    "personal loan",
+    "unsecured loan funds",
+    "payday loan",
+    "payday loan funds",
+    "student loan funds",
+]
+
+LOAN_RPMT_TAGS = [
+    "secured loan repayment",
+    "unsecured loan repayment",
+    "student loan repayment",
+    "payday loan",
+    "personal loan",
+]
+
+DSPEND_GROUPS = {
+    "other": [
+        "beauty products",
+        "beauty treatments",
+        "appearance",
+        "accessories",
+        "jewellery",
+        "personal electronics",
+        "hotel/b&b",
+        "gambling",
+        "games and gaming",
+        "enjoyment",
+    ],
+    "clothes": [
+        "clothes",
+        "clothes - designer or other",
+        "clothes - everyday or work",
+        "clothes - other",
+        "designer clothes",
+        "shoes",
+    ],
+    "groceries": [
+        "food, groceries, household",
+        "groceries",
+        "supermarket",
+    ],
+    "entertainment": [
+        "cinema",
+        "concert & theatre",
+        "entertainment, tv, media",
+        "sports event",
+    ],
+    "food": [
+        "dining and drinking",
+        "dining or going out",
+        "lunch or snacks",
+        "take-away",
+    ],
+}
+
+
+def _is_spend(df):
+    return df.tag_group.eq("spend") & df.is_debit
+
 
+def _is_income(df):
+    return df.tag_group.eq("income") & ~df.is_debit
 
-@aggregator
+
+def _is_benefit(df):
+    """(Non-family) benefit receipt."""
+    return df.tag_auto.isin(BENEFIT_TAGS)
+
+
+def _is_od_fee(df):
+    """Overdraft fees."""
+    pattern = r"(?:od|o/d|overdraft).*(?:fee|interest)"
+    return hh.str_predicate(df.desc, pattern) & df.is_debit
+
+
+def _is_invest(df):
+    """Flows into investment and pension funds."""
+    return df.tag_auto.isin(INVEST_TAGS) & df.is_debit
+
+
+def _is_up_savings(df):
+    """
+    Transfers from current accounts to (linked and unlinked)
+    savings accounts based on manual user tags.
+    """
+    return (
+        hh.str_predicate(df.tag_up, "saving")
+        & df.account_type.eq("current")
+        & df.is_debit
+    )
+
+
+def _is_ca_transfer(df):
+    """Transfers from current accounts."""
+    return df.tag_group.eq("transfers") & df.account_type.eq("current") & df.is_debit
+
+
+def _is_cc_payment(df):
+    """Payments into credit card accounts."""
+    return (
+        df.account_type.eq("credit card")
+        & ~df.is_debit
+        & df.tag_auto.eq("credit card")  # discards refunds
+    )
+
+
+def _is_loan_fund(df):
+    """Loan funds inflow."""
+    return df.tag_auto.isin(LOAN_FUND_TAGS) & ~df.is_debit
+
+
+def _is_loan_rpmt(df):
+    """Loan repayments."""
+    return df.tag_auto.isin(LOAN_RPMT_TAGS) & df.is_debit
+
+
+def _is_dspend(df):
+    """Discretionary spend."""
+    dspend_tags = [tag for group, tags in DSPEND_GROUPS.items() for tag in tags]
+    return df.tag_auto.isin(dspend_tags) & df.is_debit
+
+
+def _is_dd_dspend(df):
+    """Discretionary spend paid by debit direct."""
+    dd_pattern = "direct debit|dd$|d/d$|ddr$"
+    return hh.str_predicate(df.desc, dd_pattern) & _is_dspend(df)
+
+
+def _is_cc_spend(df):
+    return _is_spend(df) & df.account_type.eq("credit card")
+
+
+def _dummy(s):
+    return s.gt(0).astype(int)
+
+
+MASKED_REDUCTIONS = [
+    MaskedReduction("txns_volume", transform=np.abs),
+    MaskedReduction("txns_count_spend", _is_spend, reduction="count"),
+    # Total monthly spend in '000s of pounds for simpler coefficient comparison
+    MaskedReduction("month_spend", _is_spend, transform=lambda x: x / 1000),
+    MaskedReduction("has_benefits", _is_benefit, post=lambda s: s.lt(0).astype(int)),
+    MaskedReduction("has_od_fees", _is_od_fee, reduction="count", post=_dummy),
+    MaskedReduction("investments", _is_invest),
+    MaskedReduction("up_savings", _is_up_savings),
+    MaskedReduction("ca_transfers", _is_ca_transfer),
+    MaskedReduction("cc_payments", _is_cc_payment, transform=np.negative),
+    MaskedReduction("loan_funds", _is_loan_fund, transform=np.negative),
+    MaskedReduction("loan_rpmts", _is_loan_rpmt),
+    MaskedReduction("dspend", _is_dspend),
+    MaskedReduction("dspend_count", _is_dspend, reduction="count"),
+    MaskedReduction("dspend_mean", _is_dspend, reduction="mean"),
+    MaskedReduction("dspend_dd", _is_dd_dspend),
+]
+
+
+def _masked_reductions(df, groups, specs):
+    """Returns dataframe with one user-month column per spec."""
+    amount = df.amount.to_numpy()
+    columns = []
+    mask, rows = None, None
+    for spec in specs:
+        if spec.mask is None:
+            rows = None
+        elif spec.mask is not mask:
+            is_selected = spec.mask(df).fillna(False).to_numpy(dtype=bool)
+            rows = np.flatnonzero(is_selected)
+        mask = spec.mask
+        values = amount if rows is None else amount[rows]
+        if spec.transform is not None:
+            values = spec.transform(values)
+        column = groups.reduce_rows(rows, values, spec.reduction).rename(spec.name)
+        if spec.post is not None:
+            column = spec.post(column)
+        columns.append(column)
+    return pd.concat(columns, axis=1)
+
+
+@aggregator(
+    columns=[
+        "account_type",
+        "amount",
+        "desc",
+        "is_debit",
+        "tag_auto",
+        "tag_group",
+        "tag_up",
+    ]
+)
 @hh.timer(on=TIMER_ON)
-def txns_volume(df):
-    group_cols = [df.user_id, df.ym]
-    return df.amount.abs().groupby(group_cols).sum().rename("txns_volume")
+def masked_reductions(df, groups):
+    """Variables declared in `MASKED_REDUCTIONS`."""
+    return _masked_reductions(df, groups, MASKED_REDUCTIONS)
+
+
+# Masked reductions follow these columns in user-month data, which is where
+# the aggregators they replace placed them. dspend_dd follows the columns of
+# `dspend_groups`, which depend on the spend observed in a piece.
+MASKED_REDUCTION_POSITIONS = {
+    "txns_count": ["txns_volume", "txns_count_spend"],
+    "txns_count_ca": ["has_benefits", "has_od_fees"],
+    "user_reg_ym": ["month_spend"],
+    "accounts_total": [
+        "investments",
+        "up_savings",
+        "ca_transfers",
+        "cc_payments",
+        "loan_funds",
+        "loan_rpmts",
+    ],
+    "nunique_merchant": ["dspend", "dspend_count", "dspend_mean"],
+}
 
 
-@aggregator
-@hh.timer
-def spend_txns_count(df):
-    is_spend = df.tag_group.eq("spend") & df.is_debit
-    group_cols = [df.user_id, df.ym]
-    return is_spend.groupby(group_cols).sum().rename("txns_count_spend")
+@piece_aggregator
+def order_masked_reductions(df, categories):
+    """Moves masked reductions to their positions in `MASKED_REDUCTION_POSITIONS`."""
+    moved = [col for cols in MASKED_REDUCTION_POSITIONS.values() for col in cols]
+    order = [col for col in df.columns if col not in moved and col != "dspend_dd"]
+    for anchor, cols in MASKED_REDUCTION_POSITIONS.items():
+        pos = order.index(anchor) + 1
+        order[pos:pos] = cols
+    spend_cols = {"dspend_mean"}.union(f"dspend_{group}" for group in DSPEND_GROUPS)
+    pos = max(i for i, col in enumerate(order) if col in spend_cols) + 1
+    order.insert(pos, "dspend_dd")
+    return df[order]
 
 
-@aggregator
-@hh.timer
-def txns_counts_by_account_type(df):
-    group_cols = [df.user_id, df.ym, df.account_type]
+@aggregator(columns=["account_type"])
+@hh.timer(on=TIMER_ON)
+def txns_counts_by_account_type(df, groups):
     return (
-        df.groupby(group_cols, observed=True)
-        .size()
-        .unstack()
-        .fillna(0)
+        groups.crosstab(df.account_type)
         .loc[:, ["savings", "current"]]
         .rename(columns=lambda x: f"txns_count_{x[0]}a")
     )
 
 
-@aggregator
-@hh.timer
-def benefits(df):
-    """Dummy indicating (non-family) benefit receipt."""
-    tags = ["benefits", "job seekers benefits", "other benefits", "incapacity benefits"]
-    is_benefit = df.tag_auto.isin(tags)
-    benefits = df.amount.where(is_benefit, 0)
-    group_cols = [df.user_id, df.ym]
-    return benefits.groupby(group_cols).sum().lt(0).astype(int).rename("has_benefits")
-
-
-@aggregator
-@hh.timer
-def overdraft_fees(df):
-    """Dummy for whether overdraft fees were paid."""
-    pattern = r"(?:od|o/d|overdraft).*(?:fee|interest)"
-    is_od_fee = df.desc.str.contains(pattern) & df.is_debit
-    od_fees = df.id.where(is_od_fee, np.nan)
-    group_cols = [df.user_id, df.ym]
-    return od_fees.groupby(group_cols).count().gt(0).astype(int).rename("has_od_fees")
+def _month_income(df, groups):
+    """Month income in '000s."""
+    spec = MaskedReduction("month_income", _is_income, transform=lambda x: -x / 1000)
+    return _masked_reductions(df, groups, [spec]).month_income
 
 
-@aggregator
+@aggregator(columns=["amount", "is_debit", "tag_group"])
 @hh.timer(on=TIMER_ON)
-def income(df):
-    """Month and year income in '000s for easier coefficient comparison."""
-    is_income_pmt = df.tag_group.eq("income") & ~df.is_debit
-    inc_pmts = df.amount.where(is_income_pmt, 0).mul(-1).div(1000)
-    year = df.date.dt.year.rename("year")
-
-    month_income = (
-        inc_pmts.groupby([df.user_id, df.ym, year]).sum().rename("month_income")
+def income(df, groups):
+    """Month and year income in '000s for easier coefficient comparison.
+
+    Year values are calculated from month totals since user-months are
+    nested within user-years.
+    """
+    user_id, ym = (groups.index.get_level_values(x) for x in ["user_id", "ym"])
+    month_income = _month_income(df, groups)
+    month_income.index = pd.MultiIndex.from_arrays(
+        [user_id, ym, ym.year], names=["user_id", "ym", "year"]
     )
 
-    year_income = inc_pmts.groupby([df.user_id, year]).sum().rename("year_income")
+    year_income = month_income.groupby(["user_id", "year"]).sum().rename("year_income")
 
     month_income_mean = (
-        inc_pmts.groupby([df.user_id, df.ym, year])
-        .sum()
-        .groupby(["user_id", "year"])
+        month_income.groupby(["user_id", "year"])
         .transform("mean")
         .rename("month_income_mean")
     )
@@ -147,21 +417,18 @@ def income(df):
     ).droplevel("year")
 
 
-@aggregator
+@aggregator(columns=["amount", "is_debit", "is_sa_flow", "tag_group"])
 @hh.timer(on=TIMER_ON)
-def savings_accounts_flows(df):
+def savings_accounts_flows(df, groups):
     """Saving accounts flows variables."""
-    is_sa_flow = df.account_type.eq("savings") & df.amount.abs().gt(5)
-    sa_flows = df.amount.where(df.is_sa_flow, 0)
-    in_out = df.is_debit.map({True: "outflows", False: "inflows"})
-    month_income = income(df).month_income
-    group_vars = [df.user_id, df.ym, in_out]
+    month_income = _month_income(df, groups)
+    specs = [
+        MaskedReduction("inflows", lambda df: df.is_sa_flow & ~df.is_debit),
+        MaskedReduction("outflows", lambda df: df.is_sa_flow & df.is_debit),
+    ]
     return (
-        sa_flows.groupby(group_vars)
-        .sum()
+        _masked_reductions(df, groups, specs)
         .abs()
-        .unstack()
-        .fillna(0)
         .assign(
             netflows=lambda df: df.inflows - df.outflows,
             netflows_norm=lambda df: df.netflows / month_income,
@@ -175,101 +442,78 @@ def savings_accounts_flows(df):
     )
 
 
-@aggregator
+@aggregator(columns=["user_registration_date"])
 @hh.timer(on=TIMER_ON)
-def user_registration_ym(df):
+def user_registration_ym(df, groups):
     """Year-month of user registration."""
-    group_cols = [df.user_id, df.ym]
     return (
-        df.groupby(group_cols)
-        .user_registration_date.first()
+        groups.first(df.user_registration_date)
         .dt.to_period("m")
         .rename("user_reg_ym")
     )
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def month_spend(df):
-    """Total monthly spend in '000s of pounds for simpler coefficient comparison."""
-    is_spend = df.tag_group.eq("spend") & df.is_debit
-    spend = df.amount.where(is_spend, np.nan).div(1000)
-    group_cols = [df.user_id, df.ym]
-    return spend.groupby(group_cols).sum().rename("month_spend")
-
-
-@aggregator
+@aggregator(columns=["birth_year", "user_registration_date"])
 @hh.timer(on=TIMER_ON)
-def age(df):
+def age(df, groups):
     """Adds user age at time of signup."""
-    group_cols = [df.user_id, df.ym]
     age = df.user_registration_date.dt.year - df.birth_year
-    return age.groupby(group_cols).first().rename("age")
+    return groups.first(age).rename("age")
 
 
-@aggregator
+@aggregator(columns=["is_female"])
 @hh.timer(on=TIMER_ON)
-def female(df):
+def female(df, groups):
     """Dummy for whether user is a women."""
-    group_cols = [df.user_id, df.ym]
-    return df.groupby(group_cols).is_female.first()
+    return groups.first(df.is_female)
 
 
-@aggregator
+@aggregator(columns=["is_urban", "region_name"])
 @hh.timer(on=TIMER_ON)
-def region(df):
+def region(df, groups):
     """Region and urban dummy."""
-    group_cols = [df.user_id, df.ym]
-    return (
-        df.rename(columns={"region_name": "region"})
-        .groupby(group_cols)[["region", "is_urban"]]
-        .first()
-        .assign(region_code=lambda df: df.region.factorize()[0])
+    return pd.concat(
+        [groups.first(df.region_name).rename("region"), groups.first(df.is_urban)],
+        axis=1,
     )
 
 
-@aggregator
+@aggregator(columns=["account_type"])
 @hh.timer(on=TIMER_ON)
-def has_savings_account(df):
+def has_savings_account(df, groups):
     """Indicator for whether user has at least one savings account added.
 
     We can only observe an account as added when we observe a transaction. So
     the indicator is one when we observe at least one sa txn for the user.
     """
-    group_cols = [df.user_id, df.ym]
     return (
-        df.account_type.eq("savings")
-        .groupby(group_cols)
-        .max()
+        groups.max(df.account_type.eq("savings"))
         .groupby("user_id")
         .transform("max")
         .rename("has_savings_account")
     )
 
 
-@aggregator
+@aggregator(columns=["account_type"])
 @hh.timer(on=TIMER_ON)
-def has_current_account(df):
+def has_current_account(df, groups):
     """Indicator for whether user has at least one current account added.
 
     We can only observe an account as added when we observe a transaction. So
     the indicator is one when we observe at least one current account txn for
     the user.
     """
-    group_cols = [df.user_id, df.ym]
     return (
-        df.account_type.eq("current")
-        .groupby(group_cols)
-        .max()
+        groups.max(df.account_type.eq("current"))
         .groupby("user_id")
         .transform("max")
         .rename("has_current_account")
     )
 
 
-@aggregator
+@aggregator(columns=["birth_year"])
 @hh.timer(on=TIMER_ON)
-def generation(df):
+def generation(df, groups):
     """Generation of user.
 
     Source: https://www.beresfordresearch.com/age-range-by-generation/
@@ -290,12 +534,10 @@ def generation(df):
             gen = "Gen Z"
         return gen
 
-    group_cols = [df.user_id, df.ym]
     gens = ["Post War", "Boomers", "Gen X", "Millennials", "Gen Z"]
     gen_cats = pd.CategoricalDtype(gens, ordered=True)
     return (
-        df.groupby(group_cols)
-        .birth_year.first()
+        groups.first(df.birth_year)
         .map(gen)
         .astype(gen_cats)
         .rename("generation")
@@ -304,260 +546,94 @@ def generation(df):
     )
 
 
-@aggregator
+@aggregator(columns=["account_type", "amount", "is_debit", "tag_group"])
 @hh.timer(on=TIMER_ON)
-def proportion_credit(df):
+def proportion_credit(df, groups):
     """Proportion of month spend paid by credit card."""
-    group_cols = [df.user_id, df.ym]
-    is_spend = df.tag_group.eq("spend") & df.is_debit
-    spend = df.amount.where(is_spend, np.nan).groupby(group_cols).sum()
-    is_cc_spend = is_spend & df.account_type.eq("credit card")
-    cc_spend = df.amount.where(is_cc_spend, np.nan).groupby(group_cols).sum()
-    return cc_spend.div(spend).rename("prop_credit")
-
-
-@aggregator
-@hh.timer(on=TIMER_ON)
-def num_accounts(df):
-    """Number of active accounts."""
-    group_cols = [df.user_id, df.ym]
-    total = (
-        df.groupby("user_id")
-        .account_id.nunique()
-        .rename("accounts_total")
-        .reset_index()
-    )
-    return (
-        df.groupby(group_cols)
-        .account_id.nunique()
-        .rename("accounts_active")
-        .reset_index()
-        .merge(total)
-        .set_index(["user_id", "ym"])
-    )
-
-
-@aggregator
-@hh.timer(on=TIMER_ON)
-def investments(df):
-    """Flows into investment and pension funds."""
-    group_cols = [df.user_id, df.ym]
-    invest_tags = [
-        "pension or investments",
-        "investment - other",
-        "investments or shares",
+    specs = [
+        MaskedReduction("spend", _is_spend),
+        MaskedReduction("cc_spend", _is_cc_spend),
     ]
-    is_invest = df.tag_auto.isin(invest_tags) & df.is_debit
-    invest = df.amount.where(is_invest, 0)
-    return invest.groupby(group_cols).sum().rename("investments")
-
-
-@aggregator
-@hh.timer(on=TIMER_ON)
-def user_precedence_tag_based_savings(df):
-    """
-    Transfers from current accounts to (linked and unlinked)
-    savings accounts based on manual user tags.
-    """
-    group_vars = [df.user_id, df.ym]
-    is_tfr = (
-        df.tag_up.str.contains("saving") & df.account_type.eq("current") & df.is_debit
-    )
-    tfr = df.amount.where(is_tfr, 0)
-    return tfr.groupby(group_vars).sum().rename("up_savings")
-
-
-@aggregator
-@hh.timer(on=TIMER_ON)
-def current_account_transfers(df):
-    """
-    Transfers from current accounts.
-    """
-    group_vars = [df.user_id, df.ym]
-    is_tfr = df.tag_group.eq("transfers") & df.account_type.eq("current") & df.is_debit
-    tfr = df.amount.where(is_tfr, 0)
-    return tfr.groupby(group_vars).sum().rename("ca_transfers")
+    sums = _masked_reductions(df, groups, specs)
+    return sums.cc_spend.div(sums.spend).rename("prop_credit")
 
 
-@aggregator
+@aggregator(columns=["account_id"])
 @hh.timer(on=TIMER_ON)
-def credit_card_payments(df):
-    """
-    Payments into credit card accounts.
-    """
-    group_vars = [df.user_id, df.ym]
-    is_cc_inflow = (
-        df.account_type.eq("credit card")
-        & ~df.is_debit
-        & df.tag_auto.eq("credit card")  # discards refunds
+def num_accounts(df, groups):
+    """Number of active accounts."""
+    return pd.concat(
+        [
+            groups.nunique(df.account_id).rename("accounts_active"),
+            groups.nunique(df.account_id, by="user").rename("accounts_total"),
+        ],
+        axis=1,
     )
-    cc_inflow = df.amount.where(is_cc_inflow, 0).mul(-1)
-    return cc_inflow.groupby(group_vars).sum().rename("cc_payments")
 
 
-@aggregator
+@aggregator(columns=["is_debit", "merchant", "tag", "tag_group", "tag_spend"])
 @hh.timer(on=TIMER_ON)
-def loan_funds(df):
-    """Loan funds inflow."""
-    LOAN_FUND_TAGS = [
-        "personal loan",
-        "unsecured loan funds",
-        "payday loan",
-        "payday loan funds",
-        "student loan funds",
-    ]
-    group_vars = [df.user_id, df.ym]
-    is_loan_fund = df.tag_auto.isin(LOAN_FUND_TAGS) & ~df.is_debit
-    loan_fund = df.amount.where(is_loan_fund, 0).mul(-1)
-    return loan_fund.groupby(group_vars).sum().rename("loan_funds")
-
-
-@aggregator
-@hh.timer(on=TIMER_ON)
-def loan_repayments(df):
-    """Loan repayments."""
-    LOAN_RPMT_TAGS = [
-        "secured loan repayment",
-        "unsecured loan repayment",
-        "student loan repayment",
-        "payday loan",
-        "personal loan",
-    ]
-    group_vars = [df.user_id, df.ym]
-    is_loan_rpmt = df.tag_auto.isin(LOAN_RPMT_TAGS) & df.is_debit
-    loan_rpmts = df.amount.where(is_loan_rpmt, 0)
-    return loan_rpmts.groupby(group_vars).sum().rename("loan_rpmts")
-
-
-@aggregator
-@hh.timer
-def category_nunique(df):
+def category_nunique(df, groups):
     """Number of unique categories spent on per user-month."""
-    is_spend = df.tag_group.eq("spend") & df.is_debit
+    is_spend = _is_spend(df)
     cat_vars = ["tag", "tag_spend", "merchant"]
-    group_cols = [df.user_id, df.ym]
-    return (
-        df[cat_vars]
-        .where(is_spend, np.nan)
-        .groupby(group_cols)
-        .nunique()
-        .rename(columns=lambda x: "nunique_" + x)
-    )
-
-
-DSPEND_GROUPS = {
-    "other": [
-        "beauty products",
-        "beauty treatments",
-        "appearance",
-        "accessories",
-        "jewellery",
-        "personal electronics",
-        "hotel/b&b",
-        "gambling",
-        "games and gaming",
-        "enjoyment",
-    ],
-    "clothes": [
-        "clothes",
-        "clothes - designer or other",
-        "clothes - everyday or work",
-        "clothes - other",
-        "designer clothes",
-        "shoes",
-    ],
-    "groceries": [
-        "food, groceries, household",
-        "groceries",
-        "supermarket",
-    ],
-    "entertainment": [
-        "cinema",
-        "concert & theatre",
-        "entertainment, tv, media",
-        "sports event",
-    ],
-    "food": [
-        "dining and drinking",
-        "dining or going out",
-        "lunch or snacks",
-        "take-away",
-    ],
-}
-
-
-@aggregator
-@hh.timer(on=TIMER_ON)
-def dspend(df):
-    """Discretionary spend."""
-    group_cols = [df.user_id, df.ym]
-    dspend_tags = [tag for group, tags in DSPEND_GROUPS.items() for tag in tags]
-    is_dspend = df.tag_auto.isin(dspend_tags) & df.is_debit
-    dspend = df.amount.where(is_dspend, np.nan)
-    return dspend.groupby(group_cols).agg(
-        [("dspend", "sum"), ("dspend_count", "count"), ("dspend_mean", "mean")]
-    )
+    return pd.concat(
+        [groups.nunique(df[cat].where(is_spend, np.nan)) for cat in cat_vars],
+        axis=1,
+    ).rename(columns=lambda x: "nunique_" + x)
 
 
-@aggregator
+@aggregator(columns=["amount", "is_debit", "tag_auto"])
 @hh.timer(on=TIMER_ON)
-def dspend_groups(df):
+def dspend_groups(df, groups):
     """Spends on discretionary spend groups."""
     # Classify dspends
-    df["dspend"] = np.nan
+    dspend_group = pd.Series(np.nan, index=df.index, dtype="object")
     for group, tags in DSPEND_GROUPS.items():
         mask = df.tag_auto.isin(tags) & df.is_debit
-        df.loc[mask, "dspend"] = "_".join(["dspend", group])
+        dspend_group[mask] = "_".join(["dspend", group])
 
-    group_cols = [df.user_id, df.ym, df.dspend]
-    is_dspend = df.dspend.notna()
-    dspend = df.amount.where(is_dspend, np.nan)
-    return dspend.groupby(group_cols).sum().unstack().fillna(0)
+    dspend_group = dspend_group.astype("category")
+    dspend = df.amount.where(dspend_group.notna(), np.nan)
+    return groups.crosstab(dspend_group, dspend, how="sum").rename_axis(columns=None)
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def dspend_direct_debit(df):
-    """Discretionary spend paid by debit direct."""
-    group_cols = [df.user_id, df.ym]
-    dd_pattern = "direct debit|dd$|d/d$|ddr$"
-    dspend_tags = [tag for group, tags in DSPEND_GROUPS.items() for tag in tags]
-    is_dd_dspend = (
-        df.desc.str.contains(dd_pattern) & df.tag_auto.isin(dspend_tags) & df.is_debit
-    )
-    dd_dspend = df.amount.where(is_dd_dspend, np.nan)
-    return dd_dspend.groupby(group_cols).sum().rename("dspend_dd")
-
-
-def _entropy_base_values(df, cat, stat="size", wknd=False):
+def _entropy_base_values(df, groups, cat, stat="size", wknd=False, sparse=True):
     """Spend txns counts or values for each cat by user-month.
 
     Args:
     df: A txn-level dataframe.
+    groups: User-month grouping of df.
     cat: A column from df to be used for categorising spending transactions.
     stat: A stat in {'size', 'sum'} to calculate entropy based on counts or
       volume, respectively.
     wknd: A Boolean indicating whether spend txns should be categorised
       by (cat, wknd), if True, or by (cat), if False, where wknd is a dummy
       indicating whether a txn is dated as a Sa, So, or Mo.
+    sparse: A Boolean indicating whether to return a sparse table, if True,
+      or a dense DataFrame, if False. The dense table has one column per
+      category and is kept as a reference.
 
     Returns:
-      A DataFrame with user-month rows, category columns, and count values.
+      A SparseCrosstab or DataFrame with user-month rows, category columns,
+      and count values.
     """
-    is_cat_observed_spend = df.tag_group.eq("spend") & df.is_debit & df[cat].notna()
-    df = df.loc[is_cat_observed_spend].copy()
+    is_spend = df.tag_group.eq("spend") & df.is_debit
+    keys = df[cat].where(is_spend, np.nan).astype("category")
     if wknd:
         is_wknd = df.date.dt.dayofweek.isin([5, 6, 0]).astype(str)
-        df[cat] = df[cat].astype(str) + is_wknd
-    group_cols = [df.user_id, df.ym] + [cat]
-    return df.groupby(group_cols, observed=True).amount.agg(stat).unstack().fillna(0)
+        keys = (keys.astype(str) + is_wknd).where(keys.notna()).astype("category")
+    if sparse:
+        return groups.sparse_crosstab(keys, df.amount, how=stat)
+    return groups.crosstab(keys, df.amount, how=stat).rename_axis(columns=None)
 
 
 def _entropy_scores(df, norm=False, zscore=False, smooth=False):
     """Returns row-wise Shannon entropy scores based on base values.
 
     Args:
-    df: A DataFrame with entity rows, category columns, and count values.
+    df: A DataFrame or SparseCrosstab with entity rows, category columns, and
+      count values.
     norm: A Boolean value indicating whether to divide entorpy by
       max entropy.
     smoothed: A Boolean value indicating whether to apply additive smoothing
@@ -566,6 +642,10 @@ def _entropy_scores(df, norm=False, zscore=False, smooth=False):
     Returns:
       A series with entropy scores for each row.
     """
+    if isinstance(df, gr.SparseCrosstab):
+        return _sparse_entropy_scores(df, norm=norm, zscore=zscore, smooth=smooth)
+    from scipy import stats
+
     row_totals = df.sum(1)
     num_unique = len(df.columns)
     if smooth:
@@ -580,38 +660,65 @@ def _entropy_scores(df, norm=False, zscore=False, smooth=False):
     return pd.Series(e, index=df.index)
 
 
+def _sparse_entropy_scores(table, norm=False, zscore=False, smooth=False):
+    """Returns row-wise Shannon entropy scores based on sparse base values."""
+    measure = "entropy_s" if smooth else "entropy"
+    e = dv.measures(table, [measure]).iloc[:, 0].rename(None)
+    if norm:
+        e = e / np.log2(len(table.columns))
+    if zscore:
+        e = (e - e.mean()) / e.std()
+    return e
+
+
 def _cat_count_std(base_values):
     """Returns row-wise standard deviation of base_values."""
+    if isinstance(base_values, gr.SparseCrosstab):
+        return dv.measures(base_values, ["std"]).iloc[:, 0].rename(None)
     return base_values.std(1)
 
 
-@aggregator
-@hh.timer
-def cat_based_entropy(df):
-    """Calculate entropy based on category txn base values."""
+# Diversity measures (see `diversity.MEASURES`) by spend categorisation
+DIVERSITY_MEASURES = {
+    "tag": ["entropy", "entropy_z", "entropy_s", "entropy_sz", "std"],
+    "tag_spend": ["entropy", "entropy_z", "entropy_s", "entropy_sz", "std"],
+    "merchant": ["entropy", "entropy_z", "entropy_s", "entropy_sz", "std"],
+    "groc": ["entropy", "entropy_z", "entropy_s", "entropy_sz"],
+}
+
+
+@aggregator(columns=["amount", "is_debit", "merchant", "tag", "tag_group", "tag_spend"])
+@hh.timer(on=TIMER_ON)
+def cat_based_entropy(df, groups):
+    """Calculate diversity measures based on category txn base values.
+
+    Returns row statistics from which the measures are derived by
+    `diversity_measures` once all user-months of the piece are aggregated.
+    """
     cats = ["tag", "tag_spend", "merchant"]
     scores = []
+    categories = {}
     for cat in cats:
-        base_values = _entropy_base_values(df, cat, stat="size")
-        scores.extend(
-            [
-                _entropy_scores(base_values, smooth=False).rename(f"entropy_{cat}"),
-                _entropy_scores(base_values, smooth=False, zscore=True).rename(
-                    f"entropy_{cat}_z"
-                ),
-                _entropy_scores(base_values, smooth=True).rename(f"entropy_{cat}_s"),
-                _entropy_scores(base_values, smooth=True, zscore=True).rename(
-                    f"entropy_{cat}_sz"
-                ),
-                _cat_count_std(base_values).rename(f"std_{cat}"),
-            ]
-        )
-    return pd.concat(scores, axis=1)
-
-
-@aggregator
-@hh.timer
-def grocery_shop_entropy(df):
+        base_values = _entropy_base_values(df, groups, cat, stat="size")
+        scores.append(dv.row_stats(base_values, cat, DIVERSITY_MEASURES[cat]))
+        categories[cat] = base_values.columns.tolist()
+    scores = pd.concat(scores, axis=1)
+    scores.attrs["categories"] = categories
+    return scores
+
+
+@aggregator(
+    columns=[
+        "amount",
+        "date",
+        "is_debit",
+        "merchant",
+        "merchant_business_line",
+        "tag_group",
+    ]
+)
+@hh.timer(on=TIMER_ON)
+def grocery_shop_entropy(df, groups):
     """Returns Shannon entropy based on grocery merchant counts."""
 
     def is_grocery_shop(df):
@@ -635,25 +742,19 @@ def grocery_shop_entropy(df):
             "ocado",
         ]
         p = fr"^({'|'.join(grocers)})(:?\ssupermarket)?$"
-        return df.merchant_business_line.str.match(p)
+        return hh.str_predicate(df.merchant_business_line, p, how="match")
 
     data = df[["user_id", "ym", "tag_group", "is_debit", "amount", "date"]].copy()
     data["merchant"] = df.merchant.where(is_grocery_shop(df), np.nan)
-    counts = _entropy_base_values(data, cat="merchant", stat="size", wknd=True)
-    return pd.concat(
-        [
-            _entropy_scores(counts).rename("entropy_groc"),
-            _entropy_scores(counts, zscore=True).rename("entropy_groc_z"),
-            _entropy_scores(counts, smooth=True).rename("entropy_groc_s"),
-            _entropy_scores(counts, smooth=True, zscore=True).rename("entropy_groc_sz"),
-        ],
-        axis=1,
-    )
+    counts = _entropy_base_values(data, groups, cat="merchant", stat="size", wknd=True)
+    scores = dv.row_stats(counts, "groc", DIVERSITY_MEASURES["groc"])
+    scores.attrs["categories"] = {"groc": counts.columns.tolist()}
+    return scores
 
 
-@aggregator
-@hh.timer
-def month_spend_txn_value_and_counts(df):
+@aggregator(columns=["amount", "is_debit", "tag", "tag_group", "tag_spend"])
+@hh.timer(on=TIMER_ON)
+def month_spend_txn_value_and_counts(df, groups):
     """Monthly value and count of spend txns per category.
 
     Spend value expressed in £'000s to ease coefficient comparison.
@@ -665,9 +766,6 @@ def month_spend_txn_value_and_counts(df):
         name = re.sub(pattern, "_", x)
         return re.sub("_+", "_", name)
 
-    def spend_in_1000s(s):
-        return s.sum() / 1000
-
     is_spend = df.tag_group.eq("spend") & df.is_debit
     spend_amount = df.amount.where(is_spend, np.nan)
     cat_vars = ["tag", "tag_spend"]
@@ -675,16 +773,32 @@ def month_spend_txn_value_and_counts(df):
 
     for cat in cat_vars:
         spend_cats = df[cat].where(is_spend, np.nan)
-        group_cols = [df.user_id, df.ym, spend_cats]
-        data = (
-            spend_amount.groupby(group_cols, observed=True)
-            .agg([(f"sp_{cat}", spend_in_1000s), (f"ct_{cat}", "count")])
-            .unstack()
-            .pipe(lambda df: df.set_axis(df.columns.map("_".join), axis=1))
-            .fillna(0)
-        )
+        spend = groups.crosstab(spend_cats, spend_amount, how="sum")
+        counts = groups.crosstab(spend_cats, spend_amount, how="count")
+        data = pd.concat(
+            [
+                spend.astype("float64").div(1000).add_prefix(f"sp_{cat}_"),
+                counts.astype("float64").add_prefix(f"ct_{cat}_"),
+            ],
+            axis=1,
+        ).rename_axis(columns=None)
         frames.append(data)
 
     return pd.concat(frames, axis=1)
 
 
+@piece_aggregator
+def region_code(df, categories):
+    """Numeric region code."""
+    region_codes = df.region.factorize()[0]
+    df.insert(df.columns.get_loc("is_urban") + 1, "region_code", region_codes)
+    return df
+
+
+@piece_aggregator
+def diversity_measures(df, categories):
+    """Diversity measures of spending across categories observed in piece."""
+    for cat, measures in DIVERSITY_MEASURES.items():
+        k = len(categories.get(cat, []))
+        df = dv.add_measures(df, cat, k, measures)
+    return df
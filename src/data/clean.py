@@ -6,18 +6,26 @@ research projects.
 """
 
 import argparse
+import collections
+import concurrent.futures
 import functools
+import json
 import os
-import re
 import sys
 import time
 
-import numpy as np
-import pandas as pd
-
 import src.config as config
-import src.txn_classifications as tc
-import src.io as io
+import src.data.txn_classifications as tc
+import src.helpers.helpers as hh
+import src.helpers.trace as trace
+
+
+# Loaded on first use to keep startup fast, see `tests/test_startup.py`
+np = hh.lazy_import("numpy")
+pd = hh.lazy_import("pandas")
+io = hh.lazy_import("src.helpers.io")
+cache = hh.lazy_import("src.helpers.cache")
+hd = hh.lazy_import("src.helpers.data")
 
 
 cleaner_funcs = []
@@ -33,7 +41,8 @@ def timer(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         start = time.time()
-        result = func(*args, **kwargs)
+        with trace.span(func.__name__, "clean"):
+            result = func(*args, **kwargs)
         end = time.time()
         diff = end - start
         unit = "seconds"
@@ -46,53 +55,111 @@ def timer(func):
     return wrapper
 
 
-@cleaner
-@timer
-def remove_header_dots(df):
-    """Restores original variable names."""
-    return df.rename(columns=lambda x: x.replace(".", " "))
+# Storage-efficient types of raw columns, applied when reading raw pieces
+RAW_DTYPES = {
+    "Transaction Reference": "int32",
+    "User Reference": "int32",
+    "Year of Birth": "float32",
+    "Salary Range": "category",
+    "Postcode": "category",
+    "LSOA": "category",
+    "MSOA": "category",
+    "Derived Gender": "category",
+    "Account Reference": "int32",
+    "Provider Group Name": "category",
+    "Account Type": "category",
+    "Latest Recorded Balance": "float32",
+    "Transaction Description": "category",
+    "Credit Debit": "category",
+    "Amount": "float32",
+    "User Precedence Tag Name": "category",
+    "Manual Tag Name": "category",
+    "Auto Purpose Tag Name": "category",
+    "Merchant Name": "category",
+    "Merchant Business Line": "category",
+    "Transaction Updated Flag": "category",
+    "User Registration Date": "datetime64",
+    "Transaction Date": "datetime64",
+    "Account Created Date": "datetime64",
+    "Account Last Refreshed": "datetime64",
+    "Data Warehouse Date Last Updated": "datetime64",
+    "Data Warehouse Date Created": "datetime64",
+}
+
+
+def _is_string_type(arrow_type):
+    import pyarrow as pa
+
+    return pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)
+
+
+def _sort_categories(s):
+    """Returns categorical with only observed categories in sorted order.
+
+    Matches the categories produced by `astype("category")`, whereas those
+    of decoded dictionary columns are in order of appearance.
+    """
+    s = s.cat.remove_unused_categories()
+    return s.cat.reorder_categories(s.cat.categories.sort_values())
+
+
+def _categorical_to_datetime(s):
+    """Parses datetime strings of categorical once per category."""
+    categories = pd.to_datetime(s.cat.categories)
+    values = pd.api.extensions.take(
+        categories.to_numpy(), s.cat.codes.to_numpy(), allow_fill=True
+    )
+    return pd.Series(values, index=s.index, name=s.name)
 
 
-@cleaner
 @timer
-def cast_dtypes(df):
-    """Converts columns to storage-efficient types."""
-
-    dtypes = {
-        "Transaction Reference": "int32",
-        "User Reference": "int32",
-        "Year of Birth": "float32",
-        "Salary Range": "category",
-        "Postcode": "category",
-        "LSOA": "category",
-        "MSOA": "category",
-        "Derived Gender": "category",
-        "Account Reference": "int32",
-        "Provider Group Name": "category",
-        "Account Type": "category",
-        "Latest Recorded Balance": "float32",
-        "Transaction Description": "category",
-        "Credit Debit": "category",
-        "Amount": "float32",
-        "User Precedence Tag Name": "category",
-        "Manual Tag Name": "category",
-        "Auto Purpose Tag Name": "category",
-        "Merchant Name": "category",
-        "Merchant Business Line": "category",
-        "Transaction Updated Flag": "category",
-        "User Registration Date": "datetime64",
-        "Transaction Date": "datetime64",
-        "Account Created Date": "datetime64",
-        "Account Last Refreshed": "datetime64",
-        "Data Warehouse Date Last Updated": "datetime64",
-        "Data Warehouse Date Created": "datetime64",
-    }
+def read_raw_piece(filepath):
+    """Reads raw piece with columns cast to `RAW_DTYPES`.
+
+    Types are applied during the read rather than after it, so that the raw
+    representation of the data is never held in memory in full: string
+    columns are read straight into categoricals from their dictionary
+    encoding, numeric columns are cast one column at a time while still in
+    Arrow format, and Arrow buffers are released as they are converted.
+    Datetime strings are parsed once per unique value.
+    """
 
-    for var, dtype in dtypes.items():
-        df[var] = df[var].astype(dtype)
+    def read_dictionary(schema):
+        return [
+            name
+            for name in schema.names
+            if RAW_DTYPES.get(name.replace(".", " ")) in ["category", "datetime64"]
+            and _is_string_type(schema.field(name).type)
+        ]
+
+    with io.open_parquet(filepath, read_dictionary=read_dictionary) as pf:
+        schema = pf.metadata.schema.to_arrow_schema()
+        table = pf.read()
+    dtypes = {name: RAW_DTYPES.get(name.replace(".", " ")) for name in schema.names}
+    dictionary_columns = read_dictionary(schema)
+    for name, dtype in dtypes.items():
+        if dtype in ["int32", "float32"]:
+            i = table.schema.get_field_index(name)
+            table = table.set_column(i, name, table.column(i).cast(dtype))
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    for name, dtype in dtypes.items():
+        if dtype == "category" and name in dictionary_columns:
+            df[name] = _sort_categories(df[name])
+        elif dtype == "datetime64" and name in dictionary_columns:
+            df[name] = _categorical_to_datetime(df[name])
+        elif dtype is not None:
+            df[name] = df[name].astype(dtype)
     return df
 
 
+@cleaner
+@timer
+def remove_header_dots(df):
+    """Restores original variable names."""
+    return df.rename(columns=lambda x: x.replace(".", " "))
+
+
 @cleaner
 @timer
 def rename_cols(df):
@@ -129,6 +196,26 @@ def clean_headers(df):
     return df
 
 
+def _lowercase_categorical(s):
+    """Returns categorical with lowercased values.
+
+    Lowercases categories rather than values and merges categories that
+    become duplicates by remapping codes. Categories are observed values in
+    sorted order, as produced by `astype("category")`.
+    """
+    lower = s.cat.categories.str.lower()
+    categories = lower.unique().sort_values()
+    # missing values have code -1 and thus map to the appended -1
+    category_codes = np.append(categories.get_indexer(lower), -1)
+    codes = category_codes[s.cat.codes.to_numpy()]
+    is_used = np.bincount(codes[codes >= 0], minlength=len(categories)) > 0
+    if not is_used.all():
+        codes = np.append(np.cumsum(is_used) - 1, -1)[codes]
+        categories = categories[is_used]
+    values = pd.Categorical.from_codes(codes, categories=categories)
+    return pd.Series(values, index=s.index, name=s.name)
+
+
 @cleaner
 @timer
 def lowercase_categories(df):
@@ -138,7 +225,8 @@ def lowercase_categories(df):
     categories.
     """
     cat_vars = df.select_dtypes("category").columns
-    df[cat_vars] = df[cat_vars].apply(lambda x: x.str.lower()).astype("category")
+    for var in cat_vars:
+        df[var] = _lowercase_categorical(df[var])
     return df
 
 
@@ -201,34 +289,71 @@ def zero_balances_to_missing(df):
     return df
 
 
-def _apply_grouping(df, col_name, grouping):
-    """Applies grouping to col_name in dataframe in-place.
+# Groupings of tag_auto values into tag columns, applied in order such that
+# the last group wins for tags assigned to more than one group
+TAG_GROUPINGS = {
+    "tag": [tc.spend_subgroups, tc.income_subgroups, tc.transfers_subgroups],
+    "tag_group": [tc.tag_groups],
+    "tag_spend": [tc.tag_spend],
+}
 
-    Args:
-      grouping: a dict with name-tags pairs, where name
-        is the group name that will be applied to each txn
-        for which tag_auto equals one of the tags.
-      col_name: a column from df into which the group
-        names will be stored.
-    """
-    for group, tags in grouping.items():
-        escaped_tags = [re.escape(tag) for tag in tags]
-        pattern = "|".join(escaped_tags)
-        mask = df.tag_auto.str.fullmatch(pattern, na=False)
-        df.loc[mask, col_name] = group
 
-    return df
+@functools.lru_cache(maxsize=None)
+def _tag_lookups():
+    """Returns tag_auto to group lookup dicts and group conflicts by column.
+
+    Conflicts map tag_auto values assigned to more than one group of a
+    column to all their groups, and are reported when lookups are compiled.
+    """
+    lookups, conflicts = {}, {}
+    for col, groupings in TAG_GROUPINGS.items():
+        assignments = collections.defaultdict(list)
+        last = {}
+        for grouping in groupings:
+            for group, tags in grouping.items():
+                for tag in tags:
+                    last[tag] = group
+                    if group not in assignments[tag]:
+                        assignments[tag].append(group)
+        lookups[col] = last
+        conflicts[col] = {
+            tag: groups for tag, groups in assignments.items() if len(groups) > 1
+        }
+        for tag, groups in conflicts[col].items():
+            print(f"Tag '{tag}' is in {col} groups {groups}, using '{last[tag]}'.")
+    return lookups, conflicts
+
+
+def _lookup_tags(tag_auto, lookup):
+    """Returns categorical series with group of each txn's tag_auto value.
+
+    Groups are looked up once per tag_auto category and gathered through
+    the category codes.
+    """
+    tag_auto = tag_auto.astype("category")
+    names = sorted(set(lookup.values()))
+    name_codes = {name: code for code, name in enumerate(names)}
+    categories = tag_auto.cat.categories
+    category_codes = [name_codes.get(lookup.get(c), -1) for c in categories]
+    # missing tag_auto values have code -1 and thus map to the appended -1
+    codes = np.array(category_codes + [-1])[tag_auto.cat.codes.to_numpy()]
+    values = pd.Categorical.from_codes(codes, categories=names)
+    return pd.Series(values.remove_unused_categories(), index=tag_auto.index)
 
 
 @cleaner
 @timer
 def add_tag(df):
-    """Creates custom transaction tags for spends, income, and transfers."""
-    df["tag"] = np.nan
-    _apply_grouping(df, "tag", tc.spend_subgroups)
-    _apply_grouping(df, "tag", tc.income_subgroups)
-    _apply_grouping(df, "tag", tc.transfers_subgroups)
-    df["tag"] = df.tag.astype("category")
+    """Creates custom transaction tags, tag groups, and spend tags.
+
+    `tag` has custom tags for spends, income, and transfers, `tag_group`
+    groups transactions into income, spend, and transfers, and `tag_spend`
+    has corrected auto tag spend categories, as auto tag variable has
+    duplicated categories such as 'bank charges' and 'banking charges'.
+    """
+    lookups, _ = _tag_lookups()
+    for col, lookup in lookups.items():
+        df[col] = _lookup_tags(df.tag_auto, lookup)
     return df
 
 
@@ -237,9 +362,7 @@ def add_tag(df):
 def tag_corrections(df):
     """Fix issues with automatic tagging.
 
-    Correction is applied to `tag` to leave `tag_auto`
-    unchanged but to ensure that correction will be taken
-    into account in `add_tag_group()` below.
+    Correction is applied to `tag` to leave `tag_auto` unchanged.
     """
     # tag as tranfser those txns that are clear transfers
     # according to their description string but aren't tagged
@@ -249,15 +372,15 @@ def tag_corrections(df):
     exclude_strings = ["fee", "interest", "rewards"]
     exclude_pattern = "|".join(exclude_strings)
     mask = (
-        df.desc.str.contains(tfr_pattern)
-        & df.desc.str.contains(exclude_pattern).eq(False)
+        hh.str_predicate(df.desc, tfr_pattern)
+        & ~hh.str_predicate(df.desc, exclude_pattern)
         & df.tag.isna()
     )
     df.loc[mask, "tag"] = "other_transfers"
 
     # tag untagged txns as other_spend if desc contains "bbp",
     # which is short for bill payment
-    mask = df.desc.str.contains("bbp") & df.tag.isna()
+    mask = hh.str_predicate(df.desc, "bbp") & df.tag.isna()
     df.loc[mask, "tag"] = "other_spend"
 
     # reclassify 'interest income' as finance spend if txn is a debit
@@ -268,28 +391,81 @@ def tag_corrections(df):
     return df
 
 
-@cleaner
-@timer
-def add_tag_group(df):
-    """Groups transactions into income, spend, and transfers."""
-    df["tag_group"] = np.nan
-    _apply_grouping(df, "tag_group", tc.tag_groups)
-    df["tag_group"] = df.tag_group.astype("category")
-    return df
+DUPLICATE_COLS = ["user_id", "account_id", "date", "amount", "desc"]
 
+# Per-user number of txns and number and gross value of duplicate txns of the
+# piece last passed through `drop_duplicates`
+duplicates = None
 
-@cleaner
-@timer
-def add_tag_spend(df):
-    """Create separate variable for corrected auto tag spend categories.
 
-    Auto tag variable has duplicated categories such as 'bank charges' and
-    'banking charges'.
+def _column_values(s):
+    """Returns values of s, using codes for categoricals.
+
+    Negative float zeros are replaced by zeros, which they equal but would
+    otherwise not share hashes with.
     """
-    df["tag_spend"] = np.nan
-    _apply_grouping(df, "tag_spend", tc.tag_spend)
-    df["tag_spend"] = df.tag_spend.astype("category")
-    return df
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.codes.to_numpy()
+    values = s.to_numpy()
+    if values.dtype.kind == "f":
+        values = values + 0.0
+    return values
+
+
+def _row_keys(df, cols):
+    """Returns 64-bit hash of values of cols for each row of df.
+
+    Categoricals are hashed by their codes, so keys are only comparable
+    within df.
+    """
+    keys = np.zeros(len(df), dtype="uint64")
+    for col in cols:
+        hashes = pd.util.hash_array(_column_values(df[col]), categorize=False)
+        keys = keys * np.uint64(0x100000001B3) ^ hashes
+    return keys
+
+
+def _is_duplicate(df, cols):
+    """Returns Boolean array indicating rows that repeat an earlier row in cols.
+
+    Rows are compared by their hash keys. Duplicates found this way are
+    checked against the first row with the same key and, in the unlikely
+    case of a hash collision, rows are compared by their values instead.
+    """
+    codes, _ = pd.factorize(_row_keys(df, cols))
+    # codes are numbered in order of first appearance
+    previous_max = np.maximum.accumulate(np.append(-1, codes[:-1]))
+    is_duplicate = codes <= previous_max
+    duplicate_rows = np.flatnonzero(is_duplicate)
+    first_rows = np.flatnonzero(~is_duplicate)[codes[duplicate_rows]]
+    for col in cols:
+        values = _column_values(df[col])
+        if not pd.Series(values[duplicate_rows]).equals(
+            pd.Series(values[first_rows])
+        ):
+            return df.duplicated(subset=cols).to_numpy()
+    return is_duplicate
+
+
+def _duplicates_by_user(df, is_duplicate):
+    """Returns per-user number of txns and number and value of duplicates."""
+    gross_value = np.where(is_duplicate, df.amount.abs().to_numpy("float64"), 0)
+    return (
+        pd.DataFrame(
+            {
+                "user_id": df.user_id.to_numpy(),
+                "txns_dup": is_duplicate,
+                "value_dup": gross_value,
+            }
+        )
+        .groupby("user_id")
+        .agg(
+            txns=("txns_dup", "size"),
+            txns_dup=("txns_dup", "sum"),
+            value_dup=("value_dup", "sum"),
+        )
+        .reset_index()
+    )
 
 
 @cleaner
@@ -298,31 +474,68 @@ def drop_duplicates(df):
     """Drops duplicate transactions.
 
     Retains only the first of all txns for which user_id, account_id,
-    date, amount, and desc are identical.
+    date, amount, and desc are identical, and stores per-user duplicate
+    counts and values in `duplicates`.
 
     While this might drop some genuine duplicates (e.g. buying the same
     coffee at the same place on the same day), data inspection suggests
     that most dropped txns are unlikely to be genuine.
     """
-    df = df.copy()
-    cols = ["user_id", "account_id", "date", "amount", "desc"]
-    return df.drop_duplicates(subset=cols)
+    global duplicates
+    is_duplicate = _is_duplicate(df, DUPLICATE_COLS)
+    duplicates = _duplicates_by_user(df, is_duplicate)
+    if not is_duplicate.any():
+        return df
+    return df[~is_duplicate]
+
+
+NSPL_LOOKUP = "s3://3di-data-ons/nspl/NSPL_AUG_2020_UK/clean/lookup.csv"
+
+
+@functools.lru_cache(maxsize=None)
+def _read_regions(fp=NSPL_LOOKUP, cachedir=config.LOOKUP_CACHEDIR):
+    """Returns postcode sector to region lookup.
+
+    The lookup is kept in memory for the process and on local disk for
+    later processes, outside the piece cache, and only read from fp again if
+    fp changes.
+    """
+    columns = ["pcsector", "region_name", "is_urban"]
+    key = cache.make_key("regions", io.file_info(fp), columns)
+    cached = cache.load(key, cachedir=cachedir)
+    if cached is not None:
+        return cached[0]
+    regions = io.read_csv(fp, usecols=columns).rename(columns={"pcsector": "postcode"})
+    cache.store(key, regions, {"source": fp}, cachedir=cachedir)
+    return regions
 
 
 @cleaner
 @timer
 def add_region(df):
-    """Adds region name."""
-    columns = ["pcsector", "region_name", "is_urban"]
-    fp = "s3://3di-data-ons/nspl/NSPL_AUG_2020_UK/clean/lookup.csv"
+    """Adds region name.
+
+    Regions are looked up once per postcode category and gathered through
+    the category codes, which adds the columns without copying df. As with a
+    left merge, the result has a new range index.
+    """
     try:
-        regions = io.read_csv(fp, usecols=columns).rename(
-            columns={"pcsector": "postcode"}
-        )
+        regions = _read_regions()
     except FileNotFoundError:
         print("NSPL lookup table not found.")
-
-    return df.merge(regions, how="left", on="postcode", validate="m:1")
+        return df
+    postcode = df.postcode
+    if not isinstance(postcode.dtype, pd.CategoricalDtype):
+        postcode = postcode.astype("category")
+    # raises if lookup has duplicate postcodes, like merge with validate="m:1"
+    category_rows = pd.Index(regions.postcode).get_indexer(postcode.cat.categories)
+    # missing postcodes have code -1 and thus map to the appended -1
+    rows = np.append(category_rows, -1)[postcode.cat.codes.to_numpy()]
+    df.index = pd.RangeIndex(len(df))
+    for col in ["region_name", "is_urban"]:
+        values = regions[col].to_numpy()
+        df[col] = pd.api.extensions.take(values, rows, allow_fill=True)
+    return df
 
 
 @cleaner
@@ -332,8 +545,8 @@ def is_sa_flow(df):
     df["is_sa_flow"] = (
         df.account_type.eq("savings")
         & df.amount.abs().ge(5)
-        & ~df.tag_auto.str.contains("interest", na=False)
-        & ~df.desc.str.contains(r"save\s?the\s?change", na=False)
+        & ~hh.str_predicate(df.tag_auto, "interest")
+        & ~hh.str_predicate(df.desc, r"save\s?the\s?change")
     )
     return df
 
@@ -378,10 +591,200 @@ def order_and_sort(df):
     return df[order].sort_values(["user_id", "date"])
 
 
+def _rss_mb():
+    """Returns current resident set size of the process in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return _peak_rss_mb()
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def _reset_peak_rss():
+    """Resets peak resident set size to the current one where supported.
+
+    Linux resets the peak when 5 is written to /proc/self/clear_refs.
+    Elsewhere, the peak remains that of the process so far.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    """Returns peak resident set size in MB since the last `_reset_peak_rss`."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    import resource
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and in kilobytes on Linux
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+
+def _frame_mb(df):
+    return df.memory_usage(deep=True).sum() / 2**20
+
+
+def run_cleaners(df, steps=None, budget_mb=None):
+    """Applies cleaner functions to raw piece df.
+
+    Args:
+    df: A raw piece as returned by `read_raw_piece`.
+    steps: A list to which a dict with time, rows, and memory statistics of
+      each cleaner function is appended, or None to skip accounting.
+    budget_mb: Resident set size in MB above which cleaning is aborted with
+      a MemoryError, or None. Checked against the current size before
+      cleaning and against the peak during each cleaner function, which the
+      error then names.
+
+    Memory statistics are resident set size before and after the step, peak
+    resident set size during the step (of the process so far on systems
+    other than Linux), peak allocation traced by tracemalloc during the
+    step, and size of the resulting frame.
+    """
+    if steps is None and budget_mb is None:
+        return functools.reduce(lambda df, f: f(df), cleaner_funcs, df)
+    import tracemalloc
+
+    steps = [] if steps is None else steps
+    # Current rather than peak RSS, which might be that of an earlier piece
+    rss = _rss_mb()
+    if budget_mb is not None and rss > budget_mb:
+        raise MemoryError(
+            f"RSS of {rss:.0f}MB before cleaning is above "
+            f"budget of {budget_mb}MB (rows: {len(df):,})."
+        )
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        for func in cleaner_funcs:
+            rows_in, rss_before = len(df), _rss_mb()
+            _reset_peak_rss()
+            tracemalloc.reset_peak()
+            start = time.time()
+            df = func(df)
+            step = {
+                "step": func.__name__,
+                "seconds": time.time() - start,
+                "rows_in": rows_in,
+                "rows_out": len(df),
+                "rss_before_mb": rss_before,
+                "rss_after_mb": _rss_mb(),
+                "peak_rss_mb": _peak_rss_mb(),
+                "traced_peak_mb": tracemalloc.get_traced_memory()[1] / 2**20,
+                "frame_mb": _frame_mb(df),
+            }
+            steps.append(step)
+            if budget_mb is not None and step["peak_rss_mb"] > budget_mb:
+                raise MemoryError(
+                    f"Cleaner '{func.__name__}' raised peak RSS to "
+                    f"{step['peak_rss_mb']:.0f}MB, above budget of {budget_mb}MB "
+                    f"(rows in: {rows_in:,}, frame: {step['frame_mb']:.0f}MB)."
+                )
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return df
+
+
+def write_memory_report(report, dirpath, filepath):
+    """Writes memory report of raw piece at filepath to dirpath as json."""
+    os.makedirs(dirpath, exist_ok=True)
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    fp = os.path.join(dirpath, f"{name}.json")
+    with open(fp, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"{fp} written.")
+
+
+def piece_range(spec):
+    """Returns list of piece numbers in spec like '3', '0-4', or '0,2,5-7'."""
+    pieces = []
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        pieces.extend(range(int(first), int(last or first) + 1))
+    return pieces
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser()
-    parser.add_argument("filepath")
-    return parser.parse_args(args)
+    parser.add_argument(
+        "filepaths",
+        nargs="*",
+        metavar="filepath",
+        help="raw piece to clean, or glob pattern matching raw pieces",
+    )
+    parser.add_argument(
+        "-p",
+        "--pieces",
+        type=piece_range,
+        metavar="RANGE",
+        help="clean raw pieces in RANGE, like '0-9' or '0,3'",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to clean pieces in parallel",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="clean pieces even if their clean output is newer than the raw piece",
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="write clean pieces as datasets partitioned by user bucket and year",
+    )
+    parser.add_argument(
+        "--memory-report",
+        metavar="DIR",
+        help="write per-step memory report of each piece to DIR/<piece>.json",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        metavar="MB",
+        help="abort if peak RSS exceeds MB after any cleaner function",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="write Chrome trace of cleaner functions and io calls to PATH",
+    )
+    parser.add_argument(
+        "--trace-top",
+        type=int,
+        default=20,
+        metavar="N",
+        help="number of functions with most self time printed with --trace",
+    )
+    args = parser.parse_args(args)
+    if not args.filepaths and args.pieces is None:
+        parser.error("provide filepaths or --pieces")
+    return args
+
+
+def raw_piece_path(piece):
+    return os.path.join(config.AWS_RAW_PIECES, f"mdb_XX{piece}.parquet")
 
 
 def clean_path(path):
@@ -393,15 +796,181 @@ def clean_path(path):
     return path.replace('/raw/', '/clean/')
 
 
+def duplicates_path(path):
+    """Returns path for duplicates table of raw piece.
+
+    Tables are stored in <bucket>/clean/duplicates/<filename>.
+    """
+    return path.replace('/raw/pieces/', '/clean/duplicates/')
+
+
+def expand_filepaths(filepaths=(), pieces=None):
+    """Returns raw piece paths for paths, glob patterns, and piece numbers.
+
+    Paths are returned in the given order without repetitions. Patterns are
+    expanded to sorted matching paths.
+    """
+    paths = []
+    for path in filepaths:
+        if any(c in path for c in "*?["):
+            paths.extend(io.glob(path))
+        else:
+            paths.append(path)
+    paths.extend(raw_piece_path(piece) for piece in pieces or [])
+    return list(dict.fromkeys(paths))
+
+
+def is_up_to_date(filepath):
+    """Returns True if clean outputs of raw piece are newer than the piece."""
+    raw_modified = io.modified(filepath)
+    outputs = [
+        io.modified(clean_path(filepath)),
+        io.modified(duplicates_path(filepath)),
+    ]
+    if raw_modified is None or None in outputs:
+        return False
+    return min(outputs) > raw_modified
+
+
+# Maximum number of rows per row group of partitioned clean pieces
+PARTITION_ROW_GROUP_ROWS = 2**16
+
+
+def write_partitioned(df, path):
+    """Writes clean piece df as dataset partitioned by user bucket and year.
+
+    Rows are sorted by user_id and date, so row group statistics let readers
+    skip row groups of users they don't read.
+    """
+    df["user_bucket"] = hd.user_bucket(df.user_id)
+    df["year"] = df.date.dt.year
+    io.write_dataset(
+        df,
+        path,
+        hd.PARTITION_COLS,
+        max_rows_per_group=PARTITION_ROW_GROUP_ROWS,
+        min_rows_per_group=PARTITION_ROW_GROUP_ROWS,
+    )
+
+
 @timer
+def clean_piece(filepath, partitioned=False, memory_report=None, memory_budget=None):
+    """Cleans raw piece at filepath and writes clean piece and duplicates table.
+
+    Args:
+    filepath: Path of raw piece.
+    partitioned: Whether to write the clean piece as partitioned dataset
+      rather than as a single file, see `write_partitioned`.
+    memory_report: Directory to which the memory report of the piece is
+      written, or None.
+    memory_budget: Peak resident set size in MB above which cleaning is
+      aborted, see `run_cleaners`.
+
+    Returns:
+      A dict with a summary of the piece.
+    """
+    start = time.time()
+    df_raw = read_raw_piece(filepath)
+    report = {
+        "piece": filepath,
+        "budget_mb": memory_budget,
+        "raw_rows": len(df_raw),
+        "raw_frame_mb": _frame_mb(df_raw) if memory_report else None,
+        "steps": [],
+        "status": "ok",
+    }
+    track = memory_report or memory_budget
+    try:
+        df_clean = run_cleaners(
+            df_raw, report["steps"] if track else None, memory_budget
+        )
+    except MemoryError as e:
+        report["status"] = str(e)
+        raise
+    finally:
+        if memory_report:
+            write_memory_report(report, memory_report, filepath)
+    if partitioned:
+        write_partitioned(df_clean, clean_path(filepath))
+    else:
+        io.write_parquet(df_clean, clean_path(filepath))
+    io.write_parquet(duplicates, duplicates_path(filepath))
+    return {
+        "piece": filepath,
+        "status": "cleaned",
+        "raw_rows": report["raw_rows"],
+        "clean_rows": len(df_clean),
+        "duplicates": int(duplicates.txns_dup.sum()),
+        "seconds": time.time() - start,
+    }
+
+
+def _clean_piece_or_failure(filepath, **kwargs):
+    """Returns summary of cleaning piece, recording rather than raising errors.
+
+    Lets the remaining pieces of a batch be cleaned if one piece fails.
+    """
+    try:
+        return clean_piece(filepath, **kwargs)
+    except Exception as e:
+        return {"piece": filepath, "status": f"failed: {e!r}"}
+
+
+@timer
+def clean_pieces(filepaths, workers=1, force=False, **kwargs):
+    """Cleans raw pieces, skipping pieces with up-to-date clean outputs.
+
+    With more than one worker, pieces are cleaned in a process pool. Keyword
+    arguments are passed to `clean_piece`.
+
+    Returns:
+      A DataFrame with a summary row for each piece in filepaths.
+    """
+    todo = [fp for fp in filepaths if force or not is_up_to_date(fp)]
+    clean = functools.partial(_clean_piece_or_failure, **kwargs)
+    if workers <= 1 or len(todo) <= 1:
+        summaries = [clean(fp) for fp in todo]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=trace.reset, initargs=(trace.enabled,)
+        ) as executor:
+            summaries = []
+            for summary, events in executor.map(
+                functools.partial(trace.call_with_events, clean), todo
+            ):
+                summaries.append(summary)
+                trace.events.extend(events)
+    summaries = {summary["piece"]: summary for summary in summaries}
+    skipped = {"status": "skipped (up to date)"}
+    columns = ["piece", "status", "raw_rows", "clean_rows", "duplicates", "seconds"]
+    counts = {"raw_rows": "Int64", "clean_rows": "Int64", "duplicates": "Int64"}
+    return pd.DataFrame(
+        [summaries.get(fp, dict(skipped, piece=fp)) for fp in filepaths],
+        columns=columns,
+    ).astype(counts)
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     args = parse_args(argv)
-    df_raw = io.read_parquet(args.filepath)
-    df_clean = functools.reduce(lambda df, f: f(df), cleaner_funcs, df_raw)
-    fp_clean = clean_path(args.filepath)
-    io.write_parquet(df_clean, fp_clean)
+    trace.enable(args.trace is not None)
+    try:
+        summary = clean_pieces(
+            expand_filepaths(args.filepaths, args.pieces),
+            workers=args.workers,
+            force=args.force,
+            partitioned=args.partitioned,
+            memory_report=args.memory_report,
+            memory_budget=args.memory_budget,
+        )
+    finally:
+        if args.trace:
+            trace.report(args.trace, args.trace_top)
+    print(summary.to_string(index=False, float_format="{:.2f}".format))
+    failed = summary.piece[summary.status.str.startswith("failed")]
+    if len(failed):
+        raise RuntimeError(f"Cleaning failed for: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+"""
+Diversity measures of spending across categories.
+
+All measures are derived from a few row statistics of base values (txn counts
+or volumes by user-month and category), which are computed in a single pass
+over the nonzero entries of a base value table. The statistics are sums over
+categories that don't depend on the number of categories K, so measures that
+do (normalised and smoothed entropy, std) or that depend on all user-months
+of a piece (z-scores) can be derived once all batches of a piece have been
+aggregated.
+
+To add a measure, add an entry to `MEASURES` and, if it needs a statistic
+not yet available, to `STATS`.
+
+"""
+
+import collections
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import src.data.groups as gr
+
+
+Measure = collections.namedtuple("Measure", ["column", "requires", "func"])
+Measure.__doc__ = """Diversity measure.
+
+Args:
+column: Output column name, formatted with the category name `cat`.
+requires: Names of statistics and measures the measure is derived from.
+func: A function called with a dict of required values and the number of
+  categories K that returns the measure for each row.
+"""
+
+
+def _plogp(x):
+    return x * np.log2(x)
+
+
+# Row sums of functions of nonzero base values
+STATS = {
+    "total": lambda c: c,
+    "plogp": _plogp,
+    "smooth_plogp": lambda c: _plogp(c + 1),
+    "sumsq": np.square,
+}
+
+
+def _power_stat(name):
+    """Returns function for power sum statistic of form 'pow_{q}'."""
+    q = float(name.split("_")[1])
+    return lambda c: c**q
+
+
+def _zscore(x):
+    """Standardises x across all non-missing rows."""
+    return (x - np.nanmean(x)) / np.nanstd(x)
+
+
+def _renyi(q):
+    """Returns Rényi entropy of order q, log2(sum(p^q)) / (1 - q)."""
+    return Measure(
+        f"renyi{q:g}_{{cat}}",
+        ["total", f"pow_{q:g}"],
+        lambda v, k: (np.log2(v[f"pow_{q:g}"]) - q * np.log2(v["total"])) / (1 - q),
+    )
+
+
+MEASURES = {
+    # Shannon entropy, log2(T) - sum(c log2 c) / T for row total T
+    "entropy": Measure(
+        "entropy_{cat}",
+        ["total", "plogp"],
+        lambda v, k: np.log2(v["total"]) - v["plogp"] / v["total"],
+    ),
+    "entropy_z": Measure(
+        "entropy_{cat}_z", ["entropy"], lambda v, k: _zscore(v["entropy"])
+    ),
+    # Entropy divided by max entropy
+    "entropy_n": Measure(
+        "entropy_{cat}_n", ["entropy"], lambda v, k: v["entropy"] / np.log2(k)
+    ),
+    # Entropy after adding one to the base values of all K categories, which
+    # for zero base values adds 1 log2 1 = 0 to sum(c log2 c)
+    "entropy_s": Measure(
+        "entropy_{cat}_s",
+        ["total", "smooth_plogp"],
+        lambda v, k: np.log2(v["total"] + k) - v["smooth_plogp"] / (v["total"] + k),
+    ),
+    "entropy_sz": Measure(
+        "entropy_{cat}_sz", ["entropy_s"], lambda v, k: _zscore(v["entropy_s"])
+    ),
+    "renyi_0.5": _renyi(0.5),
+    "renyi_2": _renyi(2),
+    "hhi": Measure(
+        "hhi_{cat}", ["total", "sumsq"], lambda v, k: v["sumsq"] / v["total"] ** 2
+    ),
+    "gini_simpson": Measure(
+        "gini_simpson_{cat}", ["hhi"], lambda v, k: 1 - v["hhi"]
+    ),
+    "top1_share": Measure(
+        "top1_share_{cat}", ["total", "max"], lambda v, k: v["max"] / v["total"]
+    ),
+    # Std of base values of all K categories (ddof=1)
+    "std": Measure(
+        "std_{cat}",
+        ["total", "sumsq"],
+        lambda v, k: np.sqrt((v["sumsq"] - v["total"] ** 2 / k) / (k - 1)),
+    ),
+}
+
+
+def required_stats(measures):
+    """Returns names of statistics required to derive measures."""
+    stats = []
+    for name in measures:
+        if name in MEASURES:
+            new = required_stats(MEASURES[name].requires)
+        else:
+            new = [name]
+        stats.extend(s for s in new if s not in stats)
+    return stats
+
+
+def _as_sparse(base_values):
+    if isinstance(base_values, gr.SparseCrosstab):
+        return base_values
+    matrix = sparse.csr_matrix(base_values.to_numpy())
+    return gr.SparseCrosstab(base_values.index, base_values.columns, matrix)
+
+
+def row_stats(base_values, cat, measures):
+    """Returns row statistics of base values required to derive measures.
+
+    Args:
+    base_values: A SparseCrosstab or DataFrame with user-month rows,
+      category columns, and base values.
+    cat: Name of the categorisation, used in column names.
+    measures: List of names of measures in `MEASURES`.
+
+    Returns:
+      A DataFrame with a column '_{stat}_{cat}' for each required statistic.
+    """
+    table = _as_sparse(base_values)
+    matrix = table.matrix
+    nrows = matrix.shape[0]
+    values = matrix.data.astype("float64")
+    sizes = np.diff(matrix.indptr)
+    rows = np.repeat(np.arange(nrows), sizes)
+    stats = {}
+    for stat in required_stats(measures):
+        if stat == "max":
+            # Rows of dense base values can be empty, as all-zero rows are
+            result = np.zeros(nrows)
+            is_nonempty = sizes > 0
+            if is_nonempty.any():
+                starts = matrix.indptr[:-1][is_nonempty]
+                result[is_nonempty] = np.maximum.reduceat(values, starts)
+        else:
+            func = _power_stat(stat) if stat.startswith("pow_") else STATS[stat]
+            result = np.bincount(rows, func(values), minlength=nrows)
+        stats[f"_{stat}_{cat}"] = result
+    return pd.DataFrame(stats, index=table.index)
+
+
+def add_measures(df, cat, k, measures):
+    """Replaces row statistics of cat in df with diversity measures.
+
+    Args:
+    df: A DataFrame with row statistics columns as returned by `row_stats`.
+    cat: Name of the categorisation.
+    k: Number of categories.
+    measures: List of names of measures in `MEASURES`, in output order.
+    """
+    stat_cols = [f"_{stat}_{cat}" for stat in required_stats(measures)]
+    loc = df.columns.get_loc(stat_cols[0])
+    values = {col[1 : -len(cat) - 1]: df.pop(col).to_numpy() for col in stat_cols}
+
+    def evaluate(name):
+        if name not in values:
+            measure = MEASURES[name]
+            for required in measure.requires:
+                evaluate(required)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values[name] = measure.func(values, k)
+        return values[name]
+
+    for i, name in enumerate(measures):
+        column = MEASURES[name].column.format(cat=cat)
+        df.insert(loc + i, column, evaluate(name))
+    return df
+
+
+def measures(base_values, names):
+    """Returns measures for each row of base values.
+
+    All columns of base values are taken to be the categories, which makes
+    this suitable for tables covering all categories of a piece.
+    """
+    df = row_stats(base_values, "values", names)
+    df = add_measures(df, "values", len(base_values.columns), names)
+    return df.set_axis(names, axis=1)
@@ -0,0 +1,246 @@
+"""
+Grouping of transactions into user-months shared by all aggregators.
+
+Clean pieces are sorted by user and date, so all txns of a user-month form a
+contiguous segment of rows. Grouping is thus computed once per piece from the
+segment boundaries and reductions operate directly on those segments instead
+of hashing user_id and ym for every aggregator.
+
+"""
+
+import collections
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+SparseCrosstab = collections.namedtuple("SparseCrosstab", ["index", "columns", "matrix"])
+
+
+def is_user_month_sorted(df):
+    """Returns True if txns of each user-month are in contiguous rows."""
+    user_id = df.user_id.to_numpy()
+    ym = df.ym.array.asi8
+    user_diff = np.diff(user_id)
+    return bool(np.all((user_diff > 0) | ((user_diff == 0) & (np.diff(ym) >= 0))))
+
+
+def sort_by_user_month(df):
+    """Returns df with rows sorted by user_id and ym.
+
+    Uses a stable sort so that the order of txns within each user-month, and
+    thus the result of order-dependent reductions like `first`, is the same
+    as for an unsorted groupby.
+    """
+    if is_user_month_sorted(df):
+        return df
+    return df.sort_values(["user_id", "ym"], kind="stable")
+
+
+class UserMonthGroups:
+    """User-month grouping of a txn-level dataframe sorted by user and ym.
+
+    Attributes:
+      starts: Row position of first txn of each user-month.
+      sizes: Number of txns in each user-month.
+      codes: User-month code of each txn.
+      ngroups: Number of user-months.
+      index: (user_id, ym) MultiIndex of user-months in the order produced
+        by `df.groupby([df.user_id, df.ym])`.
+      user_codes: User code of each user-month.
+    """
+
+    def __init__(self, df):
+        user_id = df.user_id.to_numpy()
+        ym = df.ym.array.asi8
+        is_new_group = np.ones(len(df), dtype=bool)
+        is_new_group[1:] = (user_id[1:] != user_id[:-1]) | (ym[1:] != ym[:-1])
+        self.starts = np.flatnonzero(is_new_group)
+        self.sizes = np.diff(np.append(self.starts, len(df)))
+        self.codes = np.cumsum(is_new_group) - 1
+        self.ngroups = len(self.starts)
+        self.index = pd.MultiIndex.from_arrays(
+            [df.user_id.take(self.starts), df.ym.take(self.starts)],
+            names=["user_id", "ym"],
+        )
+        group_users = user_id[self.starts]
+        is_new_user = np.ones(self.ngroups, dtype=bool)
+        is_new_user[1:] = group_users[1:] != group_users[:-1]
+        self.user_codes = np.cumsum(is_new_user) - 1
+
+    def _series(self, values, name=None):
+        return pd.Series(values, index=self.index, name=name)
+
+    def _reduceat(self, ufunc, values):
+        if len(values) == 0:
+            return values[:0]
+        return ufunc.reduceat(values, self.starts)
+
+    def size(self):
+        """Returns number of txns per user-month."""
+        return self._series(self.sizes.astype("int64"))
+
+    def sum(self, s):
+        """Returns sum of non-missing values of s per user-month.
+
+        Floats are accumulated in double precision and returned in the dtype
+        of s, integers and booleans are returned as int64.
+        """
+        if s.dtype == bool or np.issubdtype(s.dtype, np.integer):
+            values = s.to_numpy().astype("int64")
+            return self._series(self._reduceat(np.add, values), s.name)
+        values = np.nan_to_num(s.to_numpy(dtype="float64"), nan=0.0)
+        sums = self._reduceat(np.add, values).astype(s.dtype)
+        return self._series(sums, s.name)
+
+    def count(self, s):
+        """Returns number of non-missing values of s per user-month."""
+        return self.sum(s.notna().rename(s.name))
+
+    def mean(self, s):
+        """Returns mean of non-missing values of s per user-month."""
+        counts = self.count(s).to_numpy()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sum(s).to_numpy(dtype="float64") / counts
+        return self._series(means.astype(s.dtype), s.name)
+
+    def max(self, s):
+        """Returns max of boolean series s per user-month."""
+        return self._series(self._reduceat(np.logical_or, s.to_numpy()), s.name)
+
+    def reduce_rows(self, rows, values, how="sum"):
+        """Returns reduction of values of selected rows per user-month.
+
+        Args:
+        rows: Array of row positions of selected txns, or None to select
+          all txns.
+        values: Array with values of the selected txns.
+        how: One of {'sum', 'count', 'mean'}.
+        """
+        codes = self.codes if rows is None else self.codes[rows]
+        is_valid = ~np.isnan(values)
+        counts = np.bincount(codes, is_valid, minlength=self.ngroups)
+        if how == "count":
+            return self._series(counts.astype("int64"))
+        weights = np.where(is_valid, values, 0).astype("float64")
+        sums = np.bincount(codes, weights, minlength=self.ngroups)
+        if how == "sum":
+            return self._series(sums.astype(values.dtype))
+        if how == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return self._series((sums / counts).astype(values.dtype))
+        raise ValueError(f"Unknown reduction: {how}")
+
+    def first(self, s):
+        """Returns first non-missing value of s per user-month."""
+        n = len(s)
+        positions = np.where(s.notna().to_numpy(), np.arange(n), n)
+        firsts = self._reduceat(np.minimum, positions)
+        is_missing = firsts == n
+        if is_missing.any():
+            values = pd.api.extensions.take(
+                s.array, np.where(is_missing, -1, firsts), allow_fill=True
+            )
+        else:
+            values = s.array.take(firsts)
+        return self._series(values, s.name)
+
+    def nunique(self, s, by="user_month"):
+        """Returns number of unique non-missing values of s per user-month.
+
+        With by="user", the number of unique values per user is returned for
+        each of the user's user-months.
+        """
+        if by == "user":
+            codes = self.user_codes[self.codes]
+            ngroups = self.user_codes.max(initial=-1) + 1
+        else:
+            codes, ngroups = self.codes, self.ngroups
+        values, uniques = pd.factorize(s)
+        nvalues = max(len(uniques), 1)
+        is_observed = values >= 0
+        pairs = np.unique(codes[is_observed] * nvalues + values[is_observed])
+        nunique = np.bincount(pairs // nvalues, minlength=ngroups)
+        if by == "user":
+            nunique = nunique[self.user_codes]
+        return self._series(nunique.astype("int64"), s.name)
+
+    def long(self, keys, values=None, how="size"):
+        """Returns long-form reduction of values by user-month and keys.
+
+        Args:
+        keys: A categorical series with txn categories. Txns with missing
+          keys are ignored.
+        values: A series with values to reduce, required unless how is 'size'.
+        how: One of {'size', 'sum', 'count'}.
+
+        Returns:
+          A tuple (group_codes, cat_codes, results) with one element per
+          observed user-month and category pair, sorted by group and category.
+        """
+        cat_codes = keys.cat.codes.to_numpy().astype("int64")
+        is_observed = cat_codes >= 0
+        ncats = max(len(keys.cat.categories), 1)
+        pairs = self.codes[is_observed] * ncats + cat_codes[is_observed]
+        unique_pairs, inverse = np.unique(pairs, return_inverse=True)
+        if how == "size":
+            results = np.bincount(inverse, minlength=len(unique_pairs))
+        elif how == "sum":
+            weights = np.nan_to_num(values.to_numpy(dtype="float64")[is_observed])
+            results = np.bincount(inverse, weights, minlength=len(unique_pairs))
+        elif how == "count":
+            weights = values.notna().to_numpy()[is_observed]
+            results = np.bincount(inverse, weights, minlength=len(unique_pairs))
+            results = results.astype("int64")
+        else:
+            raise ValueError(f"Unknown reduction: {how}")
+        return unique_pairs // ncats, unique_pairs % ncats, results
+
+    def crosstab(self, keys, values=None, how="size"):
+        """Returns user-month by category table of reduced values.
+
+        Mirrors `groupby([user_id, ym, keys]).agg(how).unstack().fillna(0)`:
+        only user-months with at least one txn with non-missing key and only
+        observed categories are included.
+        """
+        group_codes, cat_codes, results = self.long(keys, values, how)
+        rows, row_pos = np.unique(group_codes, return_inverse=True)
+        cols, col_pos = np.unique(cat_codes, return_inverse=True)
+        table = np.zeros((len(rows), len(cols)), dtype=results.dtype)
+        table[row_pos, col_pos] = results
+        if how == "sum":
+            table = table.astype(values.dtype)
+        elif len(results) < table.size:
+            # unstack introduces missing values for unobserved pairs
+            table = table.astype("float64")
+        return pd.DataFrame(
+            table,
+            index=self.index[rows],
+            columns=keys.cat.categories[cols].rename(keys.name),
+        )
+
+    def sparse_crosstab(self, keys, values=None, how="size"):
+        """Returns user-month by category table of reduced values in CSR format.
+
+        Has the same rows and columns as `crosstab` but only stores values of
+        observed user-month and category pairs, which is what keeps tables
+        with many categories, like merchants, small.
+
+        Returns:
+          A SparseCrosstab with the user-month index, the category columns,
+          and a scipy.sparse.csr_matrix of reduced values.
+        """
+        group_codes, cat_codes, results = self.long(keys, values, how)
+        rows, row_pos = np.unique(group_codes, return_inverse=True)
+        cols, col_pos = np.unique(cat_codes, return_inverse=True)
+        if how == "sum":
+            results = results.astype(values.dtype)
+        matrix = sparse.csr_matrix(
+            (results, (row_pos, col_pos)), shape=(len(rows), len(cols))
+        )
+        return SparseCrosstab(
+            index=self.index[rows],
+            columns=keys.cat.categories[cols],
+            matrix=matrix,
+        )
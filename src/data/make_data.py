@@ -5,21 +5,30 @@ Produces analysis dataset.
 
 import argparse
 import collections
-import concurrent
+import concurrent.futures
 import functools
+import inspect
+import json
 import os
 import sys
 
-import pandas as pd
-
 import src.config as config
-import src.data.aggregators as agg
-import src.data.selectors as sl
-import src.data.transformers as tf
-import src.data.validators as vl
-import src.helpers.data as hd
 import src.helpers.helpers as hh
-import src.helpers.io as io
+import src.helpers.trace as trace
+
+
+# Loaded on first use to keep startup fast, see `tests/test_startup.py`
+pd = hh.lazy_import("pandas")
+agg = hh.lazy_import("src.data.aggregators")
+dv = hh.lazy_import("src.data.diversity")
+gr = hh.lazy_import("src.data.groups")
+sl = hh.lazy_import("src.data.selectors")
+tf = hh.lazy_import("src.data.transformers")
+vl = hh.lazy_import("src.data.validators")
+cache = hh.lazy_import("src.helpers.cache")
+hd = hh.lazy_import("src.helpers.data")
+io = hh.lazy_import("src.helpers.io")
+sk = hh.lazy_import("src.helpers.sketch")
 
 
 TIMER_ON = True
@@ -28,32 +37,400 @@ TIMER_ON = True
 @hh.timer(on=TIMER_ON)
 def read_piece(filepath, **kwargs):
     print("Reading", filepath)
-    return io.read_parquet(filepath, **kwargs)
+    return hd.read_clean_piece(filepath, **kwargs)
+
+
+def _iter_partitioned_chunks(filepath, batch_size, filters=None, **kwargs):
+    """Yields txns of partitioned piece in chunks of at most batch_size txns.
+
+    A user's txns are spread over the year partitions of the user's bucket,
+    so the piece is read one bucket at a time, which keeps them together.
+    """
+    for bucket in hd.partition_buckets(filepath):
+        bucket_filters = (filters or []) + [("user_bucket", "==", bucket)]
+        df = hd.read_clean_piece(filepath, filters=bucket_filters, **kwargs)
+        for start in range(0, len(df), batch_size):
+            yield df.iloc[start : start + batch_size]
+
+
+def read_piece_batches(filepath, batch_size, **kwargs):
+    """Yields txns of piece in batches of about batch_size txns.
+
+    All txns of a user are in the same batch, which relies on the piece being
+    sorted by user.
+    """
+    print("Reading", filepath, "in batches")
+    if io.is_dir(filepath):
+        chunks = _iter_partitioned_chunks(filepath, batch_size, **kwargs)
+    else:
+        chunks = io.iter_parquet_batches(filepath, batch_size, **kwargs)
+    carry = None
+    for df in chunks:
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+        if df.empty:
+            continue
+        is_last_user = df.user_id.eq(df.user_id.iloc[-1])
+        carry = df[is_last_user]
+        if not is_last_user.all():
+            yield df[~is_last_user]
+    if carry is not None:
+        yield carry
+
+
+@trace.traced(cat="make_data")
+def aggregate_batch(df):
+    """Returns list with output of each aggregator for txns of a batch of users."""
+    df = gr.sort_by_user_month(df)
+    groups = gr.UserMonthGroups(df)
+    return [f(df, groups) for f in agg.aggregators]
+
+
+def _concat_batches(outputs):
+    """Concatenates outputs of an aggregator for different batches of users.
+
+    Category columns of crosstab outputs only contain categories observed in
+    a batch. Missing categories are zero for all of a batch's user-months,
+    as in a crosstab of the whole piece.
+    """
+    outputs = [x for x in outputs if len(x)] or outputs[:1]
+    if len(outputs) == 1:
+        return outputs[0]
+    if isinstance(outputs[0], pd.Series):
+        return pd.concat(outputs)
+    dtypes = {}
+    for x in outputs:
+        for col, dtype in x.dtypes.items():
+            dtypes.setdefault(col, dtype if dtype.kind == "f" else "float64")
+    columns = pd.Index(dtypes)
+    filled = []
+    for x in outputs:
+        missing = columns.difference(x.columns, sort=False)
+        zeros = {col: pd.Series(0, index=x.index, dtype=dtypes[col]) for col in missing}
+        filled.append(x.assign(**zeros)[columns])
+    return pd.concat(filled)
+
+
+def _observed_categories(batches):
+    """Returns union of categories reported by aggregators across batches."""
+    categories = collections.defaultdict(list)
+    for outputs in batches:
+        for x in outputs:
+            for name, labels in x.attrs.get("categories", {}).items():
+                categories[name].extend(set(labels).difference(categories[name]))
+    return dict(categories)
+
+
+@trace.traced(cat="make_data")
+def combine_aggregates(batches):
+    """Returns user-month data of a piece from aggregator outputs of its batches."""
+    categories = _observed_categories(batches)
+    outputs = [_concat_batches(list(x)) for x in zip(*batches)]
+    df = pd.concat(outputs, axis=1)
+    df.attrs = {}
+    if not df.index.is_monotonic_increasing:
+        # Batches of partitioned pieces are in user bucket order
+        df = df.sort_index()
+    for f in agg.piece_aggregators:
+        df = trace.call(f, df, categories, cat="aggregators")
+    return df.reset_index()
 
 
 @hh.timer(on=TIMER_ON)
 def aggregate_data(df):
-    return pd.concat((f(df) for f in agg.aggregators), axis=1).reset_index()
+    return combine_aggregates([aggregate_batch(df)])
 
 
 @hh.timer(on=TIMER_ON)
 def select_sample(df):
-    return functools.reduce(lambda df, f: f(df), sl.selectors, df)
+    return sl.select_sample(df)
+
+
+def read_piece_txns(filepath, filters=None):
+    """Returns txns of piece at filepath in the columns used by aggregators."""
+    return read_piece(filepath, columns=agg.input_columns(), filters=filters)
+
+
+@hh.timer(on=TIMER_ON)
+def aggregate_piece(filepath, filters=None, batch_size=None, txns=None):
+    """Returns user-month data for piece at filepath before sample selection.
+
+    If batch_size is given, the piece is read and aggregated in batches of
+    about batch_size txns, so peak memory depends on batch size rather than
+    on piece size. Otherwise, txns of the piece can be passed if they have
+    already been read with `read_piece_txns`.
+    """
+    kwargs = dict(columns=agg.input_columns(), filters=filters)
+    if batch_size is None:
+        if txns is None:
+            txns = read_piece_txns(filepath, filters)
+        data = aggregate_data(txns)
+    else:
+        batches = read_piece_batches(filepath, batch_size, **kwargs)
+        data = combine_aggregates([aggregate_batch(batch) for batch in batches])
+    return data
+
+
+@hh.timer(on=TIMER_ON)
+def clean_piece(filepath, filters=None, batch_size=None, txns=None):
+    """Returns user-month data of selected users, see `aggregate_piece`."""
+    return select_sample(aggregate_piece(filepath, filters, batch_size, txns))
+
+
+def make_filters(start=None, end=None, users=None):
+    """Returns parquet filters restricting txns to date range and users.
+
+    Filters are pushed down to the parquet reader, which skips row groups
+    whose statistics show they contain no matching txns.
+    """
+    filters = []
+    if start:
+        filters.append(("date", ">=", pd.Timestamp(start)))
+    if end:
+        filters.append(("date", "<=", pd.Timestamp(end)))
+    if users:
+        filters.append(("user_id", "in", list(users)))
+    return filters or None
+
+
+# Modules whose source determines the content of a cleaned piece, including
+# this one, which reads pieces and combines aggregator outputs
+CACHE_SOURCES = [agg, dv, gr, sl, hd, hh, sys.modules[__name__]]
+
+
+def piece_cache_key(filepath, filters=None):
+    """Returns cache key for the cleaned version of the piece at filepath.
+
+    Key changes whenever the raw piece, the code in `CACHE_SOURCES`, any of
+    the project configuration values, or the row filters change.
+    """
+    sources = [inspect.getsource(module) for module in CACHE_SOURCES]
+    settings = {k: v for k, v in vars(config).items() if k.isupper()}
+    return cache.make_key(io.file_info(filepath), sources, settings, filters)
+
+
+def _clean_piece_with_counts(
+    filepath,
+    filters=None,
+    batch_size=None,
+    use_cache=True,
+    refresh=False,
+    txns=None,
+    key=None,
+    sketch=False,
+):
+    """Returns cleaned piece, the selection counts it produced, and sketches.
+
+    Counts are returned rather than left in the module-level `sample_counts`
+    counter so they survive worker processes and can be cached alongside
+    the piece. The caller is responsible for merging them. Prefetched txns
+    are passed to `clean_piece`, and key is the piece's cache key if the
+    caller already computed it. If sketch, quantile sketches of winsorised
+    columns of the piece are returned as well, see `tf.sketch_piece`, and
+    None otherwise.
+    """
+    if use_cache:
+        key = key or piece_cache_key(filepath, filters)
+        cached = None if refresh else cache.load(key)
+        if cached is not None:
+            print("Reading", filepath, "from cache")
+            df, counts = cached
+            sketches = tf.sketch_piece(df) if sketch else None
+            return df, collections.Counter(counts), sketches
+
+    outer_counts = collections.Counter(sl.sample_counts)
+    sl.sample_counts.clear()
+    try:
+        if txns is None:
+            df = clean_piece(filepath, filters, batch_size)
+        else:
+            df = clean_piece(filepath, filters, batch_size, txns=txns)
+        counts = collections.Counter(sl.sample_counts)
+    finally:
+        sl.sample_counts.clear()
+        sl.sample_counts.update(outer_counts)
+
+    if use_cache:
+        cache.store(key, df, counts)
+    return df, counts, tf.sketch_piece(df) if sketch else None
+
+
+def _clean_pieces_prefetched(
+    filepaths, clean, filters, use_cache, refresh, depth, max_mb
+):
+    """Returns results of clean for filepaths, reading uncached pieces ahead.
+
+    While one piece is aggregated, up to depth of the following pieces are
+    read in a background thread, see `hh.prefetch`.
+    """
+    keys = [piece_cache_key(fp, filters) if use_cache else None for fp in filepaths]
+    is_cached = [use_cache and not refresh and cache.contains(key) for key in keys]
+    to_read = [fp for fp, cached in zip(filepaths, is_cached) if not cached]
+    txns = hh.prefetch(
+        (read_piece_txns(fp, filters) for fp in to_read), depth, max_mb
+    )
+    return [
+        clean(fp, key=key) if cached else clean(fp, txns=next(txns), key=key)
+        for fp, key, cached in zip(filepaths, keys, is_cached)
+    ]
 
 
 @hh.timer(on=TIMER_ON)
-def clean_piece(filepath):
-    return read_piece(filepath).pipe(aggregate_data).pipe(select_sample)
+def clean_pieces(
+    filepaths,
+    filters=None,
+    batch_size=None,
+    workers=1,
+    use_cache=True,
+    refresh=False,
+    prefetch=1,
+    prefetch_mb=None,
+    sketch=False,
+):
+    """Returns list of cleaned pieces in the order of filepaths.
+
+    With more than one worker, pieces are processed in a process pool. Each
+    piece's selection counts are merged into `sl.sample_counts`.
+
+    If sketch, each piece is sketched where it is cleaned, and a tuple of
+    the pieces and the merged quantile sketches of their winsorised columns
+    is returned, see `tf.sketch_piece`.
+
+    With a single worker and without batch_size, up to prefetch pieces are
+    read ahead while the current piece is aggregated, as long as those read
+    ahead take up no more than prefetch_mb MB, so that reading and
+    aggregating overlap.
+    """
+    clean = functools.partial(
+        _clean_piece_with_counts,
+        filters=filters,
+        batch_size=batch_size,
+        use_cache=use_cache,
+        refresh=refresh,
+        sketch=sketch,
+    )
+    if workers <= 1 and batch_size is None and prefetch > 0:
+        results = _clean_pieces_prefetched(
+            filepaths, clean, filters, use_cache, refresh, prefetch, prefetch_mb
+        )
+    elif workers <= 1:
+        results = [clean(fp) for fp in filepaths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=trace.reset, initargs=(trace.enabled,)
+        ) as executor:
+            traced_results = executor.map(
+                functools.partial(trace.call_with_events, clean), filepaths
+            )
+            results = []
+            for result, events in traced_results:
+                results.append(result)
+                trace.events.extend(events)
+    pieces, sketches = [], {}
+    for df, counts, piece_sketches in results:
+        pieces.append(df)
+        sl.sample_counts.update(counts)
+        if sketch:
+            sk.merge_sketches(sketches, piece_sketches)
+    return (pieces, sketches) if sketch else pieces
+
+
+def summarise_piece(
+    filepath, filters=None, batch_size=None, use_cache=True, refresh=False
+):
+    """Returns user summary of piece and its counts before user selection.
+
+    Summaries don't depend on selector thresholds and are cached, so that
+    threshold grids can be evaluated without aggregating pieces again.
+    """
+    if use_cache:
+        key = cache.make_key(piece_cache_key(filepath, filters), "user_summary")
+        cached = None if refresh else cache.load(key)
+        if cached is not None:
+            print("Reading user summary of", filepath, "from cache")
+            users, counts = cached
+            return users.set_index("user_id"), collections.Counter(counts)
+
+    _, users, counts = sl.summarise(aggregate_piece(filepath, filters, batch_size))
+    if use_cache:
+        cache.store(key, users.reset_index(), counts)
+    return users, collections.Counter(counts)
 
 
 @hh.timer(on=TIMER_ON)
-def transform_variables(df):
-    return functools.reduce(lambda df, f: f(df), tf.transformers, df)
+def selection_grid(
+    filepaths,
+    grid,
+    filters=None,
+    batch_size=None,
+    workers=1,
+    use_cache=True,
+    refresh=False,
+):
+    """Returns selection table of pieces for each combination of thresholds.
+
+    Args:
+    filepaths: Paths of pieces, whose users are selected together.
+    grid: Dict mapping '{selector}.{argument}' to a list of thresholds, see
+      `sl.grid_params`.
+
+    Returns:
+      A DataFrame as returned by `sl.selection_grid`, with the counts of the
+      raw sample and after row selection included for each combination.
+    """
+    summarise = functools.partial(
+        summarise_piece,
+        filters=filters,
+        batch_size=batch_size,
+        use_cache=use_cache,
+        refresh=refresh,
+    )
+    if workers <= 1:
+        results = [summarise(fp) for fp in filepaths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(summarise, filepaths))
+    users = pd.concat([users for users, _ in results])
+    counts = collections.Counter()
+    for _, piece_counts in results:
+        # Update rather than add so that steps counting zero are kept
+        counts.update(piece_counts)
+    return sl.selection_grid(users, grid, counts)
+
+
+def parse_grid(specs):
+    """Returns threshold grid from specs like 'selector.argument=1,2,3'."""
+    grid = {}
+    for spec in specs:
+        key, _, values = spec.partition("=")
+        grid[key] = [json.loads(value) for value in values.split(",")]
+    return grid
+
+
+def write_selection_grid(table):
+    """Writes final sample counts of each combination in a selection grid."""
+    final = table[table.step.eq(sl.FINAL_SAMPLE)].drop(columns="step")
+    grid_table = hd.make_selection_grid_table(final)
+    table_path = os.path.join(config.TABDIR, "sample_selection_grid.tex")
+    hd.write_selection_table(grid_table, table_path)
+    with pd.option_context("max_colwidth", 25):
+        print(grid_table)
+
+
+@hh.timer(on=TIMER_ON)
+def transform_variables(df, sketches=None):
+    return functools.reduce(
+        lambda df, f: trace.call(f, df, sketches, cat="transformers"),
+        tf.transformers,
+        df,
+    )
 
 
 @hh.timer(on=TIMER_ON)
 def validate_data(df):
-    return functools.reduce(lambda df, f: f(df), vl.validators, df)
+    return functools.reduce(
+        lambda df, f: trace.call(f, df, cat="validators"), vl.validators, df
+    )
 
 
 def get_filepath(piece):
@@ -78,23 +455,116 @@ def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--piece", help="Piece in [0,9] to process")
     parser.add_argument("-l", "--label", help="Label to add to filename")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to clean pieces in parallel",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="Neither read cleaned pieces from nor write them to the cache",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Clean all pieces anew and overwrite their cached versions",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        help="Aggregate pieces in batches of about this many txns",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of pieces read ahead while a piece is aggregated, 0 to disable",
+    )
+    parser.add_argument(
+        "--prefetch-mb",
+        type=float,
+        metavar="MB",
+        help="Maximum memory of pieces read ahead",
+    )
+    parser.add_argument("--start", help="Drop txns before this date")
+    parser.add_argument("--end", help="Drop txns after this date")
+    parser.add_argument(
+        "--users", nargs="+", type=int, help="Only process txns of these users"
+    )
+    parser.add_argument(
+        "--winsorise-sketch",
+        action="store_true",
+        help="Estimate winsorisation cut-offs from quantile sketches of pieces",
+    )
+    parser.add_argument(
+        "--grid",
+        nargs="+",
+        metavar="SELECTOR.ARG=VALUES",
+        help=(
+            "Only write selection table for all combinations of thresholds, "
+            "like min_number_of_months.min_months=3,6,12"
+        ),
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Write Chrome trace of pipeline stages to PATH",
+    )
+    parser.add_argument(
+        "--trace-top",
+        type=int,
+        default=20,
+        metavar="N",
+        help="Number of stages with most self time printed with --trace",
+    )
     return parser.parse_args(args)
 
 
 @hh.timer(on=TIMER_ON)
-def main(argv=None):
-    if argv is None:
-        argv = sys.argv[1:]
-    args = parse_args(argv)
-
+def run(args):
+    """Produces analysis dataset as specified by command line args."""
     # Use supplied test piece or all pieces and name datafile accordingly
     pieces = args.piece if args.piece else range(10)
     pieces_paths = [get_filepath(piece) for piece in pieces]
 
+    if args.grid:
+        table = selection_grid(
+            pieces_paths,
+            parse_grid(args.grid),
+            filters=make_filters(args.start, args.end, args.users),
+            batch_size=args.batch_size,
+            workers=args.workers,
+            use_cache=args.use_cache,
+            refresh=args.refresh,
+        )
+        write_selection_grid(table)
+        return
+
+    pieces_data = clean_pieces(
+        pieces_paths,
+        filters=make_filters(args.start, args.end, args.users),
+        batch_size=args.batch_size,
+        workers=args.workers,
+        use_cache=args.use_cache,
+        refresh=args.refresh,
+        prefetch=args.prefetch,
+        prefetch_mb=args.prefetch_mb,
+        sketch=args.winsorise_sketch,
+    )
+    sketches = None
+    if args.winsorise_sketch:
+        pieces_data, sketches = pieces_data
+
     data = (
-        pd.concat(clean_piece(path) for path in pieces_paths)
+        pd.concat(pieces_data)
         .reset_index(drop=True)
-        .pipe(transform_variables)
+        .pipe(transform_variables, sketches)
         .pipe(write_data, args.piece, args.label, debug=True)
         .pipe(validate_data)
         .pipe(write_data, args.piece, args.label)
@@ -108,5 +578,17 @@ def main(argv=None):
         print(selection_table)
 
 
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    trace.enable(args.trace is not None)
+    try:
+        run(args)
+    finally:
+        if args.trace:
+            trace.report(args.trace, args.trace_top)
+
+
 if __name__ == "__main__":
     main()
@@ -1,60 +1,272 @@
 """
 Functions to select users for analysis data.
 
+Selection is evaluated on a user summary table rather than on the user-month
+data itself. Row selectors first drop user-months, then a summary with one
+row per user is computed in a single groupby over the remaining user-months.
+Each user selector returns a condition on that summary, and the cumulative
+user masks after each selector yield the selection table counts. User-month
+data is filtered only once, at the end.
+
+To add a user selector, decorate a function of the user summary with
+`selector`, passing the named aggregations of user-month columns it needs.
+The first line of its docstring is used as description in the selection
+table.
+
 """
 
 import collections
-import functools
 import itertools
 
 import numpy as np
+import pandas as pd
 
 import src.config as cf
-import src.helpers.helpers as hh
+import src.helpers.trace as trace
 
 
+row_selectors = []
 selectors = []
 sample_counts = collections.Counter()
 
+RAW_SAMPLE = "Raw sample"
+FINAL_SAMPLE = "Final sample"
+
+# Summary columns used for selection table counts
+COUNTS = {
+    "user_months": ("ym", "size"),
+    "txns": ("txns_count", "sum"),
+    "txns_volume": ("txns_volume", "sum"),
+}
+
 
-def selector(func):
-    selectors.append(func)
+def row_selector(func):
+    """Registers func, which returns a Boolean series of user-months to keep."""
+    row_selectors.append(func)
     return func
 
 
-def counter(func):
-    """Count sample after applying function and update selection table.
+def selector(**summary):
+    """Registers function of user summary returning a Boolean series of users.
 
-    First line of func docstring is used for description in selection table.
+    Args:
+    summary: Named aggregations of user-month columns, like
+      min_spend=("month_spend", "min"), that the function requires in the
+      user summary in addition to `COUNTS`.
     """
 
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        df = func(*args, **kwargs)
-        description = func.__doc__.splitlines()[0]
-        sample_counts.update(
-            {
-                description + "@users": df.user_id.nunique(),
-                description + "@user_months": len(df),
-                description + "@txns": df.txns_count.sum(),
-                description + "@txns_volume": df.txns_volume.sum() / 1e6,
-            }
-        )
-        return df
+    def register(func):
+        func.summary = summary
+        selectors.append(func)
+        return func
+
+    return register
+
+
+def description(func):
+    """Returns first line of func docstring."""
+    return func.__doc__.splitlines()[0]
+
+
+def _counts(description, users, user_months, txns, txns_volume):
+    return {
+        description + "@users": users,
+        description + "@user_months": user_months,
+        description + "@txns": txns,
+        description + "@txns_volume": txns_volume / 1e6,
+    }
+
+
+def row_counts(description, df, rows=None):
+    """Returns selection table counts of user-months of df selected by rows."""
+    if rows is not None:
+        df = df[["user_id", "txns_count", "txns_volume"]][rows]
+    return _counts(
+        description,
+        df.user_id.nunique(),
+        len(df),
+        df.txns_count.sum(),
+        df.txns_volume.sum(),
+    )
+
+
+def user_counts(description, users, mask):
+    """Returns selection table counts of users of user summary selected by mask."""
+    selected = users[mask]
+    return _counts(
+        description,
+        len(selected),
+        selected.user_months.sum(),
+        selected.txns.sum(),
+        selected.txns_volume.sum(),
+    )
+
+
+def row_mask(df):
+    """Returns mask of user-months kept by all row selectors and their counts."""
+    rows = np.ones(len(df), dtype=bool)
+    counts = {}
+    for func in row_selectors:
+        rows &= func(df).to_numpy()
+        counts.update(row_counts(description(func), df, rows))
+    return rows, counts
+
+
+@trace.traced(cat="selectors")
+def user_summary(df, rows=None):
+    """Returns table with one row per user of columns required by selectors.
+
+    Args:
+    df: User-month data.
+    rows: Boolean array of user-months to summarise, or None for all.
+    """
+    summary = dict(COUNTS)
+    for func in selectors:
+        summary.update(func.summary)
+    columns = {"user_id"}.union(column for column, _ in summary.values())
+    data = df[[c for c in df.columns if c in columns]]
+    if rows is not None:
+        data = data[rows]
+    # Per-user volumes are summed again for counts, so keep them precise
+    data = data.astype({"txns_volume": "float64"})
+    return data.groupby("user_id").agg(**summary)
+
+
+def user_masks(users, params=None):
+    """Returns cumulative user masks after applying each selector.
+
+    Args:
+    users: User summary as returned by `user_summary`.
+    params: Dict mapping selector names to dicts of keyword arguments used
+      instead of the selector's defaults, like {"min_number_of_months":
+      {"min_months": 12}}.
+
+    Returns:
+      A list of (selector, Boolean array) tuples.
+    """
+    params = params or {}
+    mask = np.ones(len(users), dtype=bool)
+    masks = []
+    for func in selectors:
+        condition = func(users, **params.get(func.__name__, {}))
+        mask = mask & condition.to_numpy(dtype=bool)
+        masks.append((func, mask))
+    return masks
+
+
+def summarise(df):
+    """Returns user summary and selection counts that don't depend on selectors.
+
+    Returns:
+      A tuple (rows, users, counts) with the mask of user-months kept by row
+      selectors, the user summary of those user-months, and the counts of
+      the raw sample and after each row selector.
+    """
+    counts = row_counts(RAW_SAMPLE, df)
+    rows, step_counts = row_mask(df)
+    counts.update(step_counts)
+    return rows, user_summary(df, rows), counts
 
-    return wrapper
 
+def select_sample(df, params=None):
+    """Returns user-months of selected users.
 
-@selector
-@counter
-def add_raw_count(df):
-    """Raw sample
-    Add count of raw dataset to selection table."""
-    return df
+    Counts after each selection step are added to `sample_counts`.
+    """
+    rows, users, counts = summarise(df)
+    mask = np.ones(len(users), dtype=bool)
+    for func, mask in user_masks(users, params):
+        counts.update(user_counts(description(func), users, mask))
+    counts.update(user_counts(FINAL_SAMPLE, users, mask))
+    sample_counts.update(counts)
+    rows &= df.user_id.isin(users.index[mask]).to_numpy()
+    return df[rows]
+
+
+def grid_params(grid):
+    """Yields all combinations of thresholds in grid.
+
+    Args:
+    grid: Dict mapping '{selector}.{argument}' to a list of values, like
+      {"min_number_of_months.min_months": [3, 6, 12]}.
+
+    Yields:
+      Tuples of a dict mapping grid keys to values and the corresponding
+      params for `user_masks`.
+    """
+    names = {func.__name__ for func in selectors}
+    for key in grid:
+        name, _, arg = key.partition(".")
+        if name not in names or not arg:
+            raise ValueError(f"Grid key {key!r} is not '{{selector}}.{{argument}}'")
+    for values in itertools.product(*grid.values()):
+        thresholds = dict(zip(grid, values))
+        params = collections.defaultdict(dict)
+        for key, value in thresholds.items():
+            name, _, arg = key.partition(".")
+            params[name][arg] = value
+        yield thresholds, dict(params)
+
+
+def selection_grid(users, grid, counts=None):
+    """Returns selection table for each combination of thresholds in grid.
+
+    Each selector's condition is evaluated once per combination of its own
+    thresholds, so the cost of a combination is that of combining masks and
+    counting selected users.
+
+    Args:
+    users: User summary as returned by `user_summary`.
+    grid: Dict of thresholds as described in `grid_params`.
+    counts: Selection table counts of steps before user selection, as
+      returned by `summarise`, included for each combination.
+
+    Returns:
+      A DataFrame with a column for each grid key, a step column, and the
+      selection table counts after each user selector and for the final
+      sample, with one row per combination and step.
+    """
+    conditions = {}
+    totals = np.column_stack(
+        [
+            np.ones(len(users)),
+            users.user_months.to_numpy(dtype="float64"),
+            users.txns.to_numpy(dtype="float64"),
+            users.txns_volume.to_numpy(dtype="float64") / 1e6,
+        ]
+    )
+    steps = [description(func) for func in selectors] + [FINAL_SAMPLE]
+    fixed = collections.defaultdict(dict)
+    for key, value in (counts or {}).items():
+        step, metric = key.split("@")
+        fixed[step][metric] = value
+    fixed = pd.DataFrame.from_dict(fixed, orient="index").rename_axis("step")
+    tables = []
+    for thresholds, params in grid_params(grid):
+        mask = np.ones(len(users), dtype=bool)
+        masks = []
+        for func in selectors:
+            kwargs = params.get(func.__name__, {})
+            key = func.__name__, tuple(sorted(kwargs.items()))
+            if key not in conditions:
+                conditions[key] = func(users, **kwargs).to_numpy(dtype=bool)
+            mask = mask & conditions[key]
+            masks.append(mask)
+        masks.append(mask)
+        counts = np.array(masks, dtype="float64") @ totals
+        table = pd.DataFrame(
+            counts, columns=["users", "user_months", "txns", "txns_volume"]
+        )
+        table.insert(0, "step", steps)
+        table = pd.concat([fixed.reset_index(), table], ignore_index=True)
+        tables.append(table.assign(**thresholds))
+    table = pd.concat(tables, ignore_index=True)
+    int_cols = ["users", "user_months", "txns"]
+    table[int_cols] = table[int_cols].round().astype("int64")
+    return table[[*grid, "step", "users", "user_months", "txns", "txns_volume"]]
 
 
-@selector
-@counter
+@row_selector
 def drop_first_and_last_month(df):
     """Drop first and last month
 
@@ -63,114 +275,76 @@ def drop_first_and_last_month(df):
     g = df.groupby("user_id")
     ym_max = g.ym.transform("max")
     ym_min = g.ym.transform("min")
-    cond = df.ym.between(ym_min, ym_max, inclusive="neither")
-    return df[cond]
+    return df.ym.between(ym_min, ym_max, inclusive="neither")
 
 
-@selector
-@counter
-def min_number_of_months(df, min_months=6):
+@selector()
+def min_number_of_months(users, min_months=6):
     """At least 6 months of data"""
-    cond = df.groupby("user_id").size() >= min_months
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.user_months >= min_months
 
 
-@selector
-@counter
-def has_savings_account(df):
+@selector(has_savings_account=("has_savings_account", "max"))
+def has_savings_account(users):
     """At least one savings account"""
-    cond = df.has_savings_account.groupby(df.user_id).max().eq(1)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.has_savings_account.eq(1)
 
 
-@selector
-@counter
-def has_current_account(df):
+@selector(has_current_account=("has_current_account", "max"))
+def has_current_account(users):
     """At least one current account"""
-    cond = df.has_current_account.groupby(df.user_id).max().eq(1)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.has_current_account.eq(1)
 
 
-@selector
-@counter
-def year_income(df, min_year_income=cf.MIN_YEAR_INCOME):
+@selector(min_month_income_mean=("month_income_mean", "min"))
+def year_income(users, min_year_income=cf.MIN_YEAR_INCOME):
     """At least \pounds5,000 of annual income"""
     min_month_income = round(min_year_income / 12, 2)
-    cond = df.groupby("user_id").month_income_mean.min().ge(min_month_income)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.min_month_income_mean.ge(min_month_income)
 
 
-@selector
-@counter
-def month_min_spend_txns(df, min_txns=cf.MIN_MONTH_SPEND_TXNS):
+@selector(min_txns_count_spend=("txns_count_spend", "min"))
+def month_min_spend_txns(users, min_txns=cf.MIN_MONTH_SPEND_TXNS):
     """At least 10 spend txns each month"""
-    cond = df.groupby("user_id").txns_count_spend.min().ge(min_txns)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.min_txns_count_spend.ge(min_txns)
 
 
-@selector
-@counter
-def month_min_grocery_txns(df, min_txns=cf.MIN_MONTH_GROCERY_TXNS):
+@selector(min_ct_tag_spend_groceries=("ct_tag_spend_groceries", "min"))
+def month_min_grocery_txns(users, min_txns=cf.MIN_MONTH_GROCERY_TXNS):
     """At least 4 grocery txns each month"""
-    cond = df.groupby("user_id").ct_tag_spend_groceries.min().ge(min_txns)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.min_ct_tag_spend_groceries.ge(min_txns)
 
 
-@selector
-@counter
-def month_min_spend(df, min_spend=cf.MIN_MONTH_SPEND):
+@selector(min_month_spend=("month_spend", "min"))
+def month_min_spend(users, min_spend=cf.MIN_MONTH_SPEND):
     """At least \pounds200 of monthly spend"""
-    cond = df.groupby("user_id").month_spend.min().ge(min_spend)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.min_month_spend.ge(min_spend)
+
+
+DEMOGRAPHIC_COLS = ["age", "is_female", "is_urban"]
 
 
-@selector
-@counter
-def complete_demographic_info(df):
+@selector(**{f"{col}_count": (col, "count") for col in DEMOGRAPHIC_COLS})
+def complete_demographic_info(users):
     """Complete demographic information
 
     Retains only users for which we have full demographic information.
     """
-    cols = ["age", "is_female", "is_urban"]
-    cond = df[cols].isna().groupby(df.user_id).sum().sum(1).eq(0)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    cols = [f"{col}_count" for col in DEMOGRAPHIC_COLS]
+    return users[cols].eq(users.user_months, axis=0).all(axis=1)
 
 
-# @selector
-# @counter
-def drop_testers(df):
+# @selector(user_reg_ym=("user_reg_ym", "first"))
+def drop_testers(users):
     """Drop test users
 
     App was launched sometime in 2011, so to ensure we only have users that
     were not testers, we drop all users registering before 2012.
     """
-    cond = df.groupby("user_id").user_reg_ym.first().ge("2012-01")
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.user_reg_ym.ge("2012-01")
 
 
-@selector
-@counter
-def working_age(df):
+@selector(age=("age", "first"))
+def working_age(users):
     """Working age"""
-    cond = df.groupby("user_id").age.first().between(18, 65, inclusive="both")
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
-
-
-@selector
-@counter
-def add_final_count(df):
-    """Final sample
-    Add count of final dataset to selection table."""
-    return df
-
-
+    return users.age.between(18, 65, inclusive="both")
@@ -3,56 +3,90 @@ Functions to transform variables.
 
 """
 
+import pandas as pd
+
 import src.config as config
 import src.helpers.data as hd
+import src.helpers.sketch as sk
 
 
 transformers = []
 
+WINSORISE_UPPER_COLS = [
+    "inflows",
+    "outflows",
+    "pos_netflows",
+    "inflows_norm",
+    "outflows_norm",
+    "txns_count",
+    "txns_volume",
+    "month_spend",
+    "month_income",
+    "dspend",
+    "dspend_mean",
+    "dspend_count",
+    "dspend_clothes",
+    "dspend_entertainment",
+    "dspend_food",
+    "dspend_groceries",
+    "dspend_other",
+    "dspend_dd",
+    "investments",
+    "up_savings",
+    "ca_transfers",
+    "cc_payments",
+    "loan_funds",
+    "loan_rpmts",
+]
+
+WINSORISE_BOTH_COLS = [
+    "netflows",
+    "netflows_norm",
+]
+
 
 def transformer(func):
-    """Add func to list of transformer functions."""
+    """Add func to list of transformer functions.
+
+    Transformers are called with the data and a dict of quantile sketches of
+    winsorised columns of all pieces, see `sketch_piece`, or None.
+    """
     transformers.append(func)
     return func
 
 
+def sketch_piece(df):
+    """Returns dict of quantile sketches of winsorised columns of piece.
+
+    Pieces lack `dspend_*` columns of groups without spend in the piece, so
+    only columns present are sketched, see `sk.merge_sketches`.
+    """
+    cols = df.columns.intersection(WINSORISE_UPPER_COLS + WINSORISE_BOTH_COLS)
+    return sk.sketch_columns(df[cols])
+
+
+def winsorisation_cutoffs(df, cols, pct, sketches=None):
+    """Returns cut-offs for cols of df from sketches or, if None, the data."""
+    if sketches is None:
+        return hd.winsorisation_cutoffs(df[cols], pct)
+    q = [pct / 100, 1 - pct / 100]
+    cutoffs = {col: sketches[col].quantile(q) for col in cols}
+    return pd.DataFrame(cutoffs, index=["lower", "upper"])
+
+
 @transformer
-def winsorise_upper(df):
-    cols = [
-        "inflows",
-        "outflows",
-        "pos_netflows",
-        "inflows_norm",
-        "outflows_norm",
-        "txns_count",
-        "txns_volume",
-        "month_spend",
-        "month_income",
-        "dspend",
-        "dspend_mean",
-        "dspend_count",
-        "dspend_clothes",
-        "dspend_entertainment",
-        "dspend_food",
-        "dspend_groceries",
-        "dspend_other",
-        "dspend_dd",
-        "investments",
-        "up_savings",
-        "ca_transfers",
-        "cc_payments",
-        "loan_funds",
-        "loan_rpmts",
-    ]
-    df[cols] = df[cols].apply(hd.winsorise, pct=config.WIN_PCT, how="upper")
+def winsorise_upper(df, sketches=None):
+    cols = WINSORISE_UPPER_COLS
+    pct = config.WIN_PCT
+    cutoffs = winsorisation_cutoffs(df, cols, pct, sketches)
+    df[cols] = hd.winsorise_frame(df[cols], pct, "upper", cutoffs)
     return df
 
 
 @transformer
-def winsorise_both(df):
-    cols = [
-        "netflows",
-        "netflows_norm",
-    ]
-    df[cols] = df[cols].apply(hd.winsorise, pct=config.WIN_PCT / 2, how="both")
+def winsorise_both(df, sketches=None):
+    cols = WINSORISE_BOTH_COLS
+    pct = config.WIN_PCT / 2
+    cutoffs = winsorisation_cutoffs(df, cols, pct, sketches)
+    df[cols] = hd.winsorise_frame(df[cols], pct, "both", cutoffs)
     return df
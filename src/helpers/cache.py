@@ -0,0 +1,86 @@
+"""
+Local disk cache for intermediate dataframes.
+
+Entries are stored as a parquet file and a json file with metadata, both
+named after a key that hashes everything the cached result depends on.
+When the cache grows beyond its size limit, the least recently used
+entries are removed.
+
+"""
+
+import hashlib
+import json
+import os
+
+from src import config
+import src.helpers.helpers as hh
+import src.helpers.trace as trace
+
+
+pd = hh.lazy_import("pandas")
+
+
+def make_key(*parts):
+    """Returns hash of json-serialisable parts."""
+    content = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _entry_paths(key, cachedir):
+    data = os.path.join(cachedir, f"{key}.parquet")
+    meta = os.path.join(cachedir, f"{key}.json")
+    return data, meta
+
+
+def contains(key, cachedir=config.CACHEDIR):
+    """Returns True if key is cached."""
+    return all(os.path.exists(path) for path in _entry_paths(key, cachedir))
+
+
+@trace.traced(cat="io")
+def load(key, cachedir=config.CACHEDIR):
+    """Returns (data, metadata) tuple for key or None if key isn't cached."""
+    data_path, meta_path = _entry_paths(key, cachedir)
+    try:
+        data = pd.read_parquet(data_path)
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    for path in (data_path, meta_path):
+        os.utime(path)
+    return data, meta
+
+
+@trace.traced(cat="io")
+def store(key, data, meta, cachedir=config.CACHEDIR, max_gb=config.CACHE_MAX_GB):
+    """Adds data and metadata to cache and evicts entries beyond max_gb."""
+    os.makedirs(cachedir, exist_ok=True)
+    data_path, meta_path = _entry_paths(key, cachedir)
+    data.to_parquet(data_path, index=False)
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, default=lambda x: x.item())
+    evict(cachedir, max_gb * 1e9)
+
+
+def evict(cachedir, max_bytes):
+    """Removes least recently used entries until cache is below max_bytes."""
+    entries = {}
+    for entry in os.scandir(cachedir):
+        key, ext = os.path.splitext(entry.name)
+        if ext not in (".parquet", ".json"):
+            continue
+        stat = entry.stat()
+        size, used = entries.get(key, (0, 0))
+        entries[key] = (size + stat.st_size, max(used, stat.st_mtime))
+
+    total = sum(size for size, _ in entries.values())
+    for key, (size, _) in sorted(entries.items(), key=lambda x: x[1][1]):
+        if total <= max_bytes:
+            break
+        for path in _entry_paths(key, cachedir):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
@@ -1,14 +1,14 @@
 import os
 
-import numpy as np
-import pandas as pd
-
-from IPython.display import display
 from src import config
 import src.helpers.io as io
 import src.helpers.helpers as hh
 
 
+np = hh.lazy_import("numpy")
+pd = hh.lazy_import("pandas")
+
+
 def order_columns(df, first=None, others_alpha=False):
     if first is None:
         order = sorted(df.columns)
@@ -30,36 +30,157 @@ def txns_and_users(df1, df2):
 
 
 def inspect(df, nrows=2):
+    from IPython.display import display
+
     print("shape: ({:,}, {}), users: {}".format(*df.shape, df.user_id.nunique()))
     display(df.head(nrows))
 
 
+# Partition columns of clean pieces written with `clean.py --partitioned`
+PARTITION_COLS = ["user_bucket", "year"]
+
+# Partition filters on year implied by filters on date
+_YEAR_OPS = {"==": "==", ">": ">=", ">=": ">=", "<": "<=", "<=": "<="}
+
+
+def user_bucket(user_id, buckets=config.USER_BUCKETS):
+    """Returns partition bucket of user ids."""
+    return user_id % buckets
+
+
+def partition_filters(filters, buckets=config.USER_BUCKETS):
+    """Returns filters with partition filters implied by user_id and date filters.
+
+    Filters use the same format as in `io.read_parquet`. The added filters on
+    partition columns let readers skip partitions that can't contain rows
+    matching filters.
+    """
+    if not filters:
+        return filters
+    implied = []
+    for column, op, value in filters:
+        if column == "user_id" and op == "==":
+            implied.append(("user_bucket", "==", user_bucket(value, buckets)))
+        elif column == "user_id" and op == "in":
+            values = sorted({user_bucket(v, buckets) for v in value})
+            implied.append(("user_bucket", "in", values))
+        elif column == "date" and op in _YEAR_OPS:
+            implied.append(("year", _YEAR_OPS[op], pd.Timestamp(value).year))
+    return list(filters) + implied
+
+
+def partition_buckets(fp):
+    """Returns user buckets of partitioned clean piece at fp."""
+    paths = io.glob(os.path.join(fp, "user_bucket=*"))
+    return sorted(int(path.rsplit("=", 1)[1]) for path in paths)
+
+
+def read_clean_piece(fp, filters=None, **kwargs):
+    """Reads clean piece at fp, which might be partitioned.
+
+    Partitioned pieces are read with partition filters implied by filters
+    (see `partition_filters`) and returned without partition columns and in
+    the order of unpartitioned pieces, so that both read the same.
+    """
+    if not io.is_dir(fp):
+        return io.read_parquet(fp, filters=filters, **kwargs)
+    df = io.read_parquet(fp, filters=partition_filters(filters), **kwargs)
+    for col in PARTITION_COLS:
+        if col in df:
+            del df[col]
+    sort_cols = [col for col in ["user_id", "date"] if col in df]
+    if sort_cols:
+        df = df.sort_values(sort_cols, kind="stable", ignore_index=True)
+    return df
+
+
+def concat_categoricals(frames):
+    """Concatenates frames, keeping categorical columns categorical.
+
+    `pd.concat` turns categorical columns into object columns unless all
+    frames have the same categories, so categories are unified first, in
+    order of appearance.
+    """
+    frames = list(frames)
+    if len(frames) == 1:
+        return frames[0]
+    # Shallow copies let us replace columns without changing the inputs
+    frames = [df.copy(deep=False) for df in frames]
+    dtypes = frames[0].dtypes
+    for col in dtypes.index[dtypes == "category"]:
+        empty = [pd.Categorical([], df[col].cat.categories) for df in frames]
+        categories = pd.api.types.union_categoricals(empty).categories
+        for df in frames:
+            df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_many(fps, read, workers=config.IO_THREADS, **kwargs):
+    """Returns concatenated data read from fps with read(fp, **kwargs).
+
+    Files are downloaded and decoded concurrently in a pool of at most
+    workers threads, and the throughput in MB of data read per second is
+    printed.
+    """
+    import concurrent.futures
+    import time
+
+    if len(fps) == 1:
+        return read(fps[0], **kwargs)
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(min(workers, len(fps))) as executor:
+        frames = list(executor.map(lambda fp: read(fp, **kwargs), fps))
+    seconds = time.time() - start
+    mb = sum(frame.memory_usage(deep=False).sum() for frame in frames) / 2**20
+    print(
+        f"Read {len(fps)} files ({mb:,.1f}MB) in {seconds:.2f} seconds "
+        f"({mb / seconds:,.1f}MB/s)."
+    )
+    return concat_categoricals(frames)
+
+
+def _as_list(sample):
+    return [sample] if sample is None or isinstance(sample, str) else list(sample)
+
+
 @hh.timer
 def read_raw_data(sample="XX7", **kwargs):
     """Read MDB raw data.
 
     Args:
-    sample: Data sample to read, one of {'777', 'X77', 'XX7'}.
+    sample: Data sample to read, one of {'777', 'X77', 'XX7'}, or a list of
+      samples, which are read concurrently and concatenated.
 
     Returns:
     Dataframe with sample raw data.
     """
-    fp = f"s3://3di-data-mdb/raw/mdb_{sample}.parquet"
-    return io.read_parquet(fp, **kwargs)
+    fps = [f"s3://3di-data-mdb/raw/mdb_{s}.parquet" for s in _as_list(sample)]
+    return read_many(fps, io.read_parquet, **kwargs)
 
 
 @hh.timer
 def read_txn_data(sample="XX1", **kwargs):
-    fp = f"s3://3di-data-mdb/clean/samples/mdb_{sample}.parquet"
-    return io.read_parquet(fp, **kwargs)
+    """Reads clean txn data of sample or list of samples, see `read_raw_data`."""
+    fps = [f"s3://3di-data-mdb/clean/samples/mdb_{s}.parquet" for s in _as_list(sample)]
+    return read_many(fps, read_clean_piece, **kwargs)
+
+
+@hh.timer
+def read_clean_pieces(pieces=range(10), **kwargs):
+    """Reads and concatenates clean pieces, like all ten 'mdb_XX{n}' pieces."""
+    fps = [os.path.join(config.AWS_PIECES, f"mdb_XX{n}.parquet") for n in pieces]
+    return read_many(fps, read_clean_piece, **kwargs)
 
 
 @hh.timer
 def read_analysis_data(sample=None, **kwargs):
+    """Reads analysis data of sample or list of samples, see `read_raw_data`."""
     path = "s3://3di-project-entropy"
-    fn = f"entropy_{sample}.parquet" if sample else "entropy.parquet"
-    fp = os.path.join(path, fn)
-    return io.read_parquet(fp, **kwargs)
+    fps = []
+    for s in _as_list(sample):
+        fn = f"entropy_{s}.parquet" if s else "entropy.parquet"
+        fps.append(os.path.join(path, fn))
+    return read_many(fps, io.read_parquet, **kwargs)
 
 
 @hh.timer
@@ -101,6 +222,69 @@ def winsorise(series, pct=1, how="both"):
     return series.clip(**kwargs)
 
 
+def nanpercentiles(values, q):
+    """Returns percentiles q of each column of values, ignoring missing values.
+
+    Matches `np.nanpercentile(values, q, axis=0)` with linear interpolation,
+    but sorts all columns in a single operation instead of one at a time.
+
+    Args:
+    values: A 2-D array.
+    q: A sequence of percentiles in [0, 100].
+
+    Returns:
+      An array with a row for each percentile and a column for each column
+      of values.
+    """
+    if not len(values):
+        return np.full((len(q), values.shape[1]), np.nan)
+    values = np.sort(values, axis=0)
+    counts = np.count_nonzero(~np.isnan(values), axis=0)
+    last = np.maximum(counts - 1, 0)
+    virtual = (counts - 1) * (np.asarray(q, dtype="float64")[:, None] / 100)
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    previous = np.minimum(np.maximum(previous, 0).astype("int64"), last)
+    a = np.take_along_axis(values, previous, axis=0)
+    b = np.take_along_axis(values, np.minimum(previous + 1, last), axis=0)
+    # Interpolate as np.lib.function_base._lerp to reproduce its results
+    diff = b - a
+    with np.errstate(invalid="ignore"):
+        result = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+    return np.where(counts > 0, result, np.nan)
+
+
+def winsorisation_cutoffs(df, pct=1):
+    """Returns lower and upper percentile of each column of df.
+
+    Columns of the same dtype are processed together, see `nanpercentiles`.
+
+    Returns:
+      A DataFrame with rows 'lower' and 'upper' and the columns of df.
+    """
+    cutoffs = pd.DataFrame(np.nan, index=["lower", "upper"], columns=df.columns)
+    for cols in df.columns.groupby(df.dtypes).values():
+        cutoffs[cols] = nanpercentiles(df[cols].to_numpy(), [pct, 100 - pct])
+    return cutoffs
+
+
+def winsorise_frame(df, pct=1, how="both", cutoffs=None):
+    """Returns df with values of each column clipped at its percentiles.
+
+    Args:
+    df: A DataFrame of numeric columns.
+    pct, how: As in `winsorise`.
+    cutoffs: A DataFrame as returned by `winsorisation_cutoffs` with cut-offs
+      to use instead of the percentiles of df, like those estimated from
+      quantile sketches.
+    """
+    if cutoffs is None:
+        cutoffs = winsorisation_cutoffs(df, pct)
+    lower = cutoffs.loc["lower", df.columns] if how in ("both", "lower") else None
+    upper = cutoffs.loc["upper", df.columns] if how in ("both", "upper") else None
+    return df.clip(lower=lower, upper=upper, axis=1)
+
+
 def breakdown(df, group_var, group_var_value, component_var, metric="value", net=False):
     """Calculates sorted breakdown of group_var_value by component_var.
 
@@ -167,9 +351,33 @@ def make_selection_table(dict):
     return df
 
 
+def make_selection_grid_table(df):
+    """Create table of final sample for each combination of thresholds.
+
+    Args:
+    df: A DataFrame with a column for each threshold and the count columns of
+      a selection table, as returned by `sl.selection_grid`.
+    """
+    count_cols = ["users", "user_months", "txns", "txns_volume"]
+    threshold_cols = [c for c in df.columns if c not in count_cols]
+    df = df[threshold_cols + count_cols].copy()
+    df[count_cols] = df[count_cols].applymap("{:,.0f}".format)
+    df.columns = [
+        *(c.replace("_", "\\_") for c in threshold_cols),
+        "Users",
+        "User-months",
+        "Txns",
+        r"Txns (m\pounds)",
+    ]
+    return df
+
+
 def write_selection_table(table, filepath):
     """Export sample selection table in Latex format."""
-    latex_table = table.to_latex(index=False, escape=False, column_format="lrrrr")
+    column_format = "l" + "r" * (len(table.columns) - 1)
+    latex_table = table.to_latex(
+        index=False, escape=False, column_format=column_format
+    )
     with pd.option_context("max_colwidth", None):
         with open(filepath, "w") as f:
             f.write(latex_table)
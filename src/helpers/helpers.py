@@ -1,13 +1,85 @@
 import time
+import collections
 import functools
+import importlib.util
+import re
+import sys
+import threading
+import types
 
+import src.helpers.trace as trace
+
+
+_lazy_lock = threading.RLock()
+_loading = set()
+
+
+class _LazyModule(types.ModuleType):
+    """Module that is executed on first attribute access, see `lazy_import`.
+
+    Execution holds a lock, so that threads accessing the module meanwhile
+    wait for it to finish rather than see a partially executed module.
+    """
+
+    def __getattribute__(self, attr):
+        with _lazy_lock:
+            # Accesses during execution come from the executing thread
+            if type(self) is _LazyModule and id(self) not in _loading:
+                _loading.add(id(self))
+                try:
+                    spec = types.ModuleType.__getattribute__(self, "__spec__")
+                    spec.loader.exec_module(self)
+                    self.__class__ = types.ModuleType
+                finally:
+                    _loading.discard(id(self))
+        return types.ModuleType.__getattribute__(self, attr)
+
+
+def lazy_import(name):
+    """Returns module name, deferring its execution to first attribute access.
+
+    Used for heavy dependencies so that they are only loaded when a function
+    that needs them is called, which keeps startup of the command line
+    programs fast. Modules can be first accessed from any thread.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    module = importlib.util.module_from_spec(spec)
+    module.__class__ = _LazyModule
+    sys.modules[name] = module
+    return module
+
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+def _module_name(func):
+    """Returns name of module defining func, also if run with `python -m`."""
+    name = func.__module__
+    if name == "__main__":
+        spec = getattr(sys.modules["__main__"], "__spec__", None)
+        name = spec.name if spec is not None else name
+    return name
+
+
+def timer(func=None, on=True, cat=None):
+    """Prints run time of func if on and records calls as spans, see `trace.py`.
+
+    Spans are categorised by cat, by default the last part of the name of
+    the module defining func. Functions called for each batch of a piece
+    should use on=False so that only their spans are recorded.
+    """
 
-def timer(func=None, on=True):
     def decorate(func):
+        span_cat = cat or _module_name(func).rsplit(".", 1)[-1]
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             start = time.time()
-            result = func(*args, **kwargs)
+            with trace.span(func.__name__, span_cat):
+                result = func(*args, **kwargs)
             end = time.time()
             if on:
                 diff = end - start
@@ -15,9 +87,137 @@ def timer(func=None, on=True):
                 if diff > 60:
                     diff /= 60
                     unit = "minutes"
-                    print(f"Time for {func.__name__:30}: {diff:.2f} {unit}")
+                print(f"Time for {func.__name__:30}: {diff:.2f} {unit}")
             return result
 
         return wrapper
 
     return decorate(func) if func else decorate
+
+
+class _Identity:
+    """Wraps an object to be hashed and compared by identity, like in `is`."""
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return self.obj is other.obj
+
+
+@functools.lru_cache(maxsize=4)
+def _category_matches(categories, pattern, how):
+    """Returns Boolean array indicating which of categories match pattern.
+
+    Categories are the categories index of a series wrapped in `_Identity`,
+    which is cheap to hash even for millions of categories and shared by
+    series of the same categorical dtype. Comparing dtypes would ignore the
+    order of categories, while results are positional.
+    """
+    categories = categories.obj
+    regex = re.compile(pattern)
+    method = getattr(regex, "search" if how == "contains" else how)
+    return np.fromiter(
+        (method(c) is not None for c in categories), dtype=bool, count=len(categories)
+    )
+
+
+def str_predicate(series, pattern, how="contains", na=False):
+    """Returns Boolean series indicating whether values of series match pattern.
+
+    Equivalent to `getattr(series.str, how)(pattern, na=na)`. For categorical
+    series, pattern is evaluated once per category rather than once per row
+    and results are broadcast to rows through the category codes. Results
+    per category are cached for repeated calls on series with the same
+    categories.
+
+    Args:
+    series: A series of strings.
+    pattern: A regular expression.
+    how: One of {'contains', 'match', 'fullmatch'}.
+    na: Value for missing values.
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return getattr(series.str, how)(pattern, na=na)
+    categories = _Identity(series.cat.categories)
+    matches = np.append(_category_matches(categories, pattern, how), na)
+    # missing values have code -1 and thus map to na
+    values = matches[series.cat.codes.to_numpy()]
+    return pd.Series(values, index=series.index, name=series.name)
+
+
+def _frame_mb(item):
+    if isinstance(item, pd.DataFrame):
+        return item.memory_usage(deep=True).sum() / 2**20
+    return 0
+
+
+def prefetch(items, depth=1, max_mb=None):
+    """Yields items of iterable, producing up to depth items ahead in a thread.
+
+    Used to overlap reading data with processing it: while the caller
+    processes one item, the next items are produced in the background.
+
+    Args:
+    items: An iterable, like a generator that reads a file per item.
+    depth: Maximum number of items produced ahead. With 0, items are
+      produced when requested.
+    max_mb: Memory cap in MB, or None. No further item is produced ahead
+      while dataframes produced ahead take up max_mb MB or more.
+    """
+    if depth < 1:
+        yield from items
+        return
+    queue = collections.deque()
+    ready = threading.Condition()
+    state = {"mb": 0, "done": False, "error": None, "closed": False}
+
+    def has_room():
+        if len(queue) >= depth:
+            return False
+        return max_mb is None or not queue or state["mb"] < max_mb
+
+    def produce():
+        try:
+            iterator = iter(items)
+            while True:
+                with ready:
+                    ready.wait_for(lambda: state["closed"] or has_room())
+                    if state["closed"]:
+                        return
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                mb = _frame_mb(item)
+                with ready:
+                    queue.append((item, mb))
+                    state["mb"] += mb
+                    ready.notify_all()
+        except BaseException as e:
+            state["error"] = e
+        finally:
+            with ready:
+                state["done"] = True
+                ready.notify_all()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            with ready:
+                ready.wait_for(lambda: queue or state["done"])
+                if not queue:
+                    break
+                item, mb = queue.popleft()
+                state["mb"] -= mb
+                ready.notify_all()
+            yield item
+        if state["error"] is not None:
+            raise state["error"]
+    finally:
+        with ready:
+            state["closed"] = True
+            ready.notify_all()
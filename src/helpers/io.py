@@ -1,46 +1,270 @@
+"""
+Reading and writing of files in local directories and AWS buckets.
+
+S3 filesystems are created once per AWS profile and process and then reused,
+so that connections and metadata caches are shared by all calls. If
+`config.S3_ROOT` is set, s3:// urls are served from that local directory
+instead, which lets the pipeline run offline.
+
+"""
+
 import argparse
+import contextlib
+import functools
+import glob as glob_
 import os
 import platform
-
-import pandas as pd
-import s3fs
+import shutil
 
 from src import config
+import src.helpers.helpers as hh
+import src.helpers.trace as trace
+
+
+pd = hh.lazy_import("pandas")
+
+
+@functools.lru_cache(maxsize=None)
+def _s3(aws_profile):
+    """Returns S3 filesystem for profile, shared by all calls in the process."""
+    import s3fs
+
+    return s3fs.S3FileSystem(profile=aws_profile)
+
+
+# Filesystems hold connections that can't be used by forked processes
+os.register_at_fork(after_in_child=_s3.cache_clear)
+
+
+def _resolve(path, aws_profile):
+    """Returns (filesystem, path) to access path with.
+
+    Filesystem is None for local paths, including s3:// urls served from
+    `config.S3_ROOT`, and paths passed with a filesystem have no scheme.
+    """
+    if not path.startswith("s3://"):
+        return None, path
+    if config.S3_ROOT:
+        return None, os.path.join(config.S3_ROOT, path[len("s3://") :])
+    return _s3(aws_profile), path[len("s3://") :]
+
+
+def _makedirs(path):
+    """Creates parent directory of local path, as it would exist in a bucket."""
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+
+def is_dir(path, aws_profile=config.AWS_PROFILE):
+    """Returns True if path is a directory, like a partitioned dataset."""
+    fs, path = _resolve(path, aws_profile)
+    return os.path.isdir(path) if fs is None else fs.isdir(path)
+
+
+def _file_stats(path, aws_profile=config.AWS_PROFILE):
+    """Returns (size, modification time) of file or of each file in directory."""
+    fs, path = _resolve(path, aws_profile)
+    if fs is not None:
+        if fs.isdir(path):
+            infos = fs.find(path, detail=True).values()
+        else:
+            infos = [fs.info(path)]
+        return [(i["size"], i["LastModified"].timestamp()) for i in infos]
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [(stat.st_size, stat.st_mtime)]
+    stats = []
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            stat = os.stat(os.path.join(dirpath, filename))
+            stats.append((stat.st_size, stat.st_mtime))
+    return stats
+
+
+@trace.traced(cat="io")
+def file_info(path, aws_profile=config.AWS_PROFILE):
+    """Returns metadata identifying the current version of a file.
 
+    For directories, like partitioned datasets, size is the total size of
+    their files and modified the time the last of them was modified.
+    """
+    fs, fs_path = _resolve(path, aws_profile)
+    if fs is not None and not fs.isdir(fs_path):
+        info = fs.info(fs_path)
+        return {
+            "path": path,
+            "etag": info.get("ETag"),
+            "size": info["size"],
+            "modified": str(info.get("LastModified")),
+        }
+    stats = _file_stats(path, aws_profile)
+    return {
+        "path": path,
+        "size": sum(size for size, _ in stats),
+        "modified": max((mtime for _, mtime in stats), default=None),
+    }
 
+
+@trace.traced(cat="io")
+def modified(path, aws_profile=config.AWS_PROFILE):
+    """Returns last modification time of file in seconds since the epoch.
+
+    For directories, like partitioned datasets, returns the time the least
+    recently modified of their files was modified. Returns None if there is
+    no such file.
+    """
+    try:
+        stats = _file_stats(path, aws_profile)
+    except FileNotFoundError:
+        return None
+    return min((mtime for _, mtime in stats), default=None)
+
+
+def glob(pattern, aws_profile=config.AWS_PROFILE):
+    """Returns sorted paths matching pattern in local directory or AWS bucket."""
+    fs, fs_pattern = _resolve(pattern, aws_profile)
+    if fs is not None:
+        paths = fs.glob(fs_pattern)
+    else:
+        paths = glob_.glob(fs_pattern)
+        if fs_pattern != pattern:
+            paths = [os.path.relpath(path, config.S3_ROOT) for path in paths]
+    if pattern.startswith("s3://"):
+        paths = ["s3://" + path for path in paths]
+    return sorted(paths)
+
+
+@trace.traced(cat="io")
 def read_csv(path, aws_profile=config.AWS_PROFILE, **kwargs):
     """Reads csv files from local directory or AWS bucket."""
-    if path.startswith("s3://"):
-        options = dict(storage_options=dict(profile=aws_profile))
-        return pd.read_csv(path, **options, **kwargs)
-    return pd.read_csv(path, **kwargs)
+    fs, path = _resolve(path, aws_profile)
+    if fs is None:
+        return pd.read_csv(path, **kwargs)
+    with fs.open(path, "rb") as f:
+        return pd.read_csv(f, **kwargs)
 
 
+@trace.traced(cat="io")
 def write_csv(df, path, aws_profile=config.AWS_PROFILE, verbose=True, **kwargs):
     """Writes csv to local directory or to AWS bucket."""
-    if path.startswith("s3://"):
-        options = dict(storage_options=dict(profile=aws_profile))
-        df.to_csv(path, index=False, **options, **kwargs)
+    fs, fs_path = _resolve(path, aws_profile)
+    if fs is None:
+        _makedirs(fs_path)
+        df.to_csv(fs_path, index=False, **kwargs)
     else:
-        df.to_csv(path, index=False, **kwargs)
+        with fs.open(fs_path, "wb") as f:
+            df.to_csv(f, index=False, **kwargs)
     if verbose:
         print(f"{path} (of shape {df.shape}) written.")
 
 
+@trace.traced(cat="io")
 def read_parquet(path, aws_profile=config.AWS_PROFILE, **kwargs):
     """Reads parquet file from local directory or AWS bucket."""
-    if path.startswith("s3://"):
-        options = dict(storage_options=dict(profile=aws_profile))
-        return pd.read_parquet(path, **options, **kwargs)
-    return pd.read_parquet(path, **kwargs)
+    fs, path = _resolve(path, aws_profile)
+    return pd.read_parquet(path, filesystem=fs, **kwargs)
+
+
+@contextlib.contextmanager
+def open_parquet(path, aws_profile=config.AWS_PROFILE, read_dictionary=None, **kwargs):
+    """Yields pyarrow ParquetFile from local directory or AWS bucket.
+
+    The file is opened once and closed on exit.
+
+    Args:
+    read_dictionary: Columns to read as dictionaries, or a function returning
+      them for the arrow schema of the file, which lets them depend on the
+      file's column types without opening the file again.
+    kwargs: Passed to `pyarrow.parquet.ParquetFile`.
+    """
+    import pyarrow.parquet as pq
 
+    fs, path = _resolve(path, aws_profile)
+    with trace.span("open_parquet", "io"):
+        f = open(path, "rb") if fs is None else fs.open(path, "rb")
+    with f:
+        if callable(read_dictionary):
+            metadata = pq.read_metadata(f)
+            read_dictionary = read_dictionary(metadata.schema.to_arrow_schema())
+            kwargs["metadata"] = metadata
+        with pq.ParquetFile(f, read_dictionary=read_dictionary, **kwargs) as pf:
+            yield pf
 
-def write_parquet(df, path, aws_profile=config.AWS_PROFILE, index=False, verbose=True, **kwargs):
+
+@trace.traced(cat="io")
+def write_parquet(
+    df, path, aws_profile=config.AWS_PROFILE, index=False, verbose=True, **kwargs
+):
     """Writes parquet to local directory or to AWS bucket."""
-    if path.startswith("s3://"):
-        options = dict(storage_options=dict(profile=aws_profile))
-        df.to_parquet(path, index=index, **options, **kwargs)
-    else:
-        df.to_parquet(path, index=index, **kwargs)
+    fs, fs_path = _resolve(path, aws_profile)
+    if fs is None:
+        _makedirs(fs_path)
+    df.to_parquet(fs_path, index=index, filesystem=fs, **kwargs)
     if verbose:
         print(f"{path} (of shape {df.shape}) written.")
+
+
+@trace.traced(cat="io")
+def write_dataset(
+    df, path, partition_cols, aws_profile=config.AWS_PROFILE, verbose=True, **kwargs
+):
+    """Writes df as hive-partitioned parquet dataset to local directory or AWS bucket.
+
+    Replaces any file or dataset at path. Rows are written in the order of
+    df, so files of sorted data are sorted too, and with column statistics,
+    which readers use to skip row groups. Keyword arguments are passed to
+    `pyarrow.dataset.write_dataset`.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    fs, fs_path = _resolve(path, aws_profile)
+    if fs is not None:
+        if fs.exists(fs_path):
+            fs.rm(fs_path, recursive=True)
+    elif os.path.isdir(fs_path):
+        shutil.rmtree(fs_path)
+    elif os.path.exists(fs_path):
+        os.remove(fs_path)
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        fs_path,
+        format="parquet",
+        file_options=ds.ParquetFileFormat().make_write_options(write_statistics=True),
+        partitioning=partition_cols,
+        partitioning_flavor="hive",
+        filesystem=fs,
+        # Writing with multiple threads might reorder rows
+        use_threads=False,
+        **kwargs,
+    )
+    if verbose:
+        print(f"{path} (of shape {df.shape}, partitioned by {partition_cols}) written.")
+
+
+def iter_parquet_batches(
+    path, batch_size, columns=None, filters=None, aws_profile=config.AWS_PROFILE
+):
+    """Yields dataframes of at most batch_size rows of parquet file in file order.
+
+    Filters use the same format as in `read_parquet` and are pushed down to
+    row groups.
+    """
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    filesystem, path = _resolve(path, aws_profile)
+    dataset = ds.dataset(path, format="parquet", filesystem=filesystem)
+    expression = pq.filters_to_expression(filters) if filters else None
+    batches = dataset.to_batches(
+        columns=columns, filter=expression, batch_size=batch_size
+    )
+    while True:
+        # Batches are read on iteration, so each read is traced separately
+        with trace.span("iter_parquet_batches", "io", path=path):
+            batch = next(batches, None)
+            df = None if batch is None else batch.to_pandas()
+        if df is None:
+            return
+        yield df
@@ -0,0 +1,128 @@
+"""
+Mergeable quantile sketches.
+
+A sketch summarises a stream of numbers in a small, bounded number of items
+from which quantiles can be estimated. Sketches of parts of the data, like
+the pieces of a dataset, can be merged into a sketch of all the data, so
+quantiles of data too large to hold in memory at once can be estimated one
+part at a time.
+
+The sketch is a KLL sketch (Karnin, Lang, and Liberty, 2016): items are kept
+in levels of compactors, where each item at level h stands in for 2^h values.
+When a level holds more items than its capacity, its items are sorted and
+every other one, starting at a random offset, is promoted to the next level.
+
+"""
+
+import numpy as np
+
+
+class QuantileSketch:
+    """KLL sketch of a stream of numbers.
+
+    Keeps about 3k items and estimates quantiles with a rank error of about
+    1.7 / k of the number of values, so the default k=2048 estimates the
+    99th percentile to lie between the 98.92th and the 99.08th percentile.
+    Until the first compaction, quantiles are exact and equal to those of
+    `np.nanquantile`.
+
+    Attributes:
+      k: Capacity of the top level.
+      levels: List of arrays of items at each level.
+      count: Number of non-missing values added.
+    """
+
+    def __init__(self, k=2048, seed=0):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (2 / 3) ** depth)), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    # Capacities of lower levels shrink as levels are added
+                    level = 0
+                    continue
+                items = np.sort(items)
+                # With an odd number of items, the smallest stays at its level
+                odd = len(items) % 2
+                promoted = items[odd + self._rng.integers(2) :: 2]
+                self.levels[level] = items[:odd]
+                self.levels[level + 1] = np.concatenate(
+                    [self.levels[level + 1], promoted]
+                )
+            level += 1
+
+    def update(self, values):
+        """Adds non-missing values to sketch and returns sketch."""
+        values = np.asarray(values, dtype="float64").ravel()
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Adds items of other sketch to sketch and returns sketch."""
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """Returns estimates of quantiles q in [0, 1] of values added.
+
+        Items are placed at the midpoints of the ranks they stand in for and
+        quantiles interpolated linearly between them, which for unit weights
+        is the linear interpolation of `np.quantile`.
+        """
+        q = np.asarray(q, dtype="float64")
+        if not self.count:
+            return np.full(q.shape, np.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(x), 2.0**level) for level, x in enumerate(self.levels)]
+        )
+        order = np.argsort(items, kind="stable")
+        items, weights = items[order], weights[order]
+        ranks = np.cumsum(weights) - (weights + 1) / 2
+        return np.interp(q * (self.count - 1), ranks, items)
+
+
+def sketch_columns(df, sketches=None, **kwargs):
+    """Returns dict of sketches of each column of df.
+
+    Args:
+    df: A DataFrame of numeric columns.
+    sketches: Dict of sketches by column to which values of df are added, or
+      None to start new sketches.
+    kwargs: Passed to `QuantileSketch` for new sketches.
+    """
+    sketches = {} if sketches is None else sketches
+    for col in df.columns:
+        if col not in sketches:
+            sketches[col] = QuantileSketch(**kwargs)
+        sketches[col].update(df[col].to_numpy(dtype="float64", na_value=np.nan))
+    return sketches
+
+
+def merge_sketches(sketches, others):
+    """Merges dict of sketches by column others into sketches and returns it."""
+    for col, sketch in others.items():
+        if col in sketches:
+            sketches[col].merge(sketch)
+        else:
+            sketches[col] = sketch
+    return sketches
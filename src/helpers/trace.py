@@ -0,0 +1,181 @@
+"""
+Hierarchical span tracing of pipeline stages.
+
+A span records the wall time of a stage, like cleaning a piece, applying an
+aggregator, or reading a file. Spans opened while another span is open in
+the same thread are nested inside it. Tracing is off by default, in which
+case nothing is recorded and traced functions are called directly.
+
+Finished spans are stored as Chrome trace events, so a trace can be written
+to json and opened in chrome://tracing or https://ui.perfetto.dev, or
+summarised as a table of the stages that take most time. Events carry the
+id of the process and thread that recorded them, so spans recorded in
+worker processes can be merged into the trace of the main process.
+
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+
+enabled = False
+events = []
+
+
+def enable(on=True):
+    """Turns tracing on or off for the current process."""
+    global enabled
+    enabled = on
+
+
+def reset(on=False):
+    """Discards recorded events and turns tracing on or off.
+
+    Used to initialise worker processes, which might inherit the events of
+    the process that started them.
+    """
+    del events[:]
+    enable(on)
+
+
+def pop_events():
+    """Returns recorded events and removes them from `events`."""
+    popped = events[:]
+    del events[: len(popped)]
+    return popped
+
+
+@contextlib.contextmanager
+def span(name, cat="", **args):
+    """Records time spent in the with block as a span.
+
+    Args:
+    name: Name of the span, usually the name of a function.
+    cat: Category of the span, like 'io' or 'aggregator'.
+    args: Json-serialisable values shown with the span in trace viewers.
+    """
+    if not enabled:
+        yield
+        return
+    start = time.time_ns()
+    try:
+        yield
+    finally:
+        end = time.time_ns()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": start / 1e3,
+            "dur": (end - start) / 1e3,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        events.append(event)
+
+
+def traced(func=None, cat=""):
+    """Records each call of func as a span named after func."""
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with span(func.__name__, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate(func) if func else decorate
+
+
+def call(func, *args, cat=""):
+    """Returns func(*args), recording the call as a span named after func."""
+    if not enabled:
+        return func(*args)
+    with span(func.__name__, cat):
+        return func(*args)
+
+
+def call_with_events(func, *args):
+    """Returns result of func(*args) and the events it recorded.
+
+    Used to return spans recorded in worker processes to the main process.
+    """
+    return func(*args), pop_events()
+
+
+def write_chrome_trace(path, spans=None):
+    """Writes spans, by default all recorded events, to path as Chrome trace."""
+    spans = events if spans is None else spans
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": spans, "displayTimeUnit": "ms"}, f)
+    print(f"{path} (with {len(spans)} spans) written.")
+
+
+def _self_times(events):
+    """Returns duration of each event minus durations of its direct children."""
+    self_times = [e["dur"] for e in events]
+    ends = [e["ts"] + e["dur"] for e in events]
+    threads = collections.defaultdict(list)
+    for i, e in enumerate(events):
+        threads[e["pid"], e["tid"]].append(i)
+    for positions in threads.values():
+        # Parents start no later and, for equal starts, last longer
+        positions.sort(key=lambda i: (events[i]["ts"], -events[i]["dur"]))
+        open_spans = []
+        for i in positions:
+            while open_spans and ends[open_spans[-1]] <= events[i]["ts"]:
+                open_spans.pop()
+            if open_spans:
+                self_times[open_spans[-1]] -= events[i]["dur"]
+            open_spans.append(i)
+    return self_times
+
+
+def top_spans(spans=None, n=20):
+    """Returns table of the n spans with most total self time.
+
+    Spans, by default all recorded events, are grouped by category and name.
+    Self time is time spent in a span but not in any of the spans nested
+    inside it, so self times of all spans add up to total traced time.
+    """
+    import pandas as pd
+
+    spans = events if spans is None else spans
+    columns = ["cat", "name", "calls", "total_s", "self_s", "mean_s", "max_s"]
+    if not spans:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(
+        {
+            "cat": [e["cat"] for e in spans],
+            "name": [e["name"] for e in spans],
+            "dur": [e["dur"] / 1e6 for e in spans],
+            "self": [t / 1e6 for t in _self_times(spans)],
+        }
+    )
+    table = df.groupby(["cat", "name"]).agg(
+        calls=("dur", "size"),
+        total_s=("dur", "sum"),
+        self_s=("self", "sum"),
+        mean_s=("dur", "mean"),
+        max_s=("dur", "max"),
+    )
+    return table.sort_values("self_s", ascending=False).head(n).reset_index()
+
+
+def report(path, n=20, spans=None):
+    """Writes spans to path and prints the n spans with most self time."""
+    write_chrome_trace(path, spans)
+    print(top_spans(spans, n).to_string(index=False, float_format="{:.3f}".format))
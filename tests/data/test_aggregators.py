@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.data.aggregators as agg
+import src.data.diversity as dv
+import src.data.groups as gr
+
+
+@pytest.fixture
+def base_values():
+    rng = np.random.default_rng(0)
+    txns = pd.DataFrame(
+        {
+            "user_id": np.repeat([1, 2, 3], 20),
+            "ym": pd.Period("2020-01", freq="M"),
+            "tag": pd.Categorical(rng.choice(list("abcdefgh"), size=60)),
+        }
+    )
+    groups = gr.UserMonthGroups(txns)
+    return groups.crosstab(txns.tag), groups.sparse_crosstab(txns.tag)
+
+
+@pytest.mark.parametrize("smooth", [False, True])
+@pytest.mark.parametrize("norm", [False, True])
+def test_sparse_entropy_scores_match_dense(base_values, smooth, norm):
+    dense, sparse = base_values
+
+    expected = agg._entropy_scores(dense, norm=norm, smooth=smooth)
+    actual = agg._entropy_scores(sparse, norm=norm, smooth=smooth)
+
+    pd.testing.assert_series_equal(actual, expected)
+
+
+def test_sparse_cat_count_std_matches_dense(base_values):
+    dense, sparse = base_values
+
+    pd.testing.assert_series_equal(
+        agg._cat_count_std(sparse), agg._cat_count_std(dense)
+    )
+
+
+def test_diversity_measures_match_definitions(base_values):
+    dense, sparse = base_values
+    probs = dense.div(dense.sum(1), axis=0)
+    names = ["entropy_n", "renyi_2", "hhi", "gini_simpson", "top1_share"]
+
+    actual = dv.measures(sparse, names)
+
+    expected = pd.DataFrame(
+        {
+            "entropy_n": agg._entropy_scores(dense, norm=True),
+            "renyi_2": -np.log2(probs.pow(2).sum(1)),
+            "hhi": probs.pow(2).sum(1),
+            "gini_simpson": 1 - probs.pow(2).sum(1),
+            "top1_share": probs.max(1),
+        }
+    )
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_order_masked_reductions_restores_positions_of_replaced_aggregators():
+    masked = [spec.name for spec in agg.MASKED_REDUCTIONS]
+    others = [
+        "txns_count_ca",
+        "month_income",
+        "user_reg_ym",
+        "age",
+        "accounts_total",
+        "nunique_merchant",
+        "dspend_clothes",
+        "dspend_other",
+        "std_tag",
+    ]
+    df = pd.DataFrame(columns=["user_id", "ym", "txns_count", *masked, *others])
+
+    actual = agg.order_masked_reductions(df, {})
+
+    assert list(actual.columns) == [
+        "user_id",
+        "ym",
+        "txns_count",
+        "txns_volume",
+        "txns_count_spend",
+        "txns_count_ca",
+        "has_benefits",
+        "has_od_fees",
+        "month_income",
+        "user_reg_ym",
+        "month_spend",
+        "age",
+        "accounts_total",
+        "investments",
+        "up_savings",
+        "ca_transfers",
+        "cc_payments",
+        "loan_funds",
+        "loan_rpmts",
+        "nunique_merchant",
+        "dspend",
+        "dspend_count",
+        "dspend_mean",
+        "dspend_clothes",
+        "dspend_other",
+        "dspend_dd",
+        "std_tag",
+    ]
+
+
+def test_diversity_measures_of_user_without_spend_match_definitions(base_values):
+    dense, _ = base_values
+    dense = dense.copy()
+    dense.iloc[1] = 0
+    probs = dense.div(dense.sum(1), axis=0)
+
+    actual = dv.measures(dense, ["hhi", "top1_share"])
+    empty = dv.measures(dense.iloc[[1]], ["hhi", "top1_share"])
+
+    expected = pd.DataFrame({"hhi": probs.pow(2).sum(1), "top1_share": probs.max(1)})
+    expected.iloc[1] = np.nan
+    pd.testing.assert_frame_equal(actual, expected)
+    pd.testing.assert_frame_equal(empty, expected.iloc[[1]])
@@ -0,0 +1,269 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.data.clean as cl
+
+
+def test_add_tag_uses_last_group_and_reports_conflicts(monkeypatch, capsys):
+    groupings = {
+        "tag": [{"spend": ["a", "b"]}, {"income": ["b", "c"]}],
+        "tag_group": [{"spend": ["a"]}],
+        "tag_spend": [{"x": ["c"]}],
+    }
+    monkeypatch.setattr(cl, "TAG_GROUPINGS", groupings)
+    cl._tag_lookups.cache_clear()
+    df = pd.DataFrame({"tag_auto": pd.Categorical(["a", "b", "c", np.nan, "d"])})
+
+    actual = cl.add_tag(df)
+    _, conflicts = cl._tag_lookups()
+    cl._tag_lookups.cache_clear()
+
+    assert actual.tag.tolist() == ["spend", "income", "income", np.nan, np.nan]
+    assert actual.tag_group.cat.categories.tolist() == ["spend"]
+    assert actual.tag_spend.tolist()[2] == "x"
+    assert conflicts["tag"] == {"b": ["spend", "income"]}
+    assert "Tag 'b'" in capsys.readouterr().out
+
+
+def test_add_tag_uses_last_group_if_group_repeats(monkeypatch):
+    groupings = {
+        "tag": [{"a": ["x"]}, {"b": ["x"]}, {"a": ["x"]}],
+        "tag_group": [],
+        "tag_spend": [],
+    }
+    monkeypatch.setattr(cl, "TAG_GROUPINGS", groupings)
+    cl._tag_lookups.cache_clear()
+
+    lookups, conflicts = cl._tag_lookups()
+    cl._tag_lookups.cache_clear()
+
+    assert lookups["tag"] == {"x": "a"}
+    assert conflicts["tag"] == {"x": ["a", "b"]}
+
+
+def test_read_raw_piece_matches_post_hoc_cast(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        cl,
+        "RAW_DTYPES",
+        {
+            "User Reference": "int32",
+            "Amount": "float32",
+            "Merchant Name": "category",
+            "Transaction Date": "datetime64",
+        },
+    )
+    fp = str(tmp_path / "raw.parquet")
+    raw = pd.DataFrame(
+        {
+            "User.Reference": [3, 1, 2],
+            "Amount": [1.5, np.nan, 3.25],
+            "Merchant.Name": ["tesco", None, "aldi"],
+            "Transaction.Date": ["2020-01-02", "2020-01-01", None],
+            "Other": ["x", "y", "z"],
+        }
+    )
+    raw.to_parquet(fp)
+
+    actual = cl.read_raw_piece(fp)
+
+    expected = raw.astype(
+        {
+            "User.Reference": "int32",
+            "Amount": "float32",
+            "Merchant.Name": "category",
+            "Transaction.Date": "datetime64[ns]",
+        }
+    )
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_lowercase_categories_merges_duplicate_categories():
+    df = pd.DataFrame(
+        {
+            "desc": pd.Categorical(["Tesco", "tesco", np.nan, "ALDI", "Lidl"]),
+            "amount": [1.0, 2.0, 3.0, 4.0, 5.0],
+        }
+    )
+    df["desc"] = df.desc.cat.add_categories(["Unused"])
+    expected = df.desc.str.lower().astype("category")
+
+    actual = cl.lowercase_categories(df)
+
+    pd.testing.assert_series_equal(actual.desc, expected)
+
+
+@pytest.fixture
+def txns_with_duplicates():
+    return pd.DataFrame(
+        {
+            "user_id": [1, 1, 1, 1, 2],
+            "account_id": [10, 10, 10, 10, 20],
+            "date": pd.to_datetime(["2020-01-01"] * 4 + ["2020-01-02"]),
+            "amount": np.array([5.0, 5.0, -0.0, 0.0, 3.0], dtype="float32"),
+            "desc": pd.Categorical(["a", "a", "b", "b", "a"]),
+        }
+    )
+
+
+def test_drop_duplicates_matches_pandas(txns_with_duplicates):
+    expected = txns_with_duplicates.drop_duplicates(subset=cl.DUPLICATE_COLS)
+
+    actual = cl.drop_duplicates(txns_with_duplicates)
+
+    pd.testing.assert_frame_equal(actual, expected)
+    assert cl.duplicates.txns_dup.tolist() == [2, 0]
+    assert cl.duplicates.value_dup.tolist() == [5.0, 0.0]
+
+
+def test_drop_duplicates_handles_hash_collisions(txns_with_duplicates, monkeypatch):
+    monkeypatch.setattr(cl, "_row_keys", lambda df, cols: np.zeros(len(df)))
+    expected = txns_with_duplicates.drop_duplicates(subset=cl.DUPLICATE_COLS)
+
+    actual = cl.drop_duplicates(txns_with_duplicates)
+
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_add_region_matches_merge_and_caches_lookup(tmp_path, monkeypatch):
+    lookup = pd.DataFrame(
+        {
+            "pcsector": ["ab1 1", "ab1 2", "ab1 3"],
+            "region_name": ["north", "south", "east"],
+            "is_urban": [True, False, True],
+        }
+    )
+    reads = []
+
+    def read_csv(fp, usecols):
+        reads.append(fp)
+        return lookup[usecols]
+
+    monkeypatch.setattr(cl.io, "read_csv", read_csv)
+    monkeypatch.setattr(cl.io, "file_info", lambda fp: {"path": fp, "etag": "1"})
+    read_regions = cl._read_regions.__wrapped__
+    monkeypatch.setattr(
+        cl, "_read_regions", lambda: read_regions(cachedir=str(tmp_path))
+    )
+    df = pd.DataFrame(
+        {"postcode": pd.Categorical(["ab1 2", "zz9 9", np.nan, "ab1 1"])},
+        index=[3, 5, 8, 9],
+    )
+    regions = lookup.rename(columns={"pcsector": "postcode"})
+    expected = df.merge(regions, how="left", on="postcode")
+
+    actual = cl.add_region(df.copy())
+    cl.add_region(df.copy())
+
+    pd.testing.assert_frame_equal(actual.astype({"postcode": object}), expected)
+    assert actual.postcode.dtype == "category"
+    assert len(reads) == 1
+
+
+def test_read_regions_is_not_evicted_with_pieces(tmp_path, monkeypatch):
+    lookup = pd.DataFrame(
+        {"pcsector": ["ab1 1"], "region_name": ["north"], "is_urban": [True]}
+    )
+    monkeypatch.setattr(cl.io, "read_csv", lambda fp, usecols: lookup[usecols])
+    monkeypatch.setattr(cl.io, "file_info", lambda fp: {"path": fp, "etag": "1"})
+    lookup_dir = str(tmp_path / "lookups")
+    cl._read_regions.__wrapped__(cachedir=lookup_dir)
+
+    cl.cache.store("piece", pd.DataFrame({"a": [1]}), {}, cachedir=str(tmp_path))
+    cl.cache.evict(str(tmp_path), max_bytes=0)
+
+    assert len(os.listdir(lookup_dir)) == 2
+
+
+def test_run_cleaners_reports_steps_and_aborts_above_budget(monkeypatch):
+    def drop_first(df):
+        return df.iloc[1:]
+
+    def add_column(df):
+        return df.assign(b=1)
+
+    monkeypatch.setattr(cl, "cleaner_funcs", [drop_first, add_column])
+    monkeypatch.setattr(cl, "_rss_mb", lambda: 50)
+    monkeypatch.setattr(cl, "_peak_rss_mb", iter([100, 500]).__next__)
+    df = pd.DataFrame({"a": range(3)})
+    steps = []
+
+    with pytest.raises(MemoryError, match="'add_column'"):
+        cl.run_cleaners(df, steps, budget_mb=200)
+
+    assert [s["step"] for s in steps] == ["drop_first", "add_column"]
+    assert (steps[0]["rows_in"], steps[0]["rows_out"]) == (3, 2)
+
+
+def test_run_cleaners_checks_budget_against_current_rss(monkeypatch):
+    monkeypatch.setattr(cl, "cleaner_funcs", [])
+    # Peak of an earlier piece in the same process
+    monkeypatch.setattr(cl, "_peak_rss_mb", lambda: 500)
+    df = pd.DataFrame({"a": range(3)})
+
+    monkeypatch.setattr(cl, "_rss_mb", lambda: 100)
+    cl.run_cleaners(df, budget_mb=200)
+    monkeypatch.setattr(cl, "_rss_mb", lambda: 300)
+    with pytest.raises(MemoryError, match="before cleaning"):
+        cl.run_cleaners(df, budget_mb=200)
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/clear_refs"), reason="peak RSS can't be reset"
+)
+def test_run_cleaners_reports_peak_rss_of_each_step(monkeypatch):
+    def allocate(df):
+        block = np.ones(2**23)  # 64MB
+        return df.assign(b=block[: len(df)])
+
+    def keep(df):
+        return df
+
+    df = pd.DataFrame({"a": range(3)})
+    monkeypatch.setattr(cl, "cleaner_funcs", [allocate, keep])
+    first = []
+    cl.run_cleaners(df, first)
+    monkeypatch.setattr(cl, "cleaner_funcs", [keep])
+    second = []
+    cl.run_cleaners(df, second)
+
+    assert first[0]["peak_rss_mb"] - first[0]["rss_before_mb"] > 48
+    assert first[1]["peak_rss_mb"] < first[0]["peak_rss_mb"] - 48
+    assert second[0]["peak_rss_mb"] < first[0]["peak_rss_mb"] - 48
+
+
+def test_clean_pieces_skips_up_to_date_pieces_and_reports_failures(
+    tmp_path, monkeypatch
+):
+    raw = tmp_path / "raw" / "pieces"
+    for subdir in ["raw/pieces", "clean/pieces", "clean/duplicates"]:
+        (tmp_path / subdir).mkdir(parents=True)
+    for piece in range(3):
+        (raw / f"mdb_XX{piece}.parquet").touch()
+    old = str(raw / "mdb_XX0.parquet")
+    for output in [cl.clean_path(old), cl.duplicates_path(old)]:
+        open(output, "w").close()
+        os.utime(output, (os.stat(old).st_mtime + 1,) * 2)
+
+    def fake_clean_piece(filepath, **kwargs):
+        if filepath.endswith("2.parquet"):
+            raise ValueError("bad piece")
+        return {"piece": filepath, "status": "cleaned", "raw_rows": 2}
+
+    monkeypatch.setattr(cl, "clean_piece", fake_clean_piece)
+    filepaths = cl.expand_filepaths([str(raw / "*.parquet")], pieces=None)
+
+    summary = cl.clean_pieces(filepaths, workers=2)
+
+    assert summary.piece.tolist() == filepaths
+    assert summary.status[0] == "skipped (up to date)"
+    assert summary.status[1] == "cleaned"
+    assert summary.status[2].startswith("failed: ValueError")
+    assert cl.clean_pieces(filepaths[:1], force=True).status[0] == "cleaned"
+
+
+def test_piece_range():
+    assert cl.piece_range("3") == [3]
+    assert cl.piece_range("0-2,5") == [0, 1, 2, 5]
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.data.groups as gr
+
+
+@pytest.fixture
+def txns():
+    return pd.DataFrame(
+        {
+            "user_id": [1, 1, 1, 2, 2, 2],
+            "ym": pd.PeriodIndex(
+                ["2020-01", "2020-01", "2020-02", "2020-01", "2020-03", "2020-03"],
+                freq="M",
+            ),
+            "amount": [1.0, np.nan, 3.0, 4.0, 5.0, 6.0],
+            "tag": pd.Categorical(["a", "b", np.nan, "a", "a", "c"]),
+        }
+    )
+
+
+def test_reductions_match_groupby(txns):
+    groups = gr.UserMonthGroups(txns)
+    g = txns.groupby([txns.user_id, txns.ym])
+
+    pd.testing.assert_series_equal(groups.size(), g.size())
+    pd.testing.assert_series_equal(groups.sum(txns.amount), g.amount.sum())
+    pd.testing.assert_series_equal(groups.count(txns.amount), g.amount.count())
+    pd.testing.assert_series_equal(groups.mean(txns.amount), g.amount.mean())
+    pd.testing.assert_series_equal(groups.first(txns.amount), g.amount.first())
+    pd.testing.assert_series_equal(groups.nunique(txns.tag), g.tag.nunique())
+
+
+def test_crosstab_matches_unstack(txns):
+    groups = gr.UserMonthGroups(txns)
+
+    actual = groups.crosstab(txns.tag, txns.amount, how="sum")
+
+    expected = (
+        txns.groupby([txns.user_id, txns.ym, txns.tag], observed=True)
+        .amount.sum()
+        .unstack()
+        .fillna(0)
+        .rename(columns=str)
+    )
+    pd.testing.assert_frame_equal(actual, expected, check_column_type=False)
+
+
+def test_sort_by_user_month_is_stable(txns):
+    shuffled = txns.iloc[[3, 0, 4, 1, 5, 2]]
+
+    actual = gr.sort_by_user_month(shuffled)
+
+    pd.testing.assert_frame_equal(actual, txns)
+
+
+def test_reduce_rows_matches_masked_groupby(txns):
+    groups = gr.UserMonthGroups(txns)
+    mask = txns.tag.eq("a")
+    rows = np.flatnonzero(mask)
+
+    actual = groups.reduce_rows(rows, txns.amount.to_numpy()[rows])
+
+    expected = txns.amount.where(mask, 0).groupby([txns.user_id, txns.ym]).sum()
+    pd.testing.assert_series_equal(actual, expected, check_names=False)
+
+
+def test_sparse_crosstab_matches_crosstab(txns):
+    groups = gr.UserMonthGroups(txns)
+
+    dense = groups.crosstab(txns.tag)
+    actual = groups.sparse_crosstab(txns.tag)
+
+    pd.testing.assert_index_equal(actual.index, dense.index)
+    assert actual.columns.tolist() == dense.columns.tolist()
+    np.testing.assert_array_equal(actual.matrix.toarray(), dense.to_numpy())
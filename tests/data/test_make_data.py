@@ -0,0 +1,168 @@
+import pandas as pd
+
+import src.data.make_data as md
+import src.data.selectors as sl
+
+
+def fake_clean_piece(filepath, filters=None, batch_size=None):
+    sl.sample_counts.update({"Raw sample@users": 1})
+    return pd.DataFrame({"piece": [filepath]})
+
+
+def test_clean_pieces_merges_worker_counts_in_order(monkeypatch):
+    monkeypatch.setattr(md, "clean_piece", fake_clean_piece)
+    monkeypatch.setattr(sl, "sample_counts", sl.collections.Counter())
+    paths = ["a", "b", "c"]
+
+    pieces = md.clean_pieces(paths, workers=2, use_cache=False)
+
+    assert [piece.piece[0] for piece in pieces] == paths
+    assert sl.sample_counts["Raw sample@users"] == 3
+
+
+def test_clean_pieces_passes_prefetched_txns_of_uncached_pieces(monkeypatch):
+    def fake_clean(filepath, filters=None, batch_size=None, txns=None):
+        return pd.DataFrame({"piece": [filepath], "txns": [txns]})
+
+    monkeypatch.setattr(md, "clean_piece", fake_clean)
+    monkeypatch.setattr(md, "read_piece_txns", lambda fp, filters=None: fp.upper())
+    keyed = []
+    monkeypatch.setattr(
+        md, "piece_cache_key", lambda fp, filters=None: keyed.append(fp) or fp
+    )
+    cache = {"b": (pd.DataFrame({"piece": ["b"], "txns": [None]}), {})}
+    monkeypatch.setattr(md.cache, "contains", lambda key: key in cache)
+    monkeypatch.setattr(md.cache, "load", cache.get)
+    monkeypatch.setattr(md.cache, "store", lambda key, df, counts: None)
+
+    pieces = md.clean_pieces(["a", "b", "c"], prefetch=2)
+
+    assert [piece.txns[0] for piece in pieces] == ["A", None, "C"]
+    assert keyed == ["a", "b", "c"]
+
+
+def test_read_piece_pushes_down_columns_and_filters(tmp_path):
+    fp = str(tmp_path / "piece.parquet")
+    pd.DataFrame(
+        {
+            "user_id": [1, 1, 2, 3],
+            "date": pd.to_datetime(
+                ["2020-01-01", "2020-03-01", "2020-03-01", "2020-03-01"]
+            ),
+            "desc": ["a", "b", "c", "d"],
+        }
+    ).to_parquet(fp)
+    filters = md.make_filters(start="2020-02-01", users=[1, 2])
+
+    actual = md.read_piece(fp, columns=["user_id", "date"], filters=filters)
+
+    assert list(actual.columns) == ["user_id", "date"]
+    assert actual.user_id.tolist() == [1, 2]
+
+
+def test_read_piece_batches_keeps_users_together(tmp_path):
+    fp = str(tmp_path / "piece.parquet")
+    user_id = [1, 1, 1, 2, 3, 3, 4]
+    pd.DataFrame({"user_id": user_id, "amount": range(7)}).to_parquet(fp)
+
+    batches = list(md.read_piece_batches(fp, batch_size=2))
+
+    assert pd.concat(batches).user_id.tolist() == user_id
+    batch_users = [set(batch.user_id) for batch in batches]
+    assert sum(len(users) for users in batch_users) == len(set(user_id))
+
+
+def test_clean_pieces_merges_worker_spans(monkeypatch):
+    monkeypatch.setattr(sl, "sample_counts", sl.collections.Counter())
+    monkeypatch.setattr(md.trace, "events", [])
+    monkeypatch.setattr(md.trace, "enabled", True)
+    traced_clean_piece = md.trace.traced(fake_clean_piece, cat="test")
+    monkeypatch.setattr(md, "clean_piece", traced_clean_piece)
+
+    md.clean_pieces(["a", "b", "c"], workers=2, use_cache=False)
+
+    names = [e["name"] for e in md.trace.events]
+    assert names.count("fake_clean_piece") == 3
+    assert names.count("clean_pieces") == 1
+
+
+def test_read_piece_batches_keeps_users_of_partitioned_piece_together(tmp_path):
+    fp = str(tmp_path / "piece.parquet")
+    df = pd.DataFrame(
+        {
+            "user_id": [1, 1, 2, 2, 3, 17],
+            "date": pd.to_datetime(
+                ["2019-12-01", "2020-01-01", "2019-01-01", "2021-01-01"]
+                + ["2020-01-01", "2020-01-01"]
+            ),
+        }
+    )
+    md.io.write_dataset(
+        df.assign(user_bucket=md.hd.user_bucket(df.user_id), year=df.date.dt.year),
+        fp,
+        md.hd.PARTITION_COLS,
+    )
+
+    batches = list(md.read_piece_batches(fp, batch_size=1))
+
+    users = [batch.user_id.unique().tolist() for batch in batches]
+    assert users == [[1], [17], [2], [3]]
+    actual = pd.concat(batches).sort_values(["user_id", "date"], ignore_index=True)
+    pd.testing.assert_frame_equal(actual, df)
+
+
+def fake_clean_piece_with_flows(filepath, filters=None, batch_size=None):
+    cols = md.tf.WINSORISE_UPPER_COLS + md.tf.WINSORISE_BOTH_COLS
+    start = 100 * "abc".index(filepath)
+    values = {col: [float(x) for x in range(start, start + 100)] for col in cols}
+    return pd.DataFrame(values)
+
+
+def test_clean_pieces_sketches_pieces_in_workers(monkeypatch):
+    monkeypatch.setattr(md, "clean_piece", fake_clean_piece_with_flows)
+    monkeypatch.setattr(sl, "sample_counts", sl.collections.Counter())
+
+    pieces, sketches = md.clean_pieces(
+        ["a", "b", "c"], workers=2, use_cache=False, sketch=True
+    )
+    df = pd.concat(pieces).reset_index(drop=True)
+
+    assert sketches["inflows"].count == 300
+    pd.testing.assert_frame_equal(
+        md.transform_variables(df.copy(), sketches), md.transform_variables(df)
+    )
+
+
+def test_clean_pieces_sketches_pieces_with_different_spend_columns(monkeypatch):
+    def fake_clean(filepath, filters=None, batch_size=None):
+        df = fake_clean_piece_with_flows(filepath)
+        return df.drop(columns="dspend_other" if filepath == "a" else "dspend_dd")
+
+    monkeypatch.setattr(md, "clean_piece", fake_clean)
+    monkeypatch.setattr(sl, "sample_counts", sl.collections.Counter())
+
+    pieces, sketches = md.clean_pieces(
+        ["a", "b"], use_cache=False, prefetch=0, sketch=True
+    )
+    df = pd.concat(pieces).reset_index(drop=True)
+
+    assert sketches["dspend_other"].count == 100
+    assert sketches["dspend_dd"].count == 100
+    pd.testing.assert_frame_equal(
+        md.transform_variables(df.copy(), sketches), md.transform_variables(df)
+    )
+
+
+def test_selection_grid_keeps_steps_counting_zero(monkeypatch):
+    counts = {"Raw sample@users": 1, "Drop first and last month@users": 0}
+    monkeypatch.setattr(
+        md, "summarise_piece", lambda fp, **kwargs: (pd.DataFrame(), counts)
+    )
+    monkeypatch.setattr(sl, "selection_grid", lambda users, grid, counts: counts)
+
+    actual = md.selection_grid(["a", "b"], {})
+
+    assert dict(actual) == {
+        "Raw sample@users": 2,
+        "Drop first and last month@users": 0,
+    }
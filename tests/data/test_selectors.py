@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+import src.data.selectors as sl
+
+
+def make_user_months(user_id, months, **columns):
+    df = pd.DataFrame(
+        {
+            "user_id": user_id,
+            "ym": pd.PeriodIndex(months, freq="M"),
+            "txns_count": 20,
+            "txns_volume": np.float32(1e3),
+            "txns_count_spend": 15,
+            "ct_tag_spend_groceries": 5.0,
+            "month_spend": 500.0,
+            "month_income_mean": 1e3,
+            "has_savings_account": 1,
+            "has_current_account": 1,
+            "age": 40.0,
+            "is_female": 1.0,
+            "is_urban": 1.0,
+        }
+    )
+    return df.assign(**columns)
+
+
+def test_select_sample_keeps_users_passing_all_selectors(monkeypatch):
+    monkeypatch.setattr(sl, "sample_counts", sl.collections.Counter())
+    months = pd.period_range("2020-01", periods=9, freq="M").astype(str).tolist()
+    df = make_user_months(
+        np.repeat([1, 2, 3], 9),
+        months * 3,
+        # user 2 lacks demographics in one month, user 3 is too young
+        age=[40.0] * 9 + [40.0] * 4 + [np.nan] + [40.0] * 4 + [16.0] * 9,
+    )
+
+    selected = sl.select_sample(df)
+
+    assert selected.user_id.unique().tolist() == [1]
+    assert selected.ym.astype(str).tolist() == months[1:-1]
+    assert sl.sample_counts["Raw sample@user_months"] == 27
+    assert sl.sample_counts["Drop first and last month@user_months"] == 21
+    assert sl.sample_counts["Complete demographic information@users"] == 2
+    assert sl.sample_counts["Final sample@txns"] == 7 * 20
+
+
+def test_user_masks_use_given_thresholds():
+    months = pd.period_range("2020-01", periods=9, freq="M").astype(str).tolist()
+    df = make_user_months(np.repeat([1, 2], 9), months * 2, txns_count_spend=12)
+    users = sl.user_summary(df)
+
+    default = dict(sl.user_masks(users))
+    stricter = dict(
+        sl.user_masks(users, {"month_min_spend_txns": {"min_txns": 13}})
+    )
+
+    assert default[sl.month_min_spend_txns].all()
+    assert not stricter[sl.month_min_spend_txns].any()
+    assert not stricter[sl.working_age].any()
+
+
+def test_selection_grid_matches_select_sample_for_each_threshold(monkeypatch):
+    monkeypatch.setattr(sl, "sample_counts", sl.collections.Counter())
+    months = pd.period_range("2020-01", periods=9, freq="M").astype(str).tolist()
+    df = make_user_months(
+        np.repeat([1, 2, 3], 9), months * 3, txns_count_spend=[8] * 9 + [12] * 18
+    )
+    _, users, counts = sl.summarise(df)
+
+    table = sl.selection_grid(users, {"month_min_spend_txns.min_txns": [5, 10]}, counts)
+
+    for min_txns in [5, 10]:
+        sl.sample_counts.clear()
+        sl.select_sample(df, {"month_min_spend_txns": {"min_txns": min_txns}})
+        rows = table[table["month_min_spend_txns.min_txns"].eq(min_txns)]
+        for metric in ["users", "user_months", "txns", "txns_volume"]:
+            expected = [sl.sample_counts[f"{step}@{metric}"] for step in rows.step]
+            np.testing.assert_allclose(rows[metric], expected)
@@ -0,0 +1,31 @@
+import os
+
+import pandas as pd
+
+import src.helpers.cache as cache
+
+
+def test_store_and_load_roundtrip(tmp_path):
+    df = pd.DataFrame({"user_id": [1, 2], "amount": [1.5, 2.5]})
+    key = cache.make_key("piece", {"a": 1})
+
+    cache.store(key, df, {"Raw sample@users": 2}, cachedir=tmp_path)
+    data, meta = cache.load(key, cachedir=tmp_path)
+
+    pd.testing.assert_frame_equal(data, df)
+    assert meta == {"Raw sample@users": 2}
+    assert cache.load("missing", cachedir=tmp_path) is None
+
+
+def test_evict_removes_least_recently_used(tmp_path):
+    df = pd.DataFrame({"x": range(100)})
+    for i, key in enumerate(["old", "new"]):
+        cache.store(key, df, {}, cachedir=tmp_path)
+        for path in cache._entry_paths(key, tmp_path):
+            os.utime(path, (i, i))
+
+    entry_size = sum(os.path.getsize(p) for p in cache._entry_paths("new", tmp_path))
+    cache.evict(tmp_path, max_bytes=entry_size)
+
+    assert cache.load("old", cachedir=tmp_path) is None
+    assert cache.load("new", cachedir=tmp_path) is not None
@@ -0,0 +1,148 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.helpers.data as hd
+import src.helpers.io as io
+
+
+def test_partition_filters_add_implied_partition_filters():
+    filters = [
+        ("date", ">=", pd.Timestamp("2020-03-01")),
+        ("date", "<", pd.Timestamp("2021-01-01")),
+        ("user_id", "in", [1, 5, 17]),
+        ("amount", ">", 0),
+    ]
+
+    actual = hd.partition_filters(filters, buckets=4)
+
+    assert actual == filters + [
+        ("year", ">=", 2020),
+        ("year", "<=", 2021),
+        ("user_bucket", "in", [1]),
+    ]
+    assert hd.partition_filters(None) is None
+
+
+def test_read_clean_piece_reads_partitioned_and_single_file_pieces_alike(tmp_path):
+    df = pd.DataFrame(
+        {
+            "user_id": [1, 1, 2, 2, 3, 4],
+            "date": pd.to_datetime(
+                ["2019-12-31", "2020-01-01", "2019-05-01", "2020-05-01"]
+                + ["2020-01-02", "2020-02-02"]
+            ),
+            "desc": pd.Categorical(["a", "b", "a", "c", "b", "a"]),
+        }
+    )
+    single = str(tmp_path / "single.parquet")
+    partitioned = str(tmp_path / "partitioned.parquet")
+    df.to_parquet(single)
+    io.write_dataset(
+        df.assign(user_bucket=hd.user_bucket(df.user_id), year=df.date.dt.year),
+        partitioned,
+        hd.PARTITION_COLS,
+    )
+    filters = [("user_id", "in", [1, 2]), ("date", ">=", pd.Timestamp("2020-01-01"))]
+
+    assert hd.partition_buckets(partitioned) == [1, 2, 3, 4]
+    for kwargs in [{}, {"filters": filters}, {"columns": ["user_id"]}]:
+        pd.testing.assert_frame_equal(
+            hd.read_clean_piece(partitioned, **kwargs),
+            hd.read_clean_piece(single, **kwargs),
+            check_categorical=False,
+        )
+
+
+def test_concat_categoricals_unifies_categories():
+    first = pd.DataFrame({"tag": pd.Categorical(["a", "b"]), "x": [1, 2]})
+    second = pd.DataFrame({"tag": pd.Categorical(["c", "a"]), "x": [3, 4]})
+
+    actual = hd.concat_categoricals([first, second])
+
+    assert list(actual.tag.cat.categories) == ["a", "b", "c"]
+    assert actual.tag.tolist() == ["a", "b", "c", "a"]
+    assert list(second.tag.cat.categories) == ["a", "c"]
+
+
+def test_read_many_reads_and_concatenates_files_in_order(tmp_path, capsys):
+    fps = []
+    for i in range(3):
+        fp = str(tmp_path / f"mdb_XX{i}.parquet")
+        pd.DataFrame({"piece": pd.Categorical([str(i)] * 2)}).to_parquet(fp)
+        fps.append(fp)
+
+    actual = hd.read_many(fps, io.read_parquet, workers=2)
+
+    assert actual.piece.tolist() == ["0", "0", "1", "1", "2", "2"]
+    assert actual.piece.dtype == "category"
+    out = capsys.readouterr().out
+    assert "Read 3 files" in out
+    assert "MB/s" in out
+
+
+def test_read_many_loads_lazy_pandas_once_in_fresh_process(tmp_path):
+    fps = []
+    for i in range(8):
+        fp = str(tmp_path / f"mdb_XX{i}.parquet")
+        pd.DataFrame({"piece": [i] * 2}).to_parquet(fp)
+        fps.append(fp)
+    script = (
+        "import sys\n"
+        "import src.helpers.data as hd\n"
+        "import src.helpers.io as io\n"
+        "df = hd.read_many(sys.argv[1:], io.read_parquet, workers=8)\n"
+        "assert df.piece.tolist() == [i for i in range(8) for _ in range(2)]\n"
+    )
+    rootdir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+    # Threads of a fresh process race to first use pandas, which is lazy
+    result = subprocess.run(
+        [sys.executable, "-c", script, *fps],
+        cwd=rootdir,
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stderr
+
+
+def test_nanpercentiles_matches_numpy():
+    rng = np.random.default_rng(0)
+    values = rng.exponential(30, (101, 4)).astype("float32")
+    values[rng.random(values.shape) < 0.2] = np.nan
+    values[:, 3] = np.nan
+
+    actual = hd.nanpercentiles(values, [0.5, 1, 50, 99.5])
+
+    with pytest.warns(RuntimeWarning, match="All-NaN"):
+        expected = np.nanpercentile(values, [0.5, 1, 50, 99.5], axis=0)
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_nanpercentiles_of_empty_values_are_missing():
+    actual = hd.nanpercentiles(np.empty((0, 3)), [1, 99])
+
+    assert actual.shape == (2, 3)
+    assert np.isnan(actual).all()
+
+
+@pytest.mark.parametrize("how", ["both", "lower", "upper"])
+def test_winsorise_frame_matches_winsorise_of_each_column(how):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "a": rng.exponential(30, 200).astype("float32"),
+            "b": rng.integers(0, 100, 200),
+            "c": rng.normal(size=200),
+        }
+    )
+    df.loc[::7, "a"] = np.nan
+
+    expected = df.apply(hd.winsorise, pct=2, how=how)
+
+    pd.testing.assert_frame_equal(hd.winsorise_frame(df, 2, how), expected)
@@ -0,0 +1,106 @@
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.helpers.helpers as hh
+
+
+@pytest.mark.parametrize(
+    "pattern, how",
+    [
+        (r"(?:od|o/d|overdraft).*(?:fee|interest)", "contains"),
+        ("direct debit|dd$", "contains"),
+        (r"^(tesco|aldi)(:?\ssupermarket)?$", "match"),
+        ("tesco", "fullmatch"),
+    ],
+)
+def test_str_predicate_matches_str_methods(pattern, how):
+    values = ["od fee", "tesco supermarket", "rent dd", np.nan, "tesco", "aldi"]
+    series = pd.Series(values * 2, dtype="category", name="desc")
+
+    expected = getattr(series.str, how)(pattern, na=False)
+
+    pd.testing.assert_series_equal(hh.str_predicate(series, pattern, how), expected)
+    pd.testing.assert_series_equal(
+        hh.str_predicate(series.astype(object), pattern, how), expected
+    )
+
+
+def test_prefetch_yields_items_in_order_and_bounds_items_ahead():
+    produced = []
+
+    def items():
+        for i in range(5):
+            produced.append(i)
+            yield i
+
+    prefetched = hh.prefetch(items(), depth=2)
+    first = next(prefetched)
+    hh.time.sleep(0.05)
+
+    assert first == 0
+    assert len(produced) <= 3
+    assert [first, *prefetched] == list(range(5))
+
+
+def test_prefetch_raises_errors_of_items_after_yielding_earlier_items():
+    def items():
+        yield 1
+        raise ValueError("bad piece")
+
+    prefetched = hh.prefetch(items())
+
+    assert next(prefetched) == 1
+    with pytest.raises(ValueError, match="bad piece"):
+        next(prefetched)
+
+
+def test_str_predicate_respects_order_of_categories():
+    first = pd.Series(["od fee", "x"], dtype=pd.CategoricalDtype(["od fee", "x"]))
+    second = pd.Series(["od fee", "x"], dtype=pd.CategoricalDtype(["x", "od fee"]))
+
+    assert hh.str_predicate(first, "fee").tolist() == [True, False]
+    assert hh.str_predicate(second, "fee").tolist() == [True, False]
+
+
+def test_str_predicate_reuses_matches_of_series_sharing_categories():
+    series = pd.Series(["od fee", "x", "od fee"], dtype="category")
+    hh._category_matches.cache_clear()
+
+    hh.str_predicate(series, "fee")
+    hh.str_predicate(series[series.ne("x")], "fee")
+
+    assert hh._category_matches.cache_info().hits == 1
+
+
+def test_lazy_import_executes_module_once_for_concurrent_first_access(
+    tmp_path, monkeypatch
+):
+    module_path = tmp_path / "slow_lazy_module.py"
+    module_path.write_text("import time\ntime.sleep(0.2)\nVALUE = 1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(hh.sys.modules, "slow_lazy_module", raising=False)
+    module = hh.lazy_import("slow_lazy_module")
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        values = list(executor.map(lambda _: module.VALUE, range(4)))
+
+    assert values == [1] * 4
+
+
+def test_timer_categorises_spans_of_module_run_as_main(monkeypatch):
+    main = hh.types.ModuleType("__main__")
+    main.__spec__ = hh.importlib.util.find_spec("src.data.make_data")
+    monkeypatch.setitem(hh.sys.modules, "__main__", main)
+    monkeypatch.setattr(hh.trace, "events", [])
+    monkeypatch.setattr(hh.trace, "enabled", True)
+
+    def step():
+        pass
+
+    step.__module__ = "__main__"
+    hh.timer(step, on=False)()
+
+    assert [e["cat"] for e in hh.trace.events] == ["make_data"]
@@ -0,0 +1,25 @@
+import pandas as pd
+
+from src import config
+import src.helpers.io as io
+
+
+def test_s3_urls_are_served_from_local_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "S3_ROOT", str(tmp_path))
+    df = pd.DataFrame({"user_id": [1, 2], "amount": [1.5, 2.5]})
+    url = "s3://bucket/clean/pieces/mdb_XX0.parquet"
+
+    io.write_parquet(df, url)
+    io.write_csv(df, "s3://bucket/lookup.csv")
+
+    assert (tmp_path / "bucket" / "clean" / "pieces" / "mdb_XX0.parquet").exists()
+    pd.testing.assert_frame_equal(io.read_parquet(url), df)
+    pd.testing.assert_frame_equal(io.read_csv("s3://bucket/lookup.csv"), df)
+    assert io.glob("s3://bucket/clean/pieces/*.parquet") == [url]
+    assert io.modified(url) is not None
+    assert io.modified("s3://bucket/missing.parquet") is None
+
+
+def test_s3_filesystems_are_shared_per_profile():
+    assert io._s3("a") is io._s3("a")
+    assert io._s3("a") is not io._s3("b")
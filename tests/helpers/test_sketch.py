@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import src.helpers.sketch as sk
+
+
+def test_quantiles_are_exact_before_compaction():
+    values = np.random.default_rng(0).exponential(30, 500)
+    values[::10] = np.nan
+
+    sketch = sk.QuantileSketch().update(values)
+
+    q = [0.01, 0.5, 0.99]
+    np.testing.assert_array_equal(sketch.quantile(q), np.nanquantile(values, q))
+
+
+def test_merged_sketches_estimate_ranks_of_all_values():
+    values = np.random.default_rng(0).lognormal(3, 1, 200_000)
+    sketch = sk.QuantileSketch(k=512)
+    for part in np.array_split(values, 8):
+        sketch.merge(sk.QuantileSketch(k=512).update(part))
+
+    q = np.array([0.01, 0.5, 0.99])
+    ranks = np.searchsorted(np.sort(values), sketch.quantile(q)) / len(values)
+
+    assert sketch.count == len(values)
+    assert sum(len(items) for items in sketch.levels) < 3 * 512
+    np.testing.assert_allclose(ranks, q, atol=1.7 / 512)
+
+
+def test_sketch_columns_adds_values_to_existing_sketches():
+    df = pd.DataFrame({"a": [1.0, 2.0, np.nan], "b": [1, 2, 3]})
+
+    sketches = sk.sketch_columns(df)
+    sk.merge_sketches(sketches, sk.sketch_columns(df[["a"]] + 2))
+
+    assert sketches["a"].count == 4
+    assert sketches["a"].quantile(1.0) == 4.0
+    assert sketches["b"].quantile(0.5) == 2.0
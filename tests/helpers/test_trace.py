@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+import src.helpers.trace as trace
+
+
+@pytest.fixture
+def tracing(monkeypatch):
+    monkeypatch.setattr(trace, "events", [])
+    monkeypatch.setattr(trace, "enabled", True)
+
+
+@trace.traced(cat="test")
+def child():
+    return 1
+
+
+def leaf():
+    return 2
+
+
+def test_spans_nest_and_report_self_time(tracing, tmp_path):
+    with trace.span("parent", "test", piece="a"):
+        child()
+        trace.call(leaf, cat="test")
+
+    names = [e["name"] for e in trace.events]
+    assert names == ["child", "leaf", "parent"]
+    parent = trace.events[-1]
+    assert parent["args"] == {"piece": "a"}
+    assert all(e["ts"] >= parent["ts"] for e in trace.events)
+
+    table = trace.top_spans(trace.events).set_index("name")
+    children_s = sum(e["dur"] for e in trace.events[:2]) / 1e6
+    assert table.loc["leaf", "cat"] == "test"
+    assert table.loc["parent", "self_s"] == pytest.approx(
+        parent["dur"] / 1e6 - children_s
+    )
+
+    path = str(tmp_path / "trace.json")
+    trace.write_chrome_trace(path, trace.events)
+    with open(path) as f:
+        assert json.load(f)["traceEvents"] == trace.events
+
+
+def test_nothing_is_recorded_when_disabled(monkeypatch):
+    monkeypatch.setattr(trace, "events", [])
+    monkeypatch.setattr(trace, "enabled", False)
+
+    with trace.span("parent"):
+        child()
+
+    assert trace.events == []
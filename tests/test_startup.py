@@ -0,0 +1,54 @@
+"""
+Startup benchmark for the data command line programs.
+
+Runs each program with `--help` under `python -X importtime` and fails if
+the total import time exceeds the budget or a heavy dependency is imported
+before arguments are parsed. Set STARTUP_BUDGET_MS to override the budget
+on slow machines.
+
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", 150))
+
+HEAVY_MODULES = ["IPython", "numpy", "pandas", "pyarrow", "s3fs", "scipy"]
+
+CLIS = ["src.data.make_data", "src.data.clean"]
+
+
+def import_times(module):
+    """Returns cumulative import time in ms of top-level imports of module CLI."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", module, "--help"],
+        cwd=ROOTDIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    pattern = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| (\S+)$")
+    times = {}
+    for line in result.stderr.splitlines():
+        match = pattern.match(line)
+        if match:
+            times[match.group(2)] = int(match.group(1)) / 1000
+    return times
+
+
+@pytest.mark.parametrize("module", CLIS)
+def test_cli_startup_within_budget(module):
+    times = import_times(module)
+    heavy = [m for m in times if m.split(".")[0] in HEAVY_MODULES]
+    total = sum(times.values())
+    slowest = sorted(times.items(), key=lambda x: -x[1])[:10]
+
+    assert not heavy, f"Heavy modules imported at startup: {heavy}"
+    assert total < STARTUP_BUDGET_MS, f"Startup took {total:.0f}ms: {slowest}"